@@ -0,0 +1,188 @@
+import math
+from datetime import timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, Count, FloatField, Q, Sum, Value, When
+from django.db.models.functions import Cast, Coalesce, Floor, Ln, TruncDay, TruncHour
+from django.utils import timezone
+
+from api.models import Order, Shipment
+
+
+HOUR = timedelta(hours=1)
+DAY = timedelta(days=1)
+MAX_WINDOW = timedelta(days=731)
+
+# Гистограмма цен в логарифмической шкале: соседние границы корзин отличаются на 2%,
+# поэтому перцентиль по гистограмме ошибается не больше чем на ~1%. В отличие от
+# самих перцентилей, гистограммы часовых и суточных свёрток можно просто складывать.
+PRICE_BIN_WIDTH = math.log(1.02)
+PERCENTILES = (50, 90, 95)
+
+GRANULARITIES = {
+    'hour': (HOUR, TruncHour),
+    'day': (DAY, TruncDay),
+}
+
+# Поля свёртки маршрута за один бакет (плюс гистограмма цен последним элементом).
+# shipments, delayed, rating - по рейсу, который везёт заказ (у сборного - общий рейс);
+# цена рейса - одна на всю машину, поэтому считается только по основному заказу (priced)
+ROLLUP_FIELDS = (
+    'orders', 'weight', 'volume', 'shipments', 'priced', 'price_sum', 'delayed', 'rating_sum', 'rating_count',
+)
+
+
+def floor_hour(moment):
+    return moment.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def align_window(since, until):
+    """Окно [since, until) с точностью до часа; будущее отрезается по текущему часу."""
+    since = floor_hour(since)
+    until = min(until, timezone.now())
+    aligned_until = floor_hour(until)
+    if aligned_until < until:
+        aligned_until += HOUR
+    return since, max(since, aligned_until)
+
+
+def split_window(since, until):
+    """Бакеты (granularity, start), покрывающие окно: целые сутки, по краям - часы."""
+    buckets = []
+    moment = since
+    while moment < until:
+        if moment.hour == 0 and moment + DAY <= until:
+            buckets.append(('day', moment))
+            moment += DAY
+        else:
+            buckets.append(('hour', moment))
+            moment += HOUR
+    return buckets
+
+
+def _cache_key(granularity, start):
+    return f'analytics:routes:v2:{granularity}:{start:%Y%m%d%H}'
+
+
+def _compute(granularity, starts):
+    """Свёртки по маршрутам для бакетов одного размера - один GROUP BY на все бакеты."""
+    size, trunc = GRANULARITIES[granularity]
+    rollups = {start: {} for start in starts}
+    rows = (
+        Order.objects
+        .filter(created_at__gte=min(starts), created_at__lt=max(starts) + size)
+        .annotate(
+            bucket=trunc('created_at', tzinfo=dt_timezone.utc),
+            price_bin=Case(
+                When(shipment__price__gt=0, then=Floor(
+                    Ln(Cast('shipment__price', FloatField())) / Value(PRICE_BIN_WIDTH),
+                )),
+                output_field=FloatField(),
+            ),
+            # рейс заказа: свой или сборный (у основного заказа сборного рейса это один и тот же)
+            trip=Coalesce('shipment', 'consolidated_shipment'),
+            trip_status=Coalesce('shipment__status', 'consolidated_shipment__status'),
+            trip_rating=Coalesce('shipment__review_rating', 'consolidated_shipment__review_rating'),
+        )
+        .values('bucket', 'city_from', 'city_to', 'price_bin')
+        .annotate(
+            orders=Count('pk'),
+            weight=Sum('weight'),
+            volume=Sum('volume'),
+            shipments=Count('trip'),
+            priced=Count('shipment'),
+            price_sum=Sum('shipment__price'),
+            delayed=Count('trip', filter=Q(trip_status=Shipment.StatusChoices.DELAYED)),
+            rating_sum=Sum('trip_rating'),
+            rating_count=Count('trip_rating'),
+        )
+        .order_by()
+    )
+    for row in rows:
+        routes = rollups.get(row['bucket'])
+        if routes is None:
+            continue  # бакет из диапазона, который уже лежит в кэше
+        route = routes.setdefault((str(row['city_from']), str(row['city_to'])), [0] * len(ROLLUP_FIELDS) + [{}])
+        for i, field in enumerate(ROLLUP_FIELDS):
+            route[i] += row[field] or 0
+        if row['price_bin'] is not None:
+            histogram = route[-1]
+            price_bin = int(row['price_bin'])
+            histogram[price_bin] = histogram.get(price_bin, 0) + row['priced']
+    return rollups
+
+
+def _rollups(buckets):
+    """Свёртки бакетов: закрытые - из кэша (ANALYTICS_ROLLUP_TTL), текущий час - всегда заново."""
+    now = timezone.now()
+    closed = [(g, start) for g, start in buckets if start + GRANULARITIES[g][0] <= now]
+    cached = cache.get_many([_cache_key(g, start) for g, start in closed])
+
+    result, missing = [], {}
+    for granularity, start in buckets:
+        rollup = cached.get(_cache_key(granularity, start))
+        if rollup is None:
+            missing.setdefault(granularity, []).append(start)
+        else:
+            result.append(rollup)
+
+    fresh = {}
+    for granularity, starts in missing.items():
+        for start, rollup in _compute(granularity, starts).items():
+            result.append(rollup)
+            if start + GRANULARITIES[granularity][0] <= now:
+                fresh[_cache_key(granularity, start)] = rollup
+    if fresh:
+        cache.set_many(fresh, settings.ANALYTICS_ROLLUP_TTL)
+    return result
+
+
+def _percentile(histogram, total, q):
+    rank = q / 100 * total
+    seen = 0
+    for price_bin in sorted(histogram):
+        seen += histogram[price_bin]
+        if seen >= rank:
+            return round(math.exp((price_bin + 0.5) * PRICE_BIN_WIDTH), 2)
+    return None
+
+
+def route_stats(since, until, city_from=None, city_to=None, limit=100):
+    """Статистика по маршрутам (city_from, city_to) за окно, самые загруженные первыми."""
+    since, until = align_window(since, until)
+    merged = {}
+    for rollup in _rollups(split_window(since, until)):
+        for route, values in rollup.items():
+            if (city_from and route[0] != str(city_from)) or (city_to and route[1] != str(city_to)):
+                continue
+            total = merged.setdefault(route, [0] * len(ROLLUP_FIELDS) + [{}])
+            for i in range(len(ROLLUP_FIELDS)):
+                total[i] += values[i]
+            histogram = total[-1]
+            for price_bin, count in values[-1].items():
+                histogram[price_bin] = histogram.get(price_bin, 0) + count
+
+    routes = []
+    for (route_from, route_to), values in merged.items():
+        stats = dict(zip(ROLLUP_FIELDS, values))
+        histogram = values[-1]
+        binned = sum(histogram.values())
+        shipments = stats['shipments']
+        priced = stats['priced']
+        routes.append({
+            'city_from': route_from,
+            'city_to': route_to,
+            'orders': stats['orders'],
+            'weight': stats['weight'],
+            'volume': stats['volume'],
+            'shipments': shipments,
+            'price': {
+                'avg': round(stats['price_sum'] / priced, 3) if priced else None,
+                **{f'p{q}': _percentile(histogram, binned, q) if binned else None for q in PERCENTILES},
+            },
+            'delayed_share': round(stats['delayed'] / shipments, 4) if shipments else None,
+            'average_rating': round(stats['rating_sum'] / stats['rating_count'], 2) if stats['rating_count'] else None,
+        })
+    routes.sort(key=lambda route: (-route['orders'], route['city_from'], route['city_to']))
+    return {'since': since, 'until': until, 'routes': routes[:limit]}
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "api"
+
+    def ready(self):
+        # сигналы и обработчики очереди задач регистрируются при импорте
+        from api import dashboard, events, signals  # noqa: F401
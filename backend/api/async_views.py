@@ -0,0 +1,105 @@
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.http import Http404, JsonResponse
+from rest_framework import status
+from rest_framework.permissions import AllowAny
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+
+class AsyncAPIView(APIView):
+    """APIView с async-обработчиками без синхронной обвязки DRF (парсеры, аутентификация,
+    рендереры): обработчик сам разбирает запрос и возвращает JsonResponse.
+
+    От APIView наследуемся ради drf-spectacular - схема строится только по APIView,
+    поэтому обработчики описываются через @extend_schema, как у остальных вью."""
+
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        self.request = request
+        method = request.method.lower()
+        handler = getattr(self, method, None) if method in self.http_method_names else None
+        if not iscoroutinefunction(handler):
+            return JsonResponse(
+                {'detail': f'Method "{request.method}" not allowed.'}, status=status.HTTP_405_METHOD_NOT_ALLOWED,
+            )
+        return await handler(request, *args, **kwargs)
+
+
+class AsyncReadMixin:
+    """Async list/retrieve для вьюсета на тех же маршрутах, сериализаторах и правах.
+
+    as_view() оборачивает обычную DRF-вью: GET/HEAD на list/retrieve идут через async ORM
+    и не держат поток воркера, пока Postgres отвечает; остальные методы и действия
+    выполняются синхронной вью как раньше. Включается настройкой ASYNC_READ_PATH
+    (по умолчанию - только под ASGI): под WSGI async-вью обошлась бы лишним event loop
+    на каждый запрос, поэтому там as_view() отдаёт обычную синхронную вью."""
+
+    async_actions = ('list', 'retrieve')
+
+    @classmethod
+    def as_view(cls, actions=None, **initkwargs):
+        sync_view = super().as_view(actions, **initkwargs)
+        action = (actions or {}).get('get')
+        if action not in cls.async_actions or not settings.ASYNC_READ_PATH:
+            return sync_view
+
+        async def view(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return await sync_to_async(sync_view)(request, *args, **kwargs)
+            self = cls(**initkwargs)
+            self.action_map = actions
+            self.action = action
+            return await self.async_dispatch(request, *args, **kwargs)
+
+        # cls, initkwargs, actions, csrf_exempt - для роутера и drf-spectacular
+        view.__dict__.update(sync_view.__dict__)
+        return view
+
+    async def async_dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+        try:
+            # аутентификация (кэш токенов, на холодном запросе - БД) и права
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+            handler = self.alist if self.action == 'list' else self.aretrieve
+            response = await handler(request, *args, **kwargs)
+        except Exception as exc:
+            response = self.handle_exception(exc)
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+    async def aserialize(self, instance, many=False):
+        return self.get_serializer(instance, many=many).data
+
+    async def alist(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        paginator = self.paginator
+        if paginator is None:
+            return Response(await self.aserialize([obj async for obj in queryset], many=True))
+        page = await paginator.apaginate_queryset(queryset, request, view=self)
+        return paginator.get_paginated_response(await self.aserialize(page, many=True))
+
+    async def aget_object(self):
+        queryset = self.filter_queryset(self.get_queryset())
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            obj = await queryset.aget(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        except queryset.model.DoesNotExist:
+            raise Http404(f'No {queryset.model._meta.object_name} matches the given query.')
+        except (TypeError, ValueError, ValidationError):
+            # как generics.get_object_or_404: некорректный pk - тоже 404
+            raise Http404
+        self.check_object_permissions(self.request, obj)
+        return obj
+
+    async def aretrieve(self, request, *args, **kwargs):
+        return Response(await self.aserialize(await self.aget_object()))
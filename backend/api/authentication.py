@@ -0,0 +1,108 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from api.caching import bump_version, get_version
+
+
+def user_epoch_key(user_id):
+    return f'auth:epoch:{user_id}'
+
+
+def invalidate_user_tokens(user_id):
+    """Сбрасывает закэшированные токены пользователя во всех процессах."""
+    bump_version(user_epoch_key(user_id))
+
+
+def token_expired(token):
+    lifetime = settings.TOKEN_EXPIRE_SECONDS
+    return bool(lifetime) and token.created < timezone.now() - timedelta(seconds=lifetime)
+
+
+def issue_token(user):
+    """Токен для логина/регистрации. Истёкший или старше TOKEN_ROTATE_SECONDS заменяется новым."""
+    token, created = Token.objects.get_or_create(user=user)
+    rotate_after = settings.TOKEN_ROTATE_SECONDS
+    if not created and (
+        token_expired(token)
+        or (rotate_after and token.created < timezone.now() - timedelta(seconds=rotate_after))
+    ):
+        token = rotate_token(user)
+    return token
+
+
+def rotate_token(user):
+    # удаление токена сбрасывает кэш через сигнал (см. signals)
+    Token.objects.filter(user=user).delete()
+    return Token.objects.create(user=user)
+
+
+def revoke_token(user):
+    Token.objects.filter(user=user).delete()
+
+
+class TokenCache:
+    """LRU key -> (token, epoch) с TTL, свой в каждом процессе; token.user уже загружен.
+
+    Эпоха пользователя лежит в общем кэше (см. CACHES): logout, смена пароля
+    или роли увеличивают её, и записи других процессов перестают совпадать.
+    Изменение, закоммиченное во время холодного запроса, может прожить в кэше до TOKEN_CACHE_TTL."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        _, token, epoch = entry
+        if epoch != get_version(user_epoch_key(token.user_id)):
+            self.discard(key)
+            return None
+        return token
+
+    def set(self, key, token, epoch):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + settings.TOKEN_CACHE_TTL, token, epoch)
+            self._entries.move_to_end(key)
+            while len(self._entries) > settings.TOKEN_CACHE_SIZE:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = TokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication с проверкой срока жизни токена и кэшем token -> user:
+    на тёплом запросе к БД не обращаемся вовсе."""
+
+    def authenticate_credentials(self, key):
+        token = token_cache.get(key)
+        if token is None:
+            user, token = super().authenticate_credentials(key)
+            token_cache.set(key, token, get_version(user_epoch_key(user.pk)))
+        if token_expired(token):
+            token_cache.discard(key)
+            raise exceptions.AuthenticationFailed('Token has expired.')
+        return token.user, token
@@ -0,0 +1,174 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, DateTimeField, ExpressionWrapper, F, OuterRef, Q, Subquery, Value, When
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from api.matching import fleet_index
+from api.models import Downtime, Driver, Shipment, Vehicle
+from api.serializers import FreeWindowSerializer
+
+
+# Занятость ресурса - интервалы [начало, конец): активные рейсы (departure_time -> arrival_time)
+# и простои (Downtime). Интервалы одного ресурса не пересекаются - это проверяется при каждой
+# записи. Поэтому пересекается ли [start, end) с чем-то, решает один интервал: последний,
+# начавшийся раньше end (его конец - максимальный среди них). Это один seek по индексу
+# (ресурс, -начало), O(log n) независимо от длины истории.
+# Задержанный рейс (Delayed) занимает ресурс до arrival_time + SHIPMENT_DELAY_GRACE_SECONDS:
+# открытый конец навсегда блокировал бы водителя и машину, если рейс так и не закрыли.
+
+RESOURCES = {Driver: 'driver', Vehicle: 'vehicle'}
+
+# "сейчас" как интервал для производного флага is_available
+INSTANT = timedelta(microseconds=1)
+
+
+def annotate_busy(queryset, start, end, exclude_downtime=None):
+    """Аннотирует ресурсы данными для проверки пересечения с [start, end)."""
+    resource = RESOURCES[queryset.model]
+    trips = Shipment.objects.filter(**{resource: OuterRef('pk')}).order_by()
+    downtimes = Downtime.objects.filter(**{resource: OuterRef('pk')}).order_by()
+    if exclude_downtime is not None:
+        downtimes = downtimes.exclude(pk=exclude_downtime)
+    return queryset.annotate(
+        busy_trip_end=Subquery(
+            trips.filter(status=Shipment.StatusChoices.IN_PROGRESS, departure_time__lt=end)
+            .order_by('-departure_time').values('arrival_time')[:1]
+        ),
+        busy_delayed_end=Subquery(
+            trips.filter(status=Shipment.StatusChoices.DELAYED, departure_time__lt=end)
+            .order_by('-arrival_time').values('arrival_time')[:1]
+        ),
+        busy_downtime_end=Subquery(downtimes.filter(start__lt=end).order_by('-start').values('end')[:1]),
+    )
+
+
+def _delay_grace():
+    return timedelta(seconds=settings.SHIPMENT_DELAY_GRACE_SECONDS)
+
+
+def busy_q(start):
+    return (
+        Q(busy_trip_end__gt=start)
+        | Q(busy_delayed_end__gt=start - _delay_grace())
+        | Q(busy_downtime_end__gt=start)
+    )
+
+
+def free_q(start):
+    return (
+        (Q(busy_trip_end__isnull=True) | Q(busy_trip_end__lte=start))
+        & (Q(busy_delayed_end__isnull=True) | Q(busy_delayed_end__lte=start - _delay_grace()))
+        & (Q(busy_downtime_end__isnull=True) | Q(busy_downtime_end__lte=start))
+    )
+
+
+def busy_ids(model, pks, start, end, exclude_downtime=None):
+    """Какие из ресурсов pks заняты хотя бы частично в [start, end). Один запрос."""
+    if not pks:
+        return set()
+    queryset = annotate_busy(model.objects.filter(pk__in=pks), start, end, exclude_downtime)
+    return set(queryset.filter(busy_q(start)).values_list('pk', flat=True))
+
+
+def busy_intervals(model, pks, start, end):
+    """Интервалы занятости ресурсов pks, пересекающие [start, end): {pk: [(начало, конец)]}.
+
+    Один запрос (рейсы UNION ALL простои) на любое число окон внутри [start, end):
+    пересечения с каждым окном пачки проверяются уже в Python (см. overlaps)."""
+    if not pks:
+        return {}
+    resource = RESOURCES[model]
+    trip_end = ExpressionWrapper(
+        Case(
+            When(status=Shipment.StatusChoices.DELAYED, then=F('arrival_time') + Value(_delay_grace())),
+            default=F('arrival_time'),
+        ),
+        output_field=DateTimeField(),
+    )
+    trips = (
+        Shipment.objects.filter(
+            **{f'{resource}__in': pks},
+            status__in=[Shipment.StatusChoices.IN_PROGRESS, Shipment.StatusChoices.DELAYED],
+            departure_time__lt=end,
+        )
+        .annotate(busy_end=trip_end).filter(busy_end__gt=start)
+        .order_by().values_list(resource, 'departure_time', 'busy_end')
+    )
+    downtimes = (
+        Downtime.objects.filter(**{f'{resource}__in': pks}, start__lt=end, end__gt=start)
+        .order_by().values_list(resource, 'start', 'end')
+    )
+    intervals = {}
+    for pk, busy_start, busy_end in trips.union(downtimes, all=True):
+        intervals.setdefault(pk, []).append((busy_start, busy_end))
+    return intervals
+
+
+def free_between(queryset, start, end):
+    """Ресурсы, свободные на всём [start, end)."""
+    return annotate_busy(queryset, start, end).filter(free_q(start))
+
+
+def sync_available(model, pks=None, now=None):
+    """Пересчитывает is_available - "свободен прямо сейчас" - по интервалам.
+
+    Флаг - производный: им пользуются подбор и планировщик "на сейчас" (matching, planner).
+    Возвращает pk ресурсов, у которых флаг поменялся; индекс парка обновляется после коммита."""
+    now = now or timezone.now()
+    queryset = model.objects.all() if pks is None else model.objects.filter(pk__in=pks)
+    annotated = annotate_busy(queryset, now, now + INSTANT)
+    went_busy = list(annotated.filter(busy_q(now), is_available=True).values_list('pk', flat=True))
+    went_free = list(annotated.filter(free_q(now), is_available=False).values_list('pk', flat=True))
+    for changed, available in ((went_busy, False), (went_free, True)):
+        if not changed:
+            continue
+        # update() обходит auto_now - updated_at ставим сами
+        model.objects.filter(pk__in=changed).update(is_available=available, updated_at=timezone.now())
+        kind = 'drivers' if model is Driver else 'vehicles'
+        transaction.on_commit(
+            lambda changed=changed, available=available:
+                fleet_index.set_availability(**{kind: changed}, available=available)
+        )
+    return went_busy + went_free
+
+
+def sync_all():
+    """Задача планировщика: рейсы и простои начинаются и заканчиваются сами по себе."""
+    with transaction.atomic():
+        return sync_available(Driver) + sync_available(Vehicle)
+
+
+def overlaps(windows, start, end):
+    """Пересекается ли [start, end) с одним из уже выбранных окон (в пределах одной пачки)."""
+    return any(other_start < end and start < other_end for other_start, other_end in windows)
+
+
+class FreeWindowMixin:
+    """?free_from=&free_to= у списка водителей/машин - только свободные на всём окне."""
+
+    def filters_by_window(self):
+        params = self.request.query_params
+        return self.action == 'list' and ('free_from' in params or 'free_to' in params)
+
+    def conditional_enabled(self):
+        # занятость меняется от рейсов и простоев, а не от updated_at самих водителей/машин
+        return not self.filters_by_window() and super().conditional_enabled()
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if not self.filters_by_window():
+            return queryset
+        serializer = FreeWindowSerializer(data=self.request.query_params)
+        serializer.is_valid(raise_exception=True)
+        window = serializer.validated_data
+        return free_between(queryset, window['free_from'], window['free_to'])
+
+
+def check_downtime(downtime):
+    """Простой не должен пересекаться с рейсами и другими простоями своего ресурса."""
+    model, pk = (Driver, downtime.driver_id) if downtime.driver_id else (Vehicle, downtime.vehicle_id)
+    if busy_ids(model, [pk], downtime.start, downtime.end, exclude_downtime=downtime.pk):
+        raise ValidationError('Resource is busy in this window')
@@ -0,0 +1,383 @@
+from functools import wraps
+
+from django.core.exceptions import ValidationError
+from django.db import OperationalError, transaction
+from django.utils import timezone
+from rest_framework import status
+
+from api import availability, dashboard, events
+from api.matching import fleet_index
+from api.models import Driver, Order, Shipment, Vehicle
+
+
+class BookingError(Exception):
+    def __init__(self, message, status_code=status.HTTP_400_BAD_REQUEST):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+LOCKED_MESSAGE = 'Ресурс сейчас обрабатывается другим диспетчером, повторите запрос'
+
+
+def _locked(model, pk):
+    # NOWAIT: если строку держит другая транзакция, сразу падаем, а не ждём
+    return model.objects.select_for_update(nowait=True).get(pk=pk)
+
+
+# lock_not_available (NOWAIT) и deadlock_detected в PostgreSQL
+LOCK_SQLSTATES = {'55P03', '40P01'}
+
+
+def _is_lock_error(error):
+    if getattr(error.__cause__, 'sqlstate', None) in LOCK_SQLSTATES:
+        return True
+    # SQLite: "database is locked" / "database table is locked"
+    message = str(error)
+    return 'database is locked' in message or 'database table is locked' in message
+
+
+def _atomic(func):
+    # Каждый переход статуса - одна транзакция. Конфликт блокировок
+    # (или "database is locked" в SQLite) превращаем в 409, остальные ошибки БД не прячем.
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            with transaction.atomic():
+                return func(*args, **kwargs)
+        except OperationalError as e:
+            if not _is_lock_error(e):
+                raise
+            raise BookingError(LOCKED_MESSAGE, status.HTTP_409_CONFLICT)
+    return wrapper
+
+
+def _update(queryset, **values):
+    # update() обходит auto_now: updated_at (по нему считаются ETag/Last-Modified) ставим сами
+    return queryset.update(updated_at=timezone.now(), **values)
+
+
+def _sync_fleet_index(drivers, vehicles, available):
+    # queryset.update() не шлёт сигналы, поэтому индекс парка обновляем сами после коммита
+    transaction.on_commit(
+        lambda: fleet_index.set_availability(drivers=drivers, vehicles=vehicles, available=available)
+    )
+
+
+def _pending_order(order_id):
+    try:
+        order = _locked(Order, order_id)
+    except (Order.DoesNotExist, ValidationError):
+        raise BookingError('Order not found', status.HTTP_404_NOT_FOUND)
+    if order.status != Order.StatusChoices.PENDING:
+        raise BookingError('Order not pending')
+    return order
+
+
+def _window_error(departure_time, arrival_time):
+    if arrival_time <= departure_time:
+        return 'arrival_time must be later than departure_time'
+    return None
+
+
+def _occupy_now(drivers, vehicles):
+    # is_available - "свободен прямо сейчас": меняем, только если рейс уже начался.
+    # Запись в строку ресурса заодно сериализует параллельные accept там, где СУБД
+    # не умеет SELECT ... FOR UPDATE (SQLite)
+    now = timezone.now()
+    drivers = [pk for pk, start in drivers if start <= now]
+    vehicles = [pk for pk, start in vehicles if start <= now]
+    if drivers:
+        _update(Driver.objects.filter(pk__in=drivers), is_available=False)
+    if vehicles:
+        _update(Vehicle.objects.filter(pk__in=vehicles), is_available=False)
+    if drivers or vehicles:
+        _sync_fleet_index(drivers, vehicles, available=False)
+
+
+@_atomic
+def accept_order(order_id, driver_id, vehicle_id, arrival_time, price, dispatcher, departure_time=None):
+    departure_time = departure_time or timezone.now()
+    error = _window_error(departure_time, arrival_time)
+    if error:
+        raise BookingError(error)
+    order = _pending_order(order_id)
+    try:
+        driver = _locked(Driver, driver_id)
+        vehicle = _locked(Vehicle, vehicle_id)
+    except (Driver.DoesNotExist, Vehicle.DoesNotExist):
+        raise BookingError('Driver or Vehicle not found')
+
+    # строки водителя и машины заблокированы - пересечение проверяем без гонок
+    if (availability.busy_ids(Driver, [driver.pk], departure_time, arrival_time)
+            or availability.busy_ids(Vehicle, [vehicle.pk], departure_time, arrival_time)):
+        raise BookingError('Driver or Vehicle not available')
+    if not _update(
+        Order.objects.filter(pk=order.pk, status=Order.StatusChoices.PENDING),
+        status=Order.StatusChoices.CONFIRMED, dispatcher=dispatcher,
+    ):
+        raise BookingError('Order not pending')
+    order.status = Order.StatusChoices.CONFIRMED
+    order.dispatcher = dispatcher
+    _occupy_now([(driver.pk, departure_time)], [(vehicle.pk, departure_time)])
+    shipment = Shipment.objects.create(
+        order=order, driver=driver, vehicle=vehicle,
+        departure_time=departure_time, arrival_time=arrival_time, price=price,
+    )
+    dashboard.record(
+        dashboard.order_transition(Order.StatusChoices.PENDING, Order.StatusChoices.CONFIRMED),
+        dashboard.shipments_created([shipment.price]),
+    )
+    events.order_changed([order], [shipment])
+    return shipment
+
+
+@_atomic
+def reject_order(order_id, dispatcher):
+    order = _pending_order(order_id)
+    if not _update(
+        Order.objects.filter(pk=order.pk, status=Order.StatusChoices.PENDING),
+        status=Order.StatusChoices.CANCELLED, dispatcher=dispatcher,
+    ):
+        raise BookingError('Order not pending')
+    order.status = Order.StatusChoices.CANCELLED
+    order.dispatcher = dispatcher
+    dashboard.record(dashboard.order_transition(Order.StatusChoices.PENDING, Order.StatusChoices.CANCELLED))
+    events.order_changed([order])
+    return Order.StatusChoices.CANCELLED
+
+
+def _locked_map(model, pks):
+    return {obj.pk: obj for obj in model.objects.select_for_update(nowait=True).filter(pk__in=pks)}
+
+
+def _claim(queryset, expected, **values):
+    # Множественный условный UPDATE: если строк обновилось меньше, чем проверили,
+    # значит кто-то успел раньше - откатываем весь пакет.
+    if _update(queryset, **values) != expected:
+        raise BookingError(LOCKED_MESSAGE, status.HTTP_409_CONFLICT)
+
+
+def _busy_by_window(items):
+    """Занятые ресурсы для каждого окна пачки: по запросу на модель за все окна сразу."""
+    if not items:
+        return {}
+    windows = {item['window'] for item in items}
+    start = min(window[0] for window in windows)
+    end = max(window[1] for window in windows)
+    driver_intervals = availability.busy_intervals(Driver, {item['driver'] for item in items}, start, end)
+    vehicle_intervals = availability.busy_intervals(Vehicle, {item['vehicle'] for item in items}, start, end)
+    return {
+        window: tuple(
+            {pk for pk, spans in intervals.items() if availability.overlaps(spans, *window)}
+            for intervals in (driver_intervals, vehicle_intervals)
+        )
+        for window in windows
+    }
+
+
+@_atomic
+def accept_orders(items, dispatcher):
+    """Пакетное подтверждение: items - список dict(order, driver, vehicle, [departure_time], arrival_time, price).
+    Возвращает результат для каждого элемента в том же порядке."""
+    now = timezone.now()
+    items = [dict(item, window=(item.get('departure_time') or now, item['arrival_time'])) for item in items]
+    for item in items:
+        item['window_error'] = _window_error(*item['window'])
+    orders = _locked_map(Order, {item['order'] for item in items})
+    drivers = _locked_map(Driver, {item['driver'] for item in items})
+    vehicles = _locked_map(Vehicle, {item['vehicle'] for item in items})
+    busy = _busy_by_window([item for item in items if not item['window_error']])
+
+    results = []
+    shipments = []
+    used_orders = set()
+    # окна, уже занятые этой пачкой: один водитель может получить два рейса, если они не пересекаются
+    used_drivers, used_vehicles = {}, {}
+    for item in items:
+        order = orders.get(item['order'])
+        driver = drivers.get(item['driver'])
+        vehicle = vehicles.get(item['vehicle'])
+        window = item['window']
+        error = None
+        if item['window_error']:
+            error = item['window_error']
+        elif order is None:
+            error = 'Order not found'
+        elif order.status != Order.StatusChoices.PENDING or order.pk in used_orders:
+            error = 'Order not pending'
+        elif driver is None or vehicle is None:
+            error = 'Driver or Vehicle not found'
+        elif (driver.pk in busy[window][0] or vehicle.pk in busy[window][1]
+              or availability.overlaps(used_drivers.get(driver.pk, ()), *window)
+              or availability.overlaps(used_vehicles.get(vehicle.pk, ()), *window)):
+            error = 'Driver or Vehicle not available'
+        if error:
+            results.append({'order': item['order'], 'error': error})
+            continue
+
+        used_orders.add(order.pk)
+        used_drivers.setdefault(driver.pk, []).append(window)
+        used_vehicles.setdefault(vehicle.pk, []).append(window)
+        order.status = Order.StatusChoices.CONFIRMED
+        order.dispatcher = dispatcher
+        shipments.append(Shipment(
+            order=order, driver=driver, vehicle=vehicle,
+            departure_time=window[0], arrival_time=window[1], price=item['price'],
+        ))
+        results.append({'order': order.pk, 'status': order.status})
+
+    if shipments:
+        _claim(Order.objects.filter(pk__in=used_orders, status=Order.StatusChoices.PENDING),
+               len(used_orders), status=Order.StatusChoices.CONFIRMED, dispatcher=dispatcher)
+        _occupy_now(
+            [(shipment.driver_id, shipment.departure_time) for shipment in shipments],
+            [(shipment.vehicle_id, shipment.departure_time) for shipment in shipments],
+        )
+        Shipment.objects.bulk_create(shipments)
+        dashboard.record(
+            dashboard.order_transition(Order.StatusChoices.PENDING, Order.StatusChoices.CONFIRMED, len(shipments)),
+            dashboard.shipments_created([shipment.price for shipment in shipments]),
+        )
+        events.order_changed([shipment.order for shipment in shipments], shipments)
+        for result, shipment in zip((r for r in results if 'status' in r), shipments):
+            result['shipment'] = shipment.pk
+    return results
+
+
+@_atomic
+def consolidate_orders(order_ids, driver_id, vehicle_id, arrival_time, price, dispatcher, departure_time=None):
+    """Сборный рейс: несколько Pending-заказов одного маршрута - одна машина и один водитель.
+
+    Перевозка создаётся на первый заказ (Shipment.order), все заказы рейса, включая его,
+    ссылаются на неё через consolidated_shipment. Либо подтверждаются все, либо ни один."""
+    departure_time = departure_time or timezone.now()
+    error = _window_error(departure_time, arrival_time)
+    if error:
+        raise BookingError(error)
+    order_ids = list(dict.fromkeys(order_ids))
+    orders = _locked_map(Order, order_ids)
+    if len(orders) != len(order_ids):
+        raise BookingError('Order not found', status.HTTP_404_NOT_FOUND)
+    orders = [orders[order_id] for order_id in order_ids]
+    if any(order.status != Order.StatusChoices.PENDING for order in orders):
+        raise BookingError('Order not pending')
+    if len({(order.city_from_id, order.city_to_id) for order in orders}) > 1:
+        raise BookingError('Orders must share the same route')
+    try:
+        driver = _locked(Driver, driver_id)
+        vehicle = _locked(Vehicle, vehicle_id)
+    except (Driver.DoesNotExist, Vehicle.DoesNotExist):
+        raise BookingError('Driver or Vehicle not found')
+    if (sum(order.weight for order in orders) > vehicle.max_weight
+            or sum(order.volume for order in orders) > vehicle.max_volume):
+        raise BookingError('Orders exceed vehicle capacity')
+    if (availability.busy_ids(Driver, [driver.pk], departure_time, arrival_time)
+            or availability.busy_ids(Vehicle, [vehicle.pk], departure_time, arrival_time)):
+        raise BookingError('Driver or Vehicle not available')
+
+    shipment = Shipment.objects.create(
+        order=orders[0], driver=driver, vehicle=vehicle,
+        departure_time=departure_time, arrival_time=arrival_time, price=price,
+    )
+    _claim(Order.objects.filter(pk__in=order_ids, status=Order.StatusChoices.PENDING), len(orders),
+           status=Order.StatusChoices.CONFIRMED, dispatcher=dispatcher, consolidated_shipment=shipment)
+    for order in orders:
+        order.status = Order.StatusChoices.CONFIRMED
+        order.dispatcher = dispatcher
+        order.consolidated_shipment = shipment
+    _occupy_now([(driver.pk, departure_time)], [(vehicle.pk, departure_time)])
+    dashboard.record(
+        dashboard.order_transition(Order.StatusChoices.PENDING, Order.StatusChoices.CONFIRMED, len(orders)),
+        dashboard.shipments_created([shipment.price]),
+    )
+    events.consolidated_changed(orders, shipment)
+    return shipment
+
+
+@_atomic
+def reject_orders(order_ids, dispatcher):
+    orders = _locked_map(Order, set(order_ids))
+    results = []
+    rejected = set()
+    for order_id in order_ids:
+        order = orders.get(order_id)
+        if order is None:
+            results.append({'order': order_id, 'error': 'Order not found'})
+        elif order.status != Order.StatusChoices.PENDING or order.pk in rejected:
+            results.append({'order': order_id, 'error': 'Order not pending'})
+        else:
+            rejected.add(order.pk)
+            order.status = Order.StatusChoices.CANCELLED
+            order.dispatcher = dispatcher
+            results.append({'order': order_id, 'status': Order.StatusChoices.CANCELLED})
+    if rejected:
+        _claim(Order.objects.filter(pk__in=rejected, status=Order.StatusChoices.PENDING),
+               len(rejected), status=Order.StatusChoices.CANCELLED, dispatcher=dispatcher)
+        dashboard.record(dashboard.order_transition(
+            Order.StatusChoices.PENDING, Order.StatusChoices.CANCELLED, len(rejected),
+        ))
+        events.order_changed([orders[order_id] for order_id in rejected])
+    return results
+
+
+def _not_in_progress():
+    return BookingError(
+        f"Разрешено обновлять только доставки со статусом {Shipment.StatusChoices.IN_PROGRESS}"
+    )
+
+
+# Доставить можно и задержанный рейс: иначе он навсегда держал бы водителя и машину
+DELIVERABLE = (Shipment.StatusChoices.IN_PROGRESS, Shipment.StatusChoices.DELAYED)
+
+
+def _not_deliverable():
+    return BookingError(
+        f"Разрешено доставлять только перевозки со статусом {' или '.join(DELIVERABLE)}"
+    )
+
+
+def _dispatcher_shipment(shipment_id, dispatcher):
+    # поиск и проверка владельца - в транзакции перехода: "database is locked" даст 409, а не 500
+    try:
+        return Shipment.objects.select_for_update(nowait=True, of=('self',)).get(
+            pk=shipment_id, order__dispatcher=dispatcher,
+        )
+    except (Shipment.DoesNotExist, ValidationError):
+        raise BookingError('Shipment not found', status.HTTP_404_NOT_FOUND)
+
+
+@_atomic
+def deliver_shipment(shipment_id, dispatcher):
+    shipment = _dispatcher_shipment(shipment_id, dispatcher)
+    if shipment.status not in DELIVERABLE:
+        raise _not_deliverable()
+    _locked(Driver, shipment.driver_id)
+    _locked(Vehicle, shipment.vehicle_id)
+
+    if not _update(
+        Shipment.objects.filter(pk=shipment.pk, status=shipment.status),
+        status=Shipment.StatusChoices.DELIVERED,
+    ):
+        raise _not_deliverable()
+    # водитель и транспорт освобождаются в той же транзакции (если сейчас их не держит другой рейс или простой)
+    availability.sync_available(Driver, [shipment.driver_id])
+    availability.sync_available(Vehicle, [shipment.vehicle_id])
+    dashboard.record(dashboard.shipment_transition(shipment.status, Shipment.StatusChoices.DELIVERED))
+    events.shipment_changed(shipment.pk, Shipment.StatusChoices.DELIVERED)
+    return Shipment.StatusChoices.DELIVERED
+
+
+@_atomic
+def delay_shipment(shipment_id, dispatcher):
+    _dispatcher_shipment(shipment_id, dispatcher)
+    if not _update(
+        Shipment.objects.filter(pk=shipment_id, status=Shipment.StatusChoices.IN_PROGRESS),
+        status=Shipment.StatusChoices.DELAYED,
+    ):
+        raise _not_in_progress()
+    dashboard.record(dashboard.shipment_transition(
+        Shipment.StatusChoices.IN_PROGRESS, Shipment.StatusChoices.DELAYED,
+    ))
+    events.shipment_changed(shipment_id, Shipment.StatusChoices.DELAYED)
+    return Shipment.StatusChoices.DELAYED
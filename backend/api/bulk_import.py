@@ -0,0 +1,183 @@
+import csv
+import io
+import json
+
+from django.conf import settings
+from django.db import transaction
+from drf_spectacular.utils import extend_schema
+from rest_framework import serializers, status
+from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser, MultiPartParser
+from rest_framework.response import Response
+from rest_framework.validators import UniqueValidator
+
+from api.caching import invalidate_cities
+from api.distances import distance_matrix
+from api.matching import fleet_index
+from api.models import City, Driver, Vehicle
+from api.serializers import BulkImportSerializer, CitySerializer, DriverSerializer, VehicleSerializer
+from api.spatial import city_index
+
+
+class ImportFileError(ValueError):
+    pass
+
+
+def read_rows(file, name=''):
+    """Строки файла импорта: JSON-массив, NDJSON или CSV с заголовком (по расширению имени)."""
+    if name.endswith(('.json', '.ndjson', '.jsonl')):
+        text = file.read()
+        if isinstance(text, bytes):
+            text = text.decode('utf-8-sig')
+        try:
+            if text.lstrip().startswith('['):
+                return json.loads(text)
+            return [json.loads(line) for line in text.splitlines() if line.strip()]
+        except json.JSONDecodeError as exc:
+            raise ImportFileError(f'Invalid JSON: {exc}')
+    if isinstance(file, io.TextIOBase):
+        text = file
+    else:
+        text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    # пустая ячейка = поле не передано (required / default отрабатывают как в API)
+    return ({key: value for key, value in row.items() if value != ''} for row in csv.DictReader(text))
+
+
+class BulkImporter:
+    """Пакетный импорт строк с правилами сериализатора вьюсета и bulk_create.
+
+    Уникальность проверяется одним запросом на пачку, а не UniqueValidator на каждую строку;
+    дубликаты внутри файла тоже считаются ошибкой строки. bulk_create не шлёт post_save, поэтому
+    after_import получает созданные объекты каждой пачки (в транзакции импорта)."""
+
+    def __init__(self, model, serializer_class, unique_fields=(), after_import=None):
+        self.model = model
+        self.serializer_class = serializer_class
+        self.unique_fields = unique_fields
+        self.after_import = after_import
+
+    def _serializer(self):
+        serializer = self.serializer_class()
+        for name in self.unique_fields:
+            field = serializer.fields[name]
+            field.validators = [v for v in field.validators if not isinstance(v, UniqueValidator)]
+        return serializer
+
+    def run(self, rows, skip_errors=False, chunk_size=None):
+        """Возвращает (created, errors); errors - [{'row': номер с 1, 'errors': {...}}].
+
+        Без skip_errors при любой ошибке ничего не сохраняется."""
+        chunk_size = chunk_size or settings.BULK_IMPORT_CHUNK_SIZE
+        serializer = self._serializer()
+        seen = {name: set() for name in self.unique_fields}
+        created, errors = 0, []
+
+        with transaction.atomic():
+            chunk = []
+            for number, row in enumerate(rows, start=1):
+                chunk.append((number, row))
+                if len(chunk) >= chunk_size:
+                    created += self._import_chunk(serializer, chunk, seen, errors, skip_errors)
+                    chunk = []
+            if chunk:
+                created += self._import_chunk(serializer, chunk, seen, errors, skip_errors)
+            if errors and not skip_errors:
+                transaction.set_rollback(True)
+                return 0, errors
+        return created, errors
+
+    def _import_chunk(self, serializer, chunk, seen, errors, skip_errors):
+        valid = []
+        for number, row in chunk:
+            if not isinstance(row, dict):
+                errors.append({'row': number, 'errors': {'non_field_errors': ['Expected an object.']}})
+                continue
+            try:
+                valid.append((number, serializer.run_validation(row)))
+            except serializers.ValidationError as exc:
+                errors.append({'row': number, 'errors': exc.detail})
+
+        for name in self.unique_fields:
+            values = [data[name] for _, data in valid]
+            existing = set(
+                self.model.objects.filter(**{f'{name}__in': values}).values_list(name, flat=True)
+            )
+            unique = []
+            for number, data in valid:
+                value = data[name]
+                if value in existing or value in seen[name]:
+                    errors.append({'row': number, 'errors': {name: [UniqueValidator.message]}})
+                    continue
+                seen[name].add(value)
+                unique.append((number, data))
+            valid = unique
+
+        # при строгом режиме после первой ошибки только валидируем, в БД не пишем
+        if errors and not skip_errors:
+            return 0
+        objects = self.model.objects.bulk_create([self.model(**data) for _, data in valid])
+        if objects and self.after_import is not None:
+            self.after_import(objects)
+        return len(objects)
+
+
+# То же, что сигналы City/Driver/Vehicle, но пачкой: индексы дополняются после коммита,
+# матрицу расстояний дописывает воркер очереди задач (задача - в транзакции импорта)
+def _after_city_import(cities):
+    distance_matrix.queue_cities([city.pk for city in cities])
+
+    def update():
+        city_index.upsert_cities(cities)
+        invalidate_cities()
+    transaction.on_commit(update)
+
+
+def _after_driver_import(drivers):
+    transaction.on_commit(lambda: fleet_index.upsert_drivers(drivers))
+
+
+def _after_vehicle_import(vehicles):
+    transaction.on_commit(lambda: fleet_index.upsert_vehicles(vehicles))
+
+
+IMPORTERS = {
+    'drivers': BulkImporter(Driver, DriverSerializer, after_import=_after_driver_import),
+    'vehicles': BulkImporter(
+        Vehicle, VehicleSerializer, unique_fields=('license_plate',), after_import=_after_vehicle_import,
+    ),
+    'cities': BulkImporter(City, CitySerializer, after_import=_after_city_import),
+}
+
+
+class BulkImportMixin:
+    """POST .../import/: файл (multipart, поле file) или JSON-массив строк в теле.
+
+    Ответ 201 {'created', 'errors'}; при ошибках без skip_errors - 400 и ничего не создаётся."""
+
+    import_name = None
+
+    @extend_schema(request={'multipart/form-data': BulkImportSerializer}, responses={201: None, 400: None})
+    @action(detail=False, methods=['post'], url_path='import', parser_classes=[MultiPartParser, JSONParser])
+    def bulk_import(self, request):
+        importer = IMPORTERS[self.import_name]
+        if isinstance(request.data, list):
+            rows = request.data
+            skip_errors = serializers.BooleanField().to_internal_value(
+                request.query_params.get('skip_errors', False),
+            )
+        else:
+            params = BulkImportSerializer(data=request.data)
+            params.is_valid(raise_exception=True)
+            upload = params.validated_data['file']
+            skip_errors = params.validated_data['skip_errors']
+            try:
+                rows = read_rows(upload, upload.name)
+            except ImportFileError as exc:
+                return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            created, errors = importer.run(rows, skip_errors=skip_errors)
+        except (csv.Error, UnicodeDecodeError) as exc:
+            return Response({'error': f'Invalid file: {exc}'}, status=status.HTTP_400_BAD_REQUEST)
+        response_status = status.HTTP_400_BAD_REQUEST if errors and not skip_errors else status.HTTP_201_CREATED
+        return Response({'created': created, 'errors': errors}, status=response_status)
@@ -0,0 +1,103 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags
+
+
+CITIES_VERSION_KEY = 'cities:version'
+
+
+def get_version(key):
+    version = cache.get(key)
+    if version is None:
+        # после вытеснения ключа не начинаем с 1 - под старыми номерами могут лежать старые записи
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+async def aget_version(key):
+    version = await cache.aget(key)
+    if version is None:
+        await cache.aadd(key, time.time_ns(), timeout=None)
+        version = await cache.aget(key)
+    return version
+
+
+def bump_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), timeout=None)
+
+
+def cities_version():
+    return get_version(CITIES_VERSION_KEY)
+
+
+def invalidate_cities():
+    bump_version(CITIES_VERSION_KEY)
+
+
+def cities_cache_key(*parts):
+    return ':'.join(('cities', str(cities_version()), *map(str, parts)))
+
+
+async def acities_cache_key(*parts):
+    return ':'.join(('cities', str(await aget_version(CITIES_VERSION_KEY)), *map(str, parts)))
+
+
+def cached_json_response(request, key, render):
+    """Отдаёт готовые байты ответа из кэша со strong ETag.
+
+    render() - обычный вызов DRF-вью; выполняется только при промахе кэша.
+    Если ETag совпал с If-None-Match, клиент получает 304 без тела."""
+    if request.accepted_renderer.format != 'json':
+        # browsable API и прочие форматы не кэшируем
+        return render()
+
+    entry = cache.get(key)
+    if entry is None:
+        response = render()
+        if response.status_code != 200:
+            return response
+        entry = _cache_entry(request, response)
+        cache.set(key, entry, settings.CITY_CACHE_TIMEOUT)
+    return _cached_response(request, entry)
+
+
+async def acached_json_response(request, key, render):
+    """То же для async-вью: render - корутина."""
+    if request.accepted_renderer.format != 'json':
+        return await render()
+
+    entry = await cache.aget(key)
+    if entry is None:
+        response = await render()
+        if response.status_code != 200:
+            return response
+        entry = _cache_entry(request, response)
+        await cache.aset(key, entry, settings.CITY_CACHE_TIMEOUT)
+    return _cached_response(request, entry)
+
+
+def _cache_entry(request, response):
+    body = request.accepted_renderer.render(response.data, request.accepted_media_type)
+    return '"%s"' % hashlib.sha256(body).hexdigest(), body
+
+
+def _cached_response(request, entry):
+    etag, body = entry
+    if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    if etag in if_none_match or '*' in if_none_match:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, max_age=settings.CITY_CACHE_MAX_AGE, must_revalidate=True)
+    patch_vary_headers(response, ('Authorization',))
+    return response
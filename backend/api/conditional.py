@@ -0,0 +1,122 @@
+import hashlib
+
+from django.core.exceptions import ValidationError
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+
+from api.caching import aget_version, get_version
+
+
+class ConditionalGetMixin:
+    """ETag / Last-Modified для list и retrieve; If-None-Match / If-Modified-Since -> 304.
+
+    Валидаторы считаются по updated_at (и по updated_at вложенных объектов из
+    validator_fields) одним запросом, строки при этом не сериализуются. Для списка читается
+    только текущая страница (pk и эти поля, тем же keyset-запросом по индексу, что и сама
+    страница) - стоимость не растёт с размером таблицы. В ETag входят pk строк страницы:
+    удаление или новая строка на странице тоже меняют ответ."""
+
+    validator_fields = ('updated_at',)
+    # ключи версий в кэше (см. caching), от которых ответ зависит помимо самих строк
+    validator_versions = ()
+
+    def conditional_enabled(self):
+        """False - ответ зависит от данных, которые валидаторы не видят: отдаём без ETag."""
+        return True
+
+    def _list_validators(self, rows, versions):
+        last = max((value for row in rows for value in row[1:] if value), default=None)
+        return self._validators(last, versions, *rows)
+
+    def _detail_validators(self, row, versions):
+        if row is None:
+            return None
+        return self._validators(max((value for value in row if value), default=None), versions)
+
+    def _validators(self, last, versions, *extra):
+        request = self.request
+        parts = (
+            request.get_full_path(), request.accepted_renderer.format, request.user.pk,
+            last.isoformat() if last else '', *extra, *versions,
+        )
+        etag = 'W/"%s"' % hashlib.sha1('|'.join(map(str, parts)).encode()).hexdigest()
+        return etag, int(last.timestamp()) if last else None
+
+    def _list_rows(self):
+        queryset = self.filter_queryset(self.get_queryset()).values_list('pk', *self.validator_fields)
+        # запрос страницы с лишней строкой (есть ли следующая), как у самого list
+        page = getattr(self.paginator, 'page_queryset', None)
+        rows = page(queryset, self.request, view=self) if page is not None else None
+        return queryset.order_by('pk') if rows is None else rows
+
+    def _detail_row(self):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        queryset = self.filter_queryset(self.get_queryset()).order_by()
+        return queryset.filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]}).values_list(*self.validator_fields)
+
+    def _conditional(self, request, validators):
+        """304, если клиентская копия актуальна, иначе None."""
+        if validators is None:
+            return None
+        etag, last_modified = validators
+        return get_conditional_response(request, etag=etag, last_modified=last_modified)
+
+    def _with_validators(self, response, validators):
+        if validators is not None and response.status_code in (200, 304):
+            etag, last_modified = validators
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+        # кэшировать можно, но перед использованием - всегда спрашивать сервер
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ('Authorization',))
+        return response
+
+    def list(self, request, *args, **kwargs):
+        if not self.conditional_enabled():
+            return super().list(request, *args, **kwargs)
+        validators = self._list_validators(
+            list(self._list_rows()), [get_version(key) for key in self.validator_versions],
+        )
+        response = self._conditional(request, validators)
+        if response is None:
+            response = super().list(request, *args, **kwargs)
+        return self._with_validators(response, validators)
+
+    def retrieve(self, request, *args, **kwargs):
+        if not self.conditional_enabled():
+            return super().retrieve(request, *args, **kwargs)
+        try:
+            row = self._detail_row().first()
+        except (TypeError, ValueError, ValidationError):
+            # некорректный pk - пусть 404 вернёт обычный retrieve
+            row = None
+        validators = self._detail_validators(row, [get_version(key) for key in self.validator_versions])
+        response = self._conditional(request, validators)
+        if response is None:
+            response = super().retrieve(request, *args, **kwargs)
+        return self._with_validators(response, validators)
+
+    async def alist(self, request, *args, **kwargs):
+        if not self.conditional_enabled():
+            return await super().alist(request, *args, **kwargs)
+        validators = self._list_validators(
+            [row async for row in self._list_rows()], [await aget_version(key) for key in self.validator_versions],
+        )
+        response = self._conditional(request, validators)
+        if response is None:
+            response = await super().alist(request, *args, **kwargs)
+        return self._with_validators(response, validators)
+
+    async def aretrieve(self, request, *args, **kwargs):
+        if not self.conditional_enabled():
+            return await super().aretrieve(request, *args, **kwargs)
+        try:
+            row = await self._detail_row().afirst()
+        except (TypeError, ValueError, ValidationError):
+            row = None
+        validators = self._detail_validators(row, [await aget_version(key) for key in self.validator_versions])
+        response = self._conditional(request, validators)
+        if response is None:
+            response = await super().aretrieve(request, *args, **kwargs)
+        return self._with_validators(response, validators)
@@ -0,0 +1,163 @@
+import numpy as np
+
+from api.models import Order
+from api.planner import ACCEPTED_MATRIX, MAX_ROUNDS, assign_drivers, load_free_fleet
+
+
+def pack(weights, volumes, cap_weight, cap_volume):
+    """First fit decreasing в двух измерениях для машин одной вместимости.
+
+    Заказы - по убыванию доли вместимости в самом "тесном" измерении, каждый - в первую
+    открытую машину, где хватает и веса, и объёма. Возвращает номер машины для каждого
+    заказа, -1 - заказ не влезает даже в пустую."""
+    n = len(weights)
+    result = np.full(n, -1)
+    left_weight = np.empty(n)
+    left_volume = np.empty(n)
+    opened = 0
+    size = np.maximum(weights / cap_weight, volumes / cap_volume)
+    for i in np.argsort(-size, kind='stable'):
+        weight, volume = weights[i], volumes[i]
+        if weight > cap_weight or volume > cap_volume:
+            continue
+        fits = np.flatnonzero((left_weight[:opened] >= weight) & (left_volume[:opened] >= volume))
+        if len(fits):
+            b = fits[0]
+        else:
+            b = opened
+            opened += 1
+            left_weight[b], left_volume[b] = cap_weight, cap_volume
+        left_weight[b] -= weight
+        left_volume[b] -= volume
+        result[i] = b
+    return result
+
+
+def utilization(load_weights, load_volumes, vehicle_weights, vehicle_volumes):
+    """Загрузка машины по самому заполненному измерению: 1 - дальше грузить некуда."""
+    return np.maximum(load_weights / vehicle_weights, load_volumes / vehicle_volumes)
+
+
+def _pack_route(orders, order_weights, order_volumes, vehicle_weights, vehicle_volumes, by_size, free, order_vehicle):
+    """Заказы одного маршрута по машинам: пакуем под самую крупную свободную машину, затем
+    каждой получившейся загрузке отдаём самую маленькую свободную машину, в которую она влезает.
+    Если крупных машин на всех не хватило, оставшиеся заказы пакуются заново под то, что осталось."""
+    for _ in range(MAX_ROUNDS):
+        orders = orders[order_vehicle[orders] < 0]
+        available = by_size[free[by_size]]
+        if len(orders) == 0 or len(available) == 0:
+            return
+        biggest = available[-1]
+        bins = pack(order_weights[orders], order_volumes[orders], vehicle_weights[biggest], vehicle_volumes[biggest])
+        packed = bins >= 0
+        if not packed.any():
+            return
+        n_bins = bins.max() + 1
+        load_weights = np.bincount(bins[packed], weights=order_weights[orders][packed], minlength=n_bins)
+        load_volumes = np.bincount(bins[packed], weights=order_volumes[orders][packed], minlength=n_bins)
+        fullest = np.argsort(-utilization(load_weights, load_volumes, vehicle_weights[biggest], vehicle_volumes[biggest]))
+        for b in fullest:
+            available = by_size[free[by_size]]
+            fits = available[
+                (vehicle_weights[available] >= load_weights[b]) & (vehicle_volumes[available] >= load_volumes[b])
+            ]
+            if len(fits) == 0:
+                continue
+            free[fits[0]] = False
+            order_vehicle[orders[bins == b]] = fits[0]
+
+
+def solve(order_weights, order_volumes, order_routes, vehicle_weights, vehicle_volumes, vehicle_types, driver_categories):
+    """Ядро сборного планировщика на массивах numpy.
+
+    order_routes - номер маршрута (city_from, city_to) для каждого заказа: в одну машину
+    попадают только заказы одного маршрута. vehicle_types и driver_categories - как в planner.solve.
+    Возвращает (машина для каждого заказа, водитель для каждой машины); -1 - не назначен."""
+    n, m = len(order_weights), len(vehicle_weights)
+    order_vehicle = np.full(n, -1)
+    vehicle_driver = np.full(m, -1)
+    if n == 0 or m == 0 or len(driver_categories) == 0:
+        return order_vehicle, vehicle_driver
+
+    # машины от маленькой к большой (в долях самой большой по каждому измерению)
+    by_size = np.argsort(
+        vehicle_weights / vehicle_weights.max() + vehicle_volumes / vehicle_volumes.max(), kind='stable',
+    )
+    # машины, которые некому вести, в план не берём
+    has_driver = (driver_categories.astype(np.int32) @ ACCEPTED_MATRIX.T.astype(np.int32)).any(axis=0)
+    free = has_driver[vehicle_types]
+    _, route_index = np.unique(order_routes, return_inverse=True)
+    by_route = np.argsort(route_index, kind='stable')
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(route_index))])
+    # самые загруженные маршруты первыми: крупные машины нужнее им
+    route_loads = np.bincount(
+        route_index, weights=order_weights / vehicle_weights.max() + order_volumes / vehicle_volumes.max(),
+    )
+    for r in np.argsort(-route_loads, kind='stable'):
+        if not free.any():
+            break
+        _pack_route(
+            by_route[bounds[r]:bounds[r + 1]], order_weights, order_volumes,
+            vehicle_weights, vehicle_volumes, by_size, free, order_vehicle,
+        )
+
+    # водители: сначала самым загруженным машинам; машина без водителя не едет
+    used = np.unique(order_vehicle[order_vehicle >= 0])
+    assigned = order_vehicle >= 0
+    load_weights = np.bincount(order_vehicle[assigned], weights=order_weights[assigned], minlength=m)
+    load_volumes = np.bincount(order_vehicle[assigned], weights=order_volumes[assigned], minlength=m)
+    fill = utilization(load_weights[used], load_volumes[used], vehicle_weights[used], vehicle_volumes[used])
+    drivers = assign_drivers(vehicle_types[used], driver_categories, priority=-fill)
+    vehicle_driver[used] = drivers
+    order_vehicle[assigned & (vehicle_driver[np.maximum(order_vehicle, 0)] < 0)] = -1
+    return order_vehicle, vehicle_driver
+
+
+def build_consolidation_plan(limit=5000):
+    """Dry-run: сборные рейсы для самых старых Pending-заказов по текущему свободному парку."""
+    orders = list(
+        Order.objects.filter(status=Order.StatusChoices.PENDING)
+        .order_by('created_at')
+        .values_list('order_id', 'weight', 'volume', 'city_from_id', 'city_to_id')[:limit]
+    )
+    plates, vehicle_types, vehicle_weights, vehicle_volumes, driver_ids, driver_categories = load_free_fleet()
+
+    routes = {}
+    order_ids = [row[0] for row in orders]
+    order_weights = np.array([row[1] for row in orders], dtype=np.float64)
+    order_volumes = np.array([row[2] for row in orders], dtype=np.float64)
+    order_routes = np.array([routes.setdefault((row[3], row[4]), len(routes)) for row in orders], dtype=np.int64)
+
+    order_vehicle, vehicle_driver = solve(
+        order_weights, order_volumes, order_routes, vehicle_weights, vehicle_volumes, vehicle_types, driver_categories,
+    )
+
+    by_vehicle = {}
+    unassigned = []
+    for i, order_id in enumerate(order_ids):
+        if order_vehicle[i] < 0:
+            unassigned.append(order_id)
+        else:
+            by_vehicle.setdefault(int(order_vehicle[i]), []).append(i)
+    shipments = []
+    for j, items in by_vehicle.items():
+        weight, volume = float(order_weights[items].sum()), float(order_volumes[items].sum())
+        city_from, city_to = orders[items[0]][3:]
+        shipments.append({
+            'city_from': city_from,
+            'city_to': city_to,
+            'vehicle': plates[j],
+            'driver': driver_ids[vehicle_driver[j]],
+            'orders': [order_ids[i] for i in items],
+            'weight': round(weight, 3),
+            'volume': round(volume, 3),
+            'utilization': round(float(utilization(weight, volume, vehicle_weights[j], vehicle_volumes[j])), 4),
+        })
+    shipments.sort(key=lambda shipment: -shipment['utilization'])
+    return {
+        'shipments': shipments,
+        'unassigned': unassigned,
+        'orders': len(order_ids),
+        'vehicles': len(plates),
+        'drivers': len(driver_ids),
+    }
@@ -0,0 +1,153 @@
+import random
+from collections import Counter
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import Count, F, Sum
+
+from api import tasks
+from api.models import DashboardCounter, Order, Shipment, Task
+
+
+REVENUE = 'revenue'
+RATING_SUM = 'rating:sum'
+RATING_COUNT = 'rating:count'
+
+RECORD_TASK = 'dashboard.record'
+# повторы пересчёта, если PostgreSQL не смог его сериализовать с воркерами
+RECONCILE_ATTEMPTS = 3
+
+
+def order_key(status):
+    return f'orders:{status}'
+
+
+def shipment_key(status):
+    return f'shipments:{status}'
+
+
+def record(*changes):
+    """Ставит изменения {ключ: число} счётчиков в очередь задач (api/tasks.py).
+
+    Задача пишется в транзакции самого перехода статуса: откат транзакции откатывает
+    и её. Горячие строки счётчиков обновляет воркер (manage.py run_tasks), а не запрос."""
+    deltas = Counter()
+    for change in changes:
+        deltas.update(change)  # не "+": он выбрасывает отрицательные значения
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if deltas:
+        tasks.enqueue(tasks.call(RECORD_TASK, deltas=deltas))
+
+
+@tasks.handler(RECORD_TASK)
+def apply(deltas):
+    shard = random.randrange(settings.DASHBOARD_COUNTER_SHARDS)
+    with transaction.atomic():
+        # ключи по порядку - две транзакции на одном шарде не заблокируют друг друга крест-накрест
+        for key in sorted(deltas):
+            # в JSON-payload задачи Decimal приходит строкой
+            _add(key, shard, Decimal(deltas[key]))
+
+
+def _add(key, shard, delta):
+    counters = DashboardCounter.objects.filter(key=key, shard=shard)
+    if counters.update(value=F('value') + delta):
+        return
+    try:
+        with transaction.atomic():
+            DashboardCounter.objects.create(key=key, shard=shard, value=delta)
+    except IntegrityError:
+        # строку шарда только что создала параллельная транзакция
+        counters.update(value=F('value') + delta)
+
+
+def order_transition(old, new, count=1):
+    return Counter({order_key(old): -count, order_key(new): count})
+
+
+def shipment_transition(old, new, count=1):
+    return Counter({shipment_key(old): -count, shipment_key(new): count})
+
+
+def shipments_created(prices):
+    return Counter({
+        shipment_key(Shipment.StatusChoices.IN_PROGRESS): len(prices),
+        REVENUE: sum(prices, Decimal(0)),
+    })
+
+
+def review_changed(old_rating, new_rating):
+    deltas = Counter()
+    if old_rating is not None:
+        deltas.update({RATING_SUM: -old_rating, RATING_COUNT: -1})
+    if new_rating is not None:
+        deltas.update({RATING_SUM: new_rating, RATING_COUNT: 1})
+    return deltas
+
+
+def read():
+    """Сводка для дашборда: один запрос по (число ключей x DASHBOARD_COUNTER_SHARDS) строкам."""
+    totals = dict(DashboardCounter.objects.values_list('key').annotate(total=Sum('value')).order_by())
+    rating_count = int(totals.get(RATING_COUNT, 0))
+    rating_sum = totals.get(RATING_SUM, Decimal(0))
+    return {
+        'orders': {status: int(totals.get(order_key(status), 0)) for status in Order.StatusChoices.values},
+        'shipments': {status: int(totals.get(shipment_key(status), 0)) for status in Shipment.StatusChoices.values},
+        'revenue': totals.get(REVENUE, Decimal(0)).quantize(Decimal('0.001')),
+        'reviews': rating_count,
+        'average_rating': round(float(rating_sum) / rating_count, 2) if rating_count else None,
+    }
+
+
+def compute():
+    """Те же значения, посчитанные заново по заказам и перевозкам."""
+    values = Counter()
+    for status, count in Order.objects.values_list('status').annotate(n=Count('pk')).order_by():
+        values[order_key(status)] = count
+    for status, count in Shipment.objects.values_list('status').annotate(n=Count('pk')).order_by():
+        values[shipment_key(status)] = count
+    totals = Shipment.objects.aggregate(
+        revenue=Sum('price'), rating_sum=Sum('review_rating'), rating_count=Count('review_rating'),
+    )
+    values[REVENUE] = totals['revenue'] or 0
+    values[RATING_SUM] = totals['rating_sum'] or 0
+    values[RATING_COUNT] = totals['rating_count']
+    return values
+
+
+def reconcile():
+    """Пересобирает счётчики с нуля. Возвращает {ключ: (было, стало)} для разошедшихся."""
+    for attempt in range(1, RECONCILE_ATTEMPTS + 1):
+        try:
+            return _reconcile()
+        except OperationalError as e:
+            # could_not_serialize: снимок устарел - воркер успел применить задачу
+            if getattr(e.__cause__, 'sqlstate', None) != '40001' or attempt == RECONCILE_ATTEMPTS:
+                raise
+
+
+def _reconcile():
+    # Пересчёт и задачи очереди читаем из одного снимка (REPEATABLE READ в PostgreSQL):
+    # переход, закоммиченный позже, не попадёт ни в compute(), ни в список задач
+    # и применится к новым значениям сам. Уровень изоляции задаётся только в начале транзакции
+    isolate = connection.vendor == 'postgresql' and not connection.in_atomic_block
+    with transaction.atomic():
+        if isolate:
+            with connection.cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        # блокируем ещё не применённые задачи счётчиков (воркеры их пропустят) и сами счётчики
+        pending = Counter()
+        for payload in Task.objects.select_for_update().filter(name=RECORD_TASK).values_list('payload', flat=True):
+            pending.update({key: Decimal(delta) for key, delta in payload['deltas'].items()})
+        list(DashboardCounter.objects.select_for_update().values_list('pk'))
+        before = Counter(dict(DashboardCounter.objects.values_list('key').annotate(total=Sum('value')).order_by()))
+        # задачи из очереди ещё прибавятся к счётчикам - оставляем под них место
+        after = compute()
+        after.subtract(pending)
+        DashboardCounter.objects.exclude(shard=0).update(value=0)
+        DashboardCounter.objects.exclude(key__in=after).update(value=0)
+        for key, value in after.items():
+            if not DashboardCounter.objects.filter(key=key, shard=0).update(value=value):
+                DashboardCounter.objects.create(key=key, shard=0, value=value)
+        return {key: (before[key], after[key]) for key in set(before) | set(after) if before[key] != after[key]}
@@ -0,0 +1,478 @@
+import json
+import logging
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+
+from api import tasks
+from api.geo import haversine
+from api.models import City, Order
+
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессной блокировки нет, пишет один процесс
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+MIN_CAPACITY = 256
+# Место под новые маршруты после отсортированной части; заполнилось - воркер сливает их в новые файлы
+ROUTE_TAIL = 4096
+# Пар на один вызов haversine при сборке
+ROUTE_CHUNK = 100_000
+# Сколько последних изменений городов помнит meta.json: отставший читатель догоняет их, не перечитывая все id
+CITY_CHANGES_KEPT = 256
+# Версия раскладки файлов: meta.json другой версии считается отсутствующим
+FORMAT = 2
+SLOT_BITS = 32
+SLOT_MASK = (1 << SLOT_BITS) - 1
+EMPTY_ID = bytes(16)
+
+
+def route_keys(rows, cols):
+    """Маршрут без направления - пара слотов в одном int64 (меньший слот в старших битах)."""
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    return (np.minimum(rows, cols) << SLOT_BITS) | np.maximum(rows, cols)
+
+
+def _city_key(city_id):
+    try:
+        return (city_id if isinstance(city_id, uuid.UUID) else uuid.UUID(str(city_id))).bytes
+    except ValueError:
+        return None
+
+
+class DistanceMatrix:
+    """Разреженная матрица расстояний (км, float32) по маршрутам заказов.
+
+    Полная матрица n x n при 100k городов заняла бы ~40 ГБ, а цене и ETA нужны только
+    пары, по которым возят. В DISTANCE_MATRIX_DIR лежат memory-mapped файлы, общие
+    для всех воркеров через page cache:
+      ids     - UUID города по слотам (capacity x 16 байт, нули - свободный слот);
+      coords  - широта и долгота по слотам (capacity x 2, float64);
+      keys/km - маршруты (route_keys) и расстояния: отсортированная часть
+                [0, routes_sorted) и хвост маршрутов, добавленных после сборки.
+    meta.json хранит счётчики и имена файлов; он всегда заменяется атомарно (os.replace),
+    а читатели перечитывают города и маршруты, только когда сменилась их версия.
+
+    Файлы пишет только воркер очереди задач (сигналы City и новые маршруты заказов
+    ставят задачи, см. queue_cities/queue_routes) и manage.py build_distance_matrix,
+    который собирает их с нуля. В пути запроса - только чтение. Пара вне маршрутов
+    считается по координатам; пока файлов нет, расстояния неизвестны (None)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded_key = None
+        self._reset()
+
+    def _reset(self):
+        self._cities_key = None
+        self._cities_version = None
+        self._slots = {}  # UUID.bytes -> слот
+        self._slot_ids = {}  # слот -> UUID.bytes
+        self._ids = None
+        self._coords = None
+        self._routes_key = None
+        self._keys = np.empty(0, dtype=np.int64)
+        self._km = np.empty(0, dtype=np.float32)
+        self._tail = {}
+
+    @property
+    def directory(self):
+        return Path(settings.DISTANCE_MATRIX_DIR)
+
+    @contextmanager
+    def _write_lock(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.directory / '.lock', 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_meta(self):
+        try:
+            with open(self.directory / 'meta.json') as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        return meta if meta.get('format') == FORMAT else None
+
+    def _write_meta(self, meta):
+        tmp = self.directory / f'meta.json.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, self.directory / 'meta.json')
+
+    def _open(self, name, dtype, shape, mode='r'):
+        return np.memmap(self.directory / name, dtype=dtype, mode=mode, shape=shape)
+
+    @staticmethod
+    def _new_name(kind, suffix):
+        return f'{kind}-{uuid.uuid4().hex[:12]}.{suffix}'
+
+    # Чтение
+
+    def ensure_loaded(self):
+        meta_path = self.directory / 'meta.json'
+        with self._lock:
+            try:
+                stat = meta_path.stat()
+            except FileNotFoundError:
+                if self._loaded_key != 'missing':
+                    logger.warning('%s not found, run manage.py build_distance_matrix', meta_path)
+                self._reset()
+                self._loaded_key = 'missing'
+                return
+            key = (str(self.directory), stat.st_ino, stat.st_mtime_ns)
+            if key == self._loaded_key:
+                return
+            meta = self._read_meta()
+            if meta is None:
+                # файлы старой раскладки - ждём пересборки
+                self._reset()
+            else:
+                self._load(meta)
+            self._loaded_key = key
+
+    def _load(self, meta):
+        directory = str(self.directory)
+        cities_key = (directory, meta['ids'], meta['coords'])
+        if cities_key != self._cities_key:
+            self._load_cities(meta)
+            self._cities_key = cities_key
+        elif meta['cities_version'] != self._cities_version:
+            self._apply_city_changes(meta)
+
+        routes_key = (directory, meta['keys'], meta['routes_version'])
+        if routes_key != self._routes_key:
+            size, n_sorted, count = meta['routes_capacity'], meta['routes_sorted'], meta['routes_count']
+            keys = self._open(meta['keys'], np.int64, (size,))
+            km = self._open(meta['km'], np.float32, (size,))
+            self._keys, self._km = keys[:n_sorted], km[:n_sorted]
+            self._tail = dict(zip(keys[n_sorted:count].tolist(), km[n_sorted:count].tolist()))
+            self._routes_key = routes_key
+
+    def _load_cities(self, meta):
+        capacity = meta['capacity']
+        self._ids = self._open(meta['ids'], np.uint8, (capacity, 16))
+        self._coords = self._open(meta['coords'], np.float64, (capacity, 2))
+        raw = self._ids[:meta['count']].tobytes()
+        self._slot_ids = {
+            slot: raw[slot * 16:(slot + 1) * 16] for slot in range(meta['count'])
+            if raw[slot * 16:(slot + 1) * 16] != EMPTY_ID
+        }
+        self._slots = {city_key: slot for slot, city_key in self._slot_ids.items()}
+        self._cities_version = meta['cities_version']
+
+    def _apply_city_changes(self, meta):
+        changes = meta['city_changes']
+        if not changes or changes[0][0] > self._cities_version + 1:
+            # пропущенные изменения уже вытеснены из meta.json - перечитываем все id
+            return self._load_cities(meta)
+        for version, slot in changes:
+            if version <= self._cities_version:
+                continue
+            old = self._slot_ids.pop(slot, None)
+            if old is not None:
+                self._slots.pop(old, None)
+            city_key = self._ids[slot].tobytes()
+            if city_key != EMPTY_ID:
+                self._slots[city_key] = slot
+                self._slot_ids[slot] = city_key
+        self._cities_version = meta['cities_version']
+
+    def _slots_of(self, city_ids):
+        slots = self._slots
+        return np.array([slots.get(_city_key(city_id), -1) for city_id in city_ids], dtype=np.int64)
+
+    def _lookup(self, keys):
+        """Расстояния маршрутов из матрицы; NaN - такого маршрута нет."""
+        km = np.full(len(keys), np.nan)
+        if len(self._keys):
+            pos = np.minimum(np.searchsorted(self._keys, keys), len(self._keys) - 1)
+            hit = self._keys[pos] == keys
+            km[hit] = self._km[pos[hit]]
+        if self._tail:
+            for i in np.flatnonzero(np.isnan(km)):
+                km[i] = self._tail.get(int(keys[i]), np.nan)
+        return km
+
+    def _haversine(self, rows, cols):
+        start, end = self._coords[rows], self._coords[cols]
+        return haversine(start[:, 0], start[:, 1], end[:, 0], end[:, 1])
+
+    def distances(self, from_ids, to_ids):
+        """Расстояния (км) для пар городов; None, если город неизвестен."""
+        self.ensure_loaded()
+        rows = self._slots_of(from_ids)
+        cols = self._slots_of(to_ids)
+        result = np.full(len(rows), np.nan)
+        known = np.flatnonzero((rows >= 0) & (cols >= 0))
+        if len(known):
+            km = self._lookup(route_keys(rows[known], cols[known]))
+            # пары вне маршрутов заказов (и ещё не добавленные воркером) - по координатам
+            missing = np.isnan(km)
+            if missing.any():
+                km[missing] = self._haversine(rows[known[missing]], cols[known[missing]])
+            result[known] = km
+        return [None if np.isnan(d) else round(float(d), 3) for d in result]
+
+    def distance(self, from_id, to_id):
+        return self.distances([from_id], [to_id])[0]
+
+    # Постановка записей в очередь задач (в транзакции изменения)
+
+    def queue_cities(self, city_ids):
+        tasks.enqueue(tasks.call('distances.sync_cities', city_ids=[str(city_id) for city_id in city_ids]))
+
+    def queue_routes(self, pairs):
+        """Новые маршруты заказов - в матрицу через воркер; уже известные запрос не трогают."""
+        self.ensure_loaded()
+        if self._loaded_key == 'missing':
+            return  # маршруты возьмёт сборка из таблицы заказов
+        pairs = list(pairs)
+        rows = self._slots_of(city_from for city_from, _ in pairs)
+        cols = self._slots_of(city_to for _, city_to in pairs)
+        known = (rows >= 0) & (cols >= 0)
+        unseen = ~known
+        unseen[known] = np.isnan(self._lookup(route_keys(rows[known], cols[known])))
+        if unseen.any():
+            tasks.enqueue(tasks.call('distances.add_routes', pairs=[
+                [str(city_from), str(city_to)] for (city_from, city_to), new in zip(pairs, unseen) if new
+            ]))
+
+    # Запись: воркер очереди задач и manage.py build_distance_matrix
+
+    def rebuild(self):
+        with self._write_lock():
+            rows = list(City.objects.values_list('city_id', 'latitude', 'longitude'))
+            n = len(rows)
+            capacity = max(MIN_CAPACITY, 1 << int(n * 1.25).bit_length())
+            meta = {
+                'format': FORMAT,
+                'capacity': capacity,
+                'count': n,
+                'free': [],
+                'ids': self._new_name('ids', 'u8'),
+                'coords': self._new_name('coords', 'f64'),
+                'cities_version': 0,
+                'city_changes': [],
+                'routes_version': 0,
+            }
+            ids = self._open(meta['ids'], np.uint8, (capacity, 16), mode='w+')
+            coords = self._open(meta['coords'], np.float64, (capacity, 2), mode='w+')
+            if n:
+                ids[:n] = np.frombuffer(b''.join(row[0].bytes for row in rows), dtype=np.uint8).reshape(n, 16)
+                coords[:n] = np.array([row[1:] for row in rows], dtype=np.float64)
+            ids.flush()
+            coords.flush()
+
+            slots = {row[0]: slot for slot, row in enumerate(rows)}
+            pairs = [
+                (slots[city_from], slots[city_to])
+                for city_from, city_to in Order.objects.values_list('city_from', 'city_to').distinct().order_by()
+            ]
+            keys = np.unique(route_keys(*zip(*pairs))) if pairs else np.empty(0, dtype=np.int64)
+            km = np.empty(len(keys), dtype=np.float32)
+            for start in range(0, len(keys), ROUTE_CHUNK):
+                chunk = keys[start:start + ROUTE_CHUNK]
+                a, b = coords[chunk >> SLOT_BITS], coords[chunk & SLOT_MASK]
+                km[start:start + ROUTE_CHUNK] = haversine(a[:, 0], a[:, 1], b[:, 0], b[:, 1])
+            del ids, coords
+            self._write_routes(meta, keys, km)
+
+            self._write_meta(meta)
+            # старые файлы (и любой прежней раскладки) можно удалять сразу: у читателей остаётся открытый inode
+            current = {'meta.json', meta['ids'], meta['coords'], meta['keys'], meta['km']}
+            for path in self.directory.iterdir():
+                if path.name not in current and not path.name.startswith('.'):
+                    path.unlink(missing_ok=True)
+
+    def _write_routes(self, meta, keys, km):
+        """Отсортированные маршруты в новые файлы, с местом под ROUTE_TAIL новых."""
+        n = len(keys)
+        size = n + ROUTE_TAIL
+        meta.update(
+            keys=self._new_name('keys', 'i8'), km=self._new_name('km', 'f32'),
+            routes_capacity=size, routes_sorted=n, routes_count=n,
+        )
+        meta['routes_version'] += 1
+        keys_file = self._open(meta['keys'], np.int64, (size,), mode='w+')
+        km_file = self._open(meta['km'], np.float32, (size,), mode='w+')
+        keys_file[:n] = keys
+        km_file[:n] = km
+        keys_file.flush()
+        km_file.flush()
+
+    @contextmanager
+    def _writing(self):
+        """Блокировка записи и актуальное состояние; None - файлов ещё нет."""
+        with self._write_lock():
+            meta = self._read_meta()
+            if meta is not None:
+                with self._lock:
+                    self._load(meta)
+                    # meta.json сейчас перепишем - следующий ensure_loaded перечитает изменения
+                    self._loaded_key = None
+            yield meta
+
+    def sync_cities(self, city_ids):
+        """Создание, перемещение и удаление городов: слоты, координаты и маршруты через них."""
+        rows = {
+            city_id.bytes: (float(lat), float(lon))
+            for city_id, lat, lon in City.objects.filter(pk__in=city_ids).values_list('city_id', 'latitude', 'longitude')
+        }
+        with self._writing() as meta:
+            if meta is None:
+                return  # города попадут в файлы при сборке
+            old_files = []
+            changed = []
+            ids, coords = self._city_files(meta)
+            for city_id in city_ids:
+                city_key = _city_key(city_id)
+                slot = self._slots.get(city_key)
+                if city_key not in rows:
+                    if slot is not None:
+                        ids[slot] = 0
+                        del self._slots[city_key]
+                        del self._slot_ids[slot]
+                        meta['free'].append(slot)
+                        changed.append(slot)
+                    continue
+                if slot is None:
+                    if meta['free']:
+                        slot = meta['free'].pop()
+                    else:
+                        if meta['count'] == meta['capacity']:
+                            ids.flush()
+                            coords.flush()
+                            old_files += self._grow(meta)
+                            ids, coords = self._city_files(meta)
+                        slot = meta['count']
+                        meta['count'] += 1
+                    ids[slot] = np.frombuffer(city_key, dtype=np.uint8)
+                    self._slots[city_key] = slot
+                    self._slot_ids[slot] = city_key
+                coords[slot] = rows[city_key]
+                changed.append(slot)
+            ids.flush()
+            coords.flush()
+            del ids, coords
+            if not changed:
+                return
+            for slot in changed:
+                meta['cities_version'] += 1
+                meta['city_changes'].append([meta['cities_version'], slot])
+            meta['city_changes'] = meta['city_changes'][-CITY_CHANGES_KEPT:]
+            self._recompute_routes(meta, changed)
+            self._write_meta(meta)
+            for name in old_files:
+                (self.directory / name).unlink(missing_ok=True)
+
+    def _city_files(self, meta):
+        capacity = meta['capacity']
+        return (
+            self._open(meta['ids'], np.uint8, (capacity, 16), mode='r+'),
+            self._open(meta['coords'], np.float64, (capacity, 2), mode='r+'),
+        )
+
+    def _grow(self, meta):
+        """Места под города нет - копируем id и координаты в файлы вдвое больше (без чтения БД)."""
+        old_files = [meta['ids'], meta['coords']]
+        capacity = meta['capacity']
+        new_capacity = capacity * 2
+        for kind, suffix, dtype, width in (('ids', 'u8', np.uint8, 16), ('coords', 'f64', np.float64, 2)):
+            name = self._new_name(kind, suffix)
+            old = self._open(meta[kind], dtype, (capacity, width))
+            new = self._open(name, dtype, (new_capacity, width), mode='w+')
+            new[:capacity] = old
+            new.flush()
+            meta[kind] = name
+        meta['capacity'] = new_capacity
+        return old_files
+
+    def _recompute_routes(self, meta, slots):
+        count = meta['routes_count']
+        if not count:
+            return
+        keys = self._open(meta['keys'], np.int64, (meta['routes_capacity'],))[:count]
+        touched = np.flatnonzero(np.isin(keys >> SLOT_BITS, slots) | np.isin(keys & SLOT_MASK, slots))
+        if not len(touched):
+            return
+        coords = self._open(meta['coords'], np.float64, (meta['capacity'], 2))
+        a, b = coords[keys[touched] >> SLOT_BITS], coords[keys[touched] & SLOT_MASK]
+        km = self._open(meta['km'], np.float32, (meta['routes_capacity'],), mode='r+')
+        km[touched] = haversine(a[:, 0], a[:, 1], b[:, 0], b[:, 1])
+        km.flush()
+        meta['routes_version'] += 1
+
+    def add_routes(self, pairs):
+        with self._writing() as meta:
+            if meta is None:
+                return
+            rows = self._slots_of(city_from for city_from, _ in pairs)
+            cols = self._slots_of(city_to for _, city_to in pairs)
+            known = (rows >= 0) & (cols >= 0)
+            keys = np.unique(route_keys(rows[known], cols[known]))
+            keys = keys[np.isnan(self._lookup(keys))]
+            if not len(keys):
+                return
+            coords = self._open(meta['coords'], np.float64, (meta['capacity'], 2))
+            a, b = coords[keys >> SLOT_BITS], coords[keys & SLOT_MASK]
+            km = haversine(a[:, 0], a[:, 1], b[:, 0], b[:, 1]).astype(np.float32)
+
+            size, count = meta['routes_capacity'], meta['routes_count']
+            keys_file = self._open(meta['keys'], np.int64, (size,), mode='r+')
+            km_file = self._open(meta['km'], np.float32, (size,), mode='r+')
+            if count + len(keys) <= size:
+                keys_file[count:count + len(keys)] = keys
+                km_file[count:count + len(keys)] = km
+                keys_file.flush()
+                km_file.flush()
+                meta['routes_count'] += len(keys)
+                meta['routes_version'] += 1
+                return self._write_meta(meta)
+
+            # хвост заполнился - сливаем его с отсортированной частью
+            old_files = [meta['keys'], meta['km']]
+            all_keys = np.concatenate([keys_file[:count], keys])
+            all_km = np.concatenate([km_file[:count], km])
+            order = np.argsort(all_keys, kind='stable')
+            self._write_routes(meta, all_keys[order], all_km[order])
+            self._write_meta(meta)
+            for name in old_files:
+                (self.directory / name).unlink(missing_ok=True)
+
+
+distance_matrix = DistanceMatrix()
+
+
+@tasks.handler('distances.sync_cities')
+def _sync_cities(city_ids):
+    distance_matrix.sync_cities([uuid.UUID(city_id) for city_id in city_ids])
+
+
+@tasks.handler('distances.add_routes')
+def _add_routes(pairs):
+    distance_matrix.add_routes(pairs)
+
+
+def prefetch_route_distances(orders):
+    """Расстояния маршрутов пачки заказов одним вызовом distances() - для списков."""
+    orders = list(orders)
+    km = distance_matrix.distances(
+        [order.city_from_id for order in orders], [order.city_to_id for order in orders],
+    )
+    for order, distance_km in zip(orders, km):
+        order._route_distance_km = distance_km
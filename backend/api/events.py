@@ -0,0 +1,288 @@
+import asyncio
+import json
+import threading
+import uuid
+from collections import deque
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+from api import tasks
+from api.models import CustomUser, Order
+
+
+class Broker:
+    """Канал событий об изменении статусов, реализация выбирается в EVENTS_BROKER.
+
+    publish вызывается из синхронного кода после коммита; subscribe - async-итератор
+    событий пользователя. Событие - dict(id, type, data); id - строка, которую клиент
+    присылает обратно в Last-Event-ID, чтобы получить пропущенное.
+
+    shared - брокер общий для всех процессов: только тогда публикацию можно отдать
+    очереди задач, выполняющейся в другом процессе (manage.py run_tasks)."""
+
+    shared = False
+
+    def publish(self, user_ids, event_type, data):
+        raise NotImplementedError
+
+    def subscribe(self, user_id, last_event_id=None):
+        raise NotImplementedError
+
+
+# Служебное событие: пропущенное восстановить нельзя, клиенту нужно перечитать списки
+RESET_EVENT = {'id': None, 'type': 'reset', 'data': {}}
+
+
+class _Subscription:
+    def __init__(self, loop, maxsize):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+    def push(self, event):
+        # выполняется в цикле событий подписчика
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+
+class InMemoryBroker(Broker):
+    """Брокер в памяти процесса: кольцевой буфер последних EVENTS_BUFFER_SIZE событий
+    для докачки по Last-Event-ID и очереди подписчиков.
+
+    Видит только события своего процесса - при нескольких воркерах нужен общий брокер.
+    id = '<эпоха процесса>-<номер>': после рестарта старый Last-Event-ID даёт reset,
+    а не молча пропускает события с меньшими номерами."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._epoch = uuid.uuid4().hex[:12]
+        self._seq = 0
+        self._buffer = deque(maxlen=settings.EVENTS_BUFFER_SIZE)  # (seq, user_ids, event)
+        self._subscribers = {}  # user_id -> {_Subscription}
+
+    def publish(self, user_ids, event_type, data):
+        user_ids = frozenset(user_id for user_id in user_ids if user_id is not None)
+        with self._lock:
+            self._seq += 1
+            event = {'id': f'{self._epoch}-{self._seq}', 'type': event_type, 'data': data}
+            self._buffer.append((self._seq, user_ids, event))
+            targets = [sub for user_id in user_ids for sub in self._subscribers.get(user_id, ())]
+        for sub in targets:
+            try:
+                sub.loop.call_soon_threadsafe(sub.push, event)
+            except RuntimeError:
+                pass  # цикл подписчика уже закрыт, отписка придёт из finally
+        return event
+
+    def _parse_id(self, event_id):
+        epoch, _, seq = (event_id or '').partition('-')
+        if epoch != self._epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def _since(self, user_id, seq):
+        """События пользователя после seq и признак, что буфер покрывает весь пропуск."""
+        with self._lock:
+            complete = not self._buffer or self._buffer[0][0] <= seq + 1
+            return complete, [event for event_seq, user_ids, event in self._buffer
+                              if event_seq > seq and user_id in user_ids]
+
+    async def subscribe(self, user_id, last_event_id=None):
+        sub = _Subscription(asyncio.get_running_loop(), settings.EVENTS_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(sub)
+            current = self._seq
+        try:
+            # подписываемся до чтения буфера: событие между ними придёт дважды, а не потеряется
+            last = current
+            if last_event_id:
+                last = self._parse_id(last_event_id)
+                if last is None or last > current:
+                    last = current
+                    yield RESET_EVENT
+                else:
+                    complete, missed = self._since(user_id, last)
+                    if not complete:
+                        yield RESET_EVENT
+                    for event in missed:
+                        last = self._parse_id(event['id'])
+                        yield event
+            while True:
+                event = await sub.queue.get()
+                if sub.overflowed:
+                    # подписчик не успевал читать: очередь сбрасываем и догоняем по буферу
+                    while not sub.queue.empty():
+                        sub.queue.get_nowait()
+                    sub.overflowed = False
+                    complete, missed = self._since(user_id, last)
+                    if not complete:
+                        yield RESET_EVENT
+                else:
+                    missed = [event]
+                for event in missed:
+                    seq = self._parse_id(event['id'])
+                    if seq > last:
+                        last = seq
+                        yield event
+        finally:
+            with self._lock:
+                subs = self._subscribers.get(user_id)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del self._subscribers[user_id]
+
+
+class RedisBroker(Broker):
+    """Общий брокер на Redis Streams (REDIS_URL): у каждого пользователя свой поток
+    events:<user_id>, обрезанный примерно до EVENTS_BUFFER_SIZE записей.
+
+    Событие видят подписчики всех процессов, поэтому публиковать его может воркер
+    очереди задач. id события - id записи в потоке: Last-Event-ID переживает
+    переподключение к другому процессу и рестарты."""
+
+    shared = True
+    # сколько ждать новых записей за один XREAD; пинги шлёт сама вью
+    BLOCK_MS = 60000
+
+    def __init__(self, url=None):
+        import redis
+
+        self._url = url or settings.REDIS_URL
+        self._redis = redis.Redis.from_url(self._url)
+
+    @staticmethod
+    def _key(user_id):
+        return f'events:{user_id}'
+
+    @staticmethod
+    def _parse_id(event_id):
+        ms, _, seq = (event_id or '').partition('-')
+        if not (ms.isdigit() and seq.isdigit()):
+            return None
+        return int(ms), int(seq)
+
+    def publish(self, user_ids, event_type, data):
+        fields = {'type': event_type, 'data': json.dumps(data)}
+        with self._redis.pipeline(transaction=False) as pipe:
+            for user_id in {user_id for user_id in user_ids if user_id is not None}:
+                pipe.xadd(self._key(user_id), fields, maxlen=settings.EVENTS_BUFFER_SIZE, approximate=True)
+            pipe.execute()
+
+    async def subscribe(self, user_id, last_event_id=None):
+        from redis import asyncio as aioredis
+
+        client = aioredis.Redis.from_url(self._url)
+        key = self._key(user_id)
+        try:
+            last = '$'
+            if last_event_id:
+                parsed = self._parse_id(last_event_id)
+                first = await client.xrange(key, count=1)
+                oldest = self._parse_id(first[0][0].decode()) if first else None
+                if parsed is None or oldest is None or oldest > parsed:
+                    # чужой id или пропуск уже обрезан из потока
+                    yield RESET_EVENT
+                if parsed is not None:
+                    last = last_event_id
+            if last == '$':
+                # с конкретного id, а не '$': иначе запись между двумя XREAD потеряется
+                latest = await client.xrevrange(key, count=1)
+                last = latest[0][0].decode() if latest else '0-0'
+            while True:
+                response = await client.xread({key: last}, block=self.BLOCK_MS, count=100)
+                for _, entries in response:
+                    for entry_id, fields in entries:
+                        last = entry_id.decode()
+                        yield {'id': last, 'type': fields[b'type'].decode(), 'data': json.loads(fields[b'data'])}
+        finally:
+            await client.aclose()
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            _broker = import_string(settings.EVENTS_BROKER)()
+        return _broker
+
+
+# Публикация - только после коммита перехода, откаченный переход статуса клиент не увидит.
+# С общим брокером (shared, RedisBroker при заданном REDIS_URL) публикация идёт через очередь
+# задач (api/tasks.py): задача пишется в транзакции перехода, и запрос не ждёт брокер.
+# Брокер в памяти процесса видят только подписчики этого процесса (локальная разработка),
+# поэтому ему публикуем здесь же, в on_commit
+
+def _send(name, **payload):
+    if get_broker().shared:
+        tasks.enqueue(tasks.call(name, **payload))
+    else:
+        handler = tasks.get_handler(name)
+        transaction.on_commit(lambda: handler(**payload))
+
+
+def order_changed(orders, shipments=()):
+    """Статусы заказов (и созданных для них перевозок) - клиенту и диспетчеру заказа."""
+    events = []
+    for order in orders:
+        events.append(([order.client_id, order.dispatcher_id], 'order',
+                       {'order': str(order.pk), 'status': order.status}))
+    for shipment in shipments:
+        order = shipment.order
+        events.append(([order.client_id, order.dispatcher_id], 'shipment',
+                       {'shipment': str(shipment.pk), 'order': str(order.pk), 'status': shipment.status}))
+    _send('events.publish', events=events)
+
+
+def consolidated_changed(orders, shipment):
+    """Сборный рейс: каждому заказу - его новый статус и общая перевозка."""
+    events = []
+    for order in orders:
+        recipients = [order.client_id, order.dispatcher_id]
+        events.append((recipients, 'order', {'order': str(order.pk), 'status': order.status}))
+        events.append((recipients, 'shipment',
+                       {'shipment': str(shipment.pk), 'order': str(order.pk), 'status': shipment.status}))
+    _send('events.publish', events=events)
+
+
+def shipment_changed(shipment_id, status):
+    _send('events.shipment', shipment_id=shipment_id, status=status)
+
+
+def shipments_changed(rows, status):
+    """Пакетный переход: rows - [(shipment_id, order_id, client_id, dispatcher_id)]."""
+    events = [
+        ([client_id, dispatcher_id], 'shipment',
+         {'shipment': str(shipment_id), 'order': str(order_id), 'status': status})
+        for shipment_id, order_id, client_id, dispatcher_id in rows
+    ]
+    _send('events.publish', events=events)
+
+
+@tasks.handler('events.publish')
+def _publish_all(events):
+    broker = get_broker()
+    to_user_id = CustomUser._meta.pk.to_python  # в payload задачи (JSON) id пользователей - строки
+    for user_ids, event_type, data in events:
+        broker.publish([to_user_id(user_id) for user_id in user_ids if user_id], event_type, data)
+
+
+@tasks.handler('events.shipment')
+def _publish_shipment(shipment_id, status):
+    # основной заказ рейса и, если рейс сборный, остальные его заказы
+    recipients = Order.objects.filter(
+        Q(shipment=shipment_id) | Q(consolidated_shipment=shipment_id),
+    ).values_list('order_id', 'client_id', 'dispatcher_id')
+    broker = get_broker()
+    for order_id, client_id, dispatcher_id in recipients:
+        broker.publish([client_id, dispatcher_id], 'shipment',
+                       {'shipment': str(shipment_id), 'order': str(order_id), 'status': status})
@@ -0,0 +1,170 @@
+import csv
+import io
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import extend_schema
+from rest_framework.decorators import action
+
+from api.serializers import ExportParamsSerializer
+
+
+# (колонка в файле, lookup для values_list): связанные таблицы подтягиваются JOIN-ами в том же запросе
+ORDER_EXPORT_COLUMNS = (
+    ('order_id', 'order_id'),
+    ('status', 'status'),
+    ('created_at', 'created_at'),
+    ('weight', 'weight'),
+    ('volume', 'volume'),
+    ('city_from', 'city_from__city_name'),
+    ('city_to', 'city_to__city_name'),
+    ('client_email', 'client__email'),
+    ('dispatcher_email', 'dispatcher__email'),
+    ('shipment_id', 'shipment__shipment_id'),
+    ('shipment_status', 'shipment__status'),
+    ('price', 'shipment__price'),
+    ('driver_first_name', 'shipment__driver__first_name'),
+    ('driver_last_name', 'shipment__driver__last_name'),
+    ('vehicle', 'shipment__vehicle__license_plate'),
+    ('transport_type', 'shipment__vehicle__transport_type'),
+)
+
+SHIPMENT_EXPORT_COLUMNS = (
+    ('shipment_id', 'shipment_id'),
+    ('status', 'status'),
+    ('created_at', 'created_at'),
+    ('departure_time', 'departure_time'),
+    ('arrival_time', 'arrival_time'),
+    ('price', 'price'),
+    ('order_id', 'order__order_id'),
+    ('weight', 'order__weight'),
+    ('volume', 'order__volume'),
+    ('city_from', 'order__city_from__city_name'),
+    ('city_to', 'order__city_to__city_name'),
+    ('client_email', 'order__client__email'),
+    ('driver_id', 'driver__driver_id'),
+    ('driver_first_name', 'driver__first_name'),
+    ('driver_last_name', 'driver__last_name'),
+    ('vehicle', 'vehicle__license_plate'),
+    ('transport_type', 'vehicle__transport_type'),
+    ('review_rating', 'review_rating'),
+)
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+# Начало ячейки, которое Excel/LibreOffice считают формулой
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return "'" + value if value.startswith(FORMULA_PREFIXES) else value
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+class _Encoder:
+    def __init__(self, output, names):
+        self.output = output
+        self.names = names
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+
+    def header(self):
+        if self.output == 'csv':
+            self.writer.writerow(self.names)
+            return self._flush()
+        return ''
+
+    def rows(self, rows):
+        if self.output == 'csv':
+            self.writer.writerows([_csv_value(value) for value in row] for row in rows)
+            return self._flush()
+        return ''.join(
+            json.dumps(dict(zip(self.names, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+            for row in rows
+        )
+
+    def _flush(self):
+        data = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+
+def _stream(queryset, encoder, chunk_size):
+    yield encoder.header()
+    batch = []
+    # iterator() на Postgres читает через server-side cursor: в памяти не больше chunk_size строк
+    for row in queryset.iterator(chunk_size=chunk_size):
+        batch.append(row)
+        if len(batch) >= chunk_size:
+            yield encoder.rows(batch)
+            batch = []
+    if batch:
+        yield encoder.rows(batch)
+
+
+async def _astream(queryset, encoder, chunk_size):
+    yield encoder.header()
+    batch = []
+    async for row in queryset.aiterator(chunk_size=chunk_size):
+        batch.append(row)
+        if len(batch) >= chunk_size:
+            yield encoder.rows(batch)
+            batch = []
+    if batch:
+        yield encoder.rows(batch)
+
+
+def export_response(request, queryset, columns, output, name):
+    """StreamingHttpResponse с выгрузкой queryset в CSV или NDJSON.
+
+    Под ASGI отдаём async-генератор (иначе Django соберёт синхронный поток в список целиком),
+    под WSGI - обычный."""
+    names = [column for column, _ in columns]
+    queryset = queryset.values_list(*(lookup for _, lookup in columns)).order_by('created_at', 'pk')
+    encoder = _Encoder(output, names)
+    chunk_size = settings.EXPORT_CHUNK_SIZE
+    if hasattr(request, 'scope'):
+        content = _astream(queryset, encoder, chunk_size)
+    else:
+        content = _stream(queryset, encoder, chunk_size)
+
+    response = StreamingHttpResponse(content, content_type=EXPORT_FORMATS[output])
+    filename = f'{name}-{timezone.now():%Y%m%d-%H%M%S}.{output}'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+class ExportMixin:
+    """GET .../export/?output=csv|ndjson&created_after=&created_before= для вьюсета.
+
+    Берёт get_queryset() вьюсета (с его ограничениями доступа) и колонки export_columns."""
+
+    export_columns = ()
+    export_name = 'export'
+
+    @extend_schema(parameters=[ExportParamsSerializer], responses={200: OpenApiTypes.BINARY})
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        params = ExportParamsSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        queryset = self.get_queryset()
+        if 'created_after' in params.validated_data:
+            queryset = queryset.filter(created_at__gte=params.validated_data['created_after'])
+        if 'created_before' in params.validated_data:
+            queryset = queryset.filter(created_at__lt=params.validated_data['created_before'])
+        return export_response(
+            request, queryset, self.export_columns, params.validated_data['output'], self.export_name,
+        )
@@ -0,0 +1,55 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password, verify_password
+
+
+class HashingPoolBusy(Exception):
+    pass
+
+
+class HashingPool:
+    """Ограниченный пул потоков для PBKDF2 (hashlib отпускает GIL на время расчёта).
+
+    Одновременно хэшируют не больше PASSWORD_HASH_WORKERS потоков, всего в работе
+    и очереди - не больше PASSWORD_HASH_QUEUE задач. Сверх этого пул сразу отказывает
+    (HashingPoolBusy -> 503), а не копит запросы: шторм логинов не съедает CPU
+    остальных эндпоинтов и не растит очередь без предела."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = None
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=settings.PASSWORD_HASH_WORKERS, thread_name_prefix='password-hash',
+                )
+                self._slots = threading.BoundedSemaphore(settings.PASSWORD_HASH_QUEUE)
+
+    async def run(self, fn, *args):
+        self._ensure_started()
+        if not self._slots.acquire(blocking=False):
+            raise HashingPoolBusy
+        try:
+            return await asyncio.wrap_future(self._executor.submit(fn, *args))
+        finally:
+            self._slots.release()
+
+    async def hash(self, password):
+        return await self.run(make_password, password)
+
+    async def verify(self, password, encoded):
+        """(пароль верен, нужно перехэшировать). Для несуществующего пользователя
+        всё равно считаем хэш, чтобы время ответа не выдавало, есть ли такой email."""
+        if encoded is None:
+            await self.hash(password)
+            return False, False
+        return await self.run(verify_password, password, encoded)
+
+
+hashing_pool = HashingPool()
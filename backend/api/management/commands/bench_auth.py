@@ -0,0 +1,97 @@
+import threading
+import time
+
+from django.contrib.auth import authenticate
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+
+from api.authentication import issue_token
+from api.models import CustomUser
+
+
+READER_EMAIL = 'bench-reader@bench.local'
+STORM_EMAIL = 'bench-storm@bench.local'
+PASSWORD = 'bench-password'
+
+
+class Command(BaseCommand):
+    help = 'Пропускная способность обычного эндпоинта во время шторма логинов (нужна БД, создаёт и удаляет двух пользователей)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=float, default=5)
+        parser.add_argument('--readers', type=int, default=4)
+        parser.add_argument('--storm', type=int, default=32, help='потоков, которые непрерывно логинятся')
+        parser.add_argument('--url', default='/api/drivers/?page_size=1')
+
+    def handle(self, *args, **options):
+        CustomUser.objects.filter(email__in=(READER_EMAIL, STORM_EMAIL)).delete()
+        reader = CustomUser.objects.create_user(
+            email=READER_EMAIL, username='bench-reader', password=PASSWORD, role=CustomUser.RoleChoices.DISPATCHER,
+        )
+        CustomUser.objects.create_user(
+            email=STORM_EMAIL, username='bench-storm', password=PASSWORD, role=CustomUser.RoleChoices.CLIENT,
+        )
+        self.token = issue_token(reader).key
+        self.options = options
+        try:
+            with override_settings(ALLOWED_HOSTS=['*'], AUTH_THROTTLE_EMAIL_PER_MINUTE=0, AUTH_THROTTLE_IP_PER_MINUTE=0):
+                baseline = self.run_phase('no logins', None)
+                for name, storm in (('login storm, hashing pool', self.login_via_view),
+                                    ('login storm, inline hashing', self.login_inline)):
+                    reads = self.run_phase(name, storm)
+                    if baseline:
+                        self.stdout.write(f'  reads vs baseline: {reads / baseline:.0%}')
+        finally:
+            CustomUser.objects.filter(email__in=(READER_EMAIL, STORM_EMAIL)).delete()
+
+    def login_via_view(self, client):
+        response = client.post('/api/login/', {'email': STORM_EMAIL, 'password': PASSWORD}, content_type='application/json')
+        return response.status_code
+
+    def login_inline(self, client):
+        # так работал синхронный LoginView: PBKDF2 прямо на воркере запроса
+        return 200 if authenticate(email=STORM_EMAIL, password=PASSWORD) else 400
+
+    def run_phase(self, name, storm):
+        stop = threading.Event()
+        reads, logins, rejected = [], [], []
+
+        def reader():
+            client = Client(HTTP_AUTHORIZATION=f'Token {self.token}')
+            count = 0
+            while not stop.is_set():
+                client.get(self.options['url'])
+                count += 1
+            reads.append(count)
+            connection.close()
+
+        def stormer():
+            client = Client()
+            ok = busy = 0
+            while not stop.is_set():
+                code = storm(client)
+                ok += code == 200
+                busy += code == 503
+            logins.append(ok)
+            rejected.append(busy)
+            connection.close()
+
+        threads = [threading.Thread(target=reader) for _ in range(self.options['readers'])]
+        if storm is not None:
+            threads += [threading.Thread(target=stormer) for _ in range(self.options['storm'])]
+        for thread in threads:
+            thread.start()
+        time.sleep(self.options['seconds'])
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        seconds = self.options['seconds']
+        rate = sum(reads) / seconds
+        line = f'{name}: {rate:.0f} reads/s'
+        if storm is not None:
+            line += f', {sum(logins) / seconds:.1f} logins/s, {sum(rejected)} rejected (503)'
+        self.stdout.write(self.style.SUCCESS(line))
+        return rate
@@ -0,0 +1,63 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from api import consolidation, planner
+from api.matching import LICENCE_CATEGORIES
+
+
+class Command(BaseCommand):
+    help = 'Бенчмарк сборных рейсов против "один заказ - одна машина" на синтетических данных (без БД)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=50000)
+        parser.add_argument('--routes', type=int, default=1000)
+        parser.add_argument('--vehicles', type=int, default=5000)
+        parser.add_argument('--drivers', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--skip-baseline', action='store_true', help='Не запускать planner.solve')
+
+    def report(self, title, order_weights, order_volumes, vehicle_weights, vehicle_volumes, order_vehicle, elapsed):
+        assigned = order_vehicle >= 0
+        used = np.unique(order_vehicle[assigned])
+        m = len(vehicle_weights)
+        load_weights = np.bincount(order_vehicle[assigned], weights=order_weights[assigned], minlength=m)[used]
+        load_volumes = np.bincount(order_vehicle[assigned], weights=order_volumes[assigned], minlength=m)[used]
+        fill = consolidation.utilization(load_weights, load_volumes, vehicle_weights[used], vehicle_volumes[used])
+        self.stdout.write(title)
+        self.stdout.write(f'  shipped: {assigned.sum()} ({assigned.mean():.1%}), vehicles used: {len(used)}')
+        self.stdout.write(f'  orders per vehicle: {assigned.sum() / max(len(used), 1):.1f}')
+        self.stdout.write(f'  mean utilization: {fill.mean() if len(fill) else 0:.1%}')
+        self.stdout.write(self.style.SUCCESS(f'  solve: {elapsed:.2f} s'))
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        n, r, m, d = options['orders'], options['routes'], options['vehicles'], options['drivers']
+
+        # сборные грузы: мелкие заказы, неравномерно распределённые по маршрутам
+        order_weights = rng.uniform(50, 3000, n)
+        order_volumes = rng.uniform(0.2, 12, n)
+        order_routes = np.minimum(rng.zipf(1.3, n) - 1, r - 1) if r > 1 else np.zeros(n, dtype=np.int64)
+        vehicle_weights = rng.integers(1000, 40000, m).astype(np.float64)
+        vehicle_volumes = rng.integers(10, 120, m).astype(np.float64)
+        vehicle_types = rng.integers(0, len(LICENCE_CATEGORIES), m)
+        driver_categories = rng.random((d, len(LICENCE_CATEGORIES))) < 0.4
+        self.stdout.write(f'orders={n} routes={len(np.unique(order_routes))} vehicles={m} drivers={d}')
+
+        if not options['skip_baseline']:
+            started = time.perf_counter()
+            order_vehicle, _ = planner.solve(
+                order_weights, order_volumes, vehicle_weights, vehicle_volumes, vehicle_types, driver_categories,
+            )
+            elapsed = time.perf_counter() - started
+            self.report('one order per vehicle (planner.solve)', order_weights, order_volumes,
+                        vehicle_weights, vehicle_volumes, order_vehicle, elapsed)
+
+        started = time.perf_counter()
+        order_vehicle, _ = consolidation.solve(
+            order_weights, order_volumes, order_routes, vehicle_weights, vehicle_volumes, vehicle_types, driver_categories,
+        )
+        elapsed = time.perf_counter() - started
+        self.report('consolidated (consolidation.solve)', order_weights, order_volumes,
+                    vehicle_weights, vehicle_volumes, order_vehicle, elapsed)
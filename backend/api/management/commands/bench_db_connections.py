@@ -0,0 +1,85 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+from django.test import Client
+from django.test.utils import override_settings
+
+from api.authentication import issue_token
+from api.models import CustomUser
+
+
+BENCH_EMAIL = 'bench-db@bench.local'
+
+# Каждый режим запускается отдельным процессом: настройки БД читаются из окружения при старте
+MODES = (
+    ('new connection per request', {'DB_POOL_MAX_SIZE': '0', 'DB_CONN_MAX_AGE': '0'}),
+    ('persistent (CONN_MAX_AGE)', {'DB_POOL_MAX_SIZE': '0', 'DB_CONN_MAX_AGE': '600'}),
+    ('psycopg pool', {'DB_POOL_MAX_SIZE': '4', 'DB_POOL_MIN_SIZE': '1', 'DB_CONN_MAX_AGE': '0'}),
+)
+
+
+class Command(BaseCommand):
+    help = 'Латентность запроса с новым соединением к БД, с постоянным соединением и с пулом'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--url', default='/api/drivers/?page_size=1')
+        parser.add_argument('--child', metavar='TOKEN', help='внутренний режим: замер в текущих настройках')
+
+    def handle(self, *args, **options):
+        if options['child']:
+            return self.measure(options['child'], options['requests'], options['url'])
+
+        CustomUser.objects.filter(email=BENCH_EMAIL).delete()
+        user = CustomUser.objects.create_user(
+            email=BENCH_EMAIL, username='bench-db', password='bench-password',
+            role=CustomUser.RoleChoices.DISPATCHER,
+        )
+        token = issue_token(user).key
+        connection.close()
+        try:
+            baseline = None
+            for name, env in MODES:
+                result = subprocess.run(
+                    [sys.executable, sys.argv[0], 'bench_db_connections', '--child', token,
+                     '--requests', str(options['requests']), '--url', options['url']],
+                    env={**os.environ, **env}, capture_output=True, text=True,
+                )
+                if result.returncode != 0:
+                    self.stderr.write(f'{name}: failed\n{result.stderr.strip().splitlines()[-1]}')
+                    continue
+                latencies = json.loads(result.stdout.strip().splitlines()[-1])
+                p50 = statistics.median(latencies)
+                p95 = statistics.quantiles(latencies, n=20)[-1]
+                line = f'{name}: p50 {p50:.2f} ms, p95 {p95:.2f} ms'
+                if baseline is None:
+                    baseline = p50
+                else:
+                    line += f' ({baseline - p50:+.2f} ms vs new connection)'
+                self.stdout.write(self.style.SUCCESS(line))
+        finally:
+            CustomUser.objects.filter(email=BENCH_EMAIL).delete()
+
+    def measure(self, token, requests, url):
+        client = Client(HTTP_AUTHORIZATION=f'Token {token}')
+        latencies = []
+        with override_settings(ALLOWED_HOSTS=['*']):
+            for i in range(requests + 10):
+                started = time.perf_counter()
+                # как WSGI/ASGI-сервер: request_started/request_finished закрывают устаревшие соединения
+                # (тестовый клиент этого не делает)
+                close_old_connections()
+                response = client.get(url)
+                close_old_connections()
+                elapsed = (time.perf_counter() - started) * 1000
+                if response.status_code != 200:
+                    raise RuntimeError(f'{url}: HTTP {response.status_code}')
+                if i >= 10:  # прогрев: импорты, кэш токена, первое соединение пула
+                    latencies.append(elapsed)
+        self.stdout.write(json.dumps(latencies))
@@ -0,0 +1,45 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from api.matching import LICENCE_CATEGORIES
+from api.planner import solve
+
+
+class Command(BaseCommand):
+    help = 'Бенчмарк планировщика назначений на синтетических данных (без БД)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=5000)
+        parser.add_argument('--vehicles', type=int, default=5000)
+        parser.add_argument('--drivers', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        n, m, d = options['orders'], options['vehicles'], options['drivers']
+
+        order_weights = rng.uniform(100, 20000, n)
+        order_volumes = rng.uniform(1, 80, n)
+        vehicle_weights = rng.integers(1000, 40000, m).astype(np.float64)
+        vehicle_volumes = rng.integers(10, 120, m).astype(np.float64)
+        vehicle_types = rng.integers(0, len(LICENCE_CATEGORIES), m)
+        driver_categories = rng.random((d, len(LICENCE_CATEGORIES))) < 0.4
+
+        started = time.perf_counter()
+        order_vehicle, order_driver = solve(
+            order_weights, order_volumes, vehicle_weights, vehicle_volumes, vehicle_types, driver_categories,
+        )
+        elapsed = time.perf_counter() - started
+
+        assigned = order_vehicle >= 0
+        chosen = order_vehicle[assigned]
+        waste = (
+            (vehicle_weights[chosen] - order_weights[assigned]) / vehicle_weights[chosen]
+            + (vehicle_volumes[chosen] - order_volumes[assigned]) / vehicle_volumes[chosen]
+        )
+        self.stdout.write(f'orders={n} vehicles={m} drivers={d}')
+        self.stdout.write(f'assigned: {assigned.sum()} ({assigned.mean():.1%})')
+        self.stdout.write(f'mean waste per assigned order: {waste.mean() if len(waste) else 0:.3f}')
+        self.stdout.write(self.style.SUCCESS(f'solve: {elapsed:.2f} s'))
@@ -0,0 +1,37 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from api.routing import solve
+
+
+class Command(BaseCommand):
+    help = 'Бенчмарк оптимизатора маршрута с несколькими остановками на синтетических данных (без БД)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stops', type=int, default=200, help='Точек погрузки и выгрузки (чётное число)')
+        parser.add_argument('--runs', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        pairs_count = options['stops'] // 2
+        timings, gains = [], []
+        for _ in range(options['runs']):
+            # точки в пределах европейской части России; точка 0 - гараж
+            n = 2 * pairs_count + 1
+            latitudes = rng.uniform(45, 60, n)
+            longitudes = rng.uniform(30, 50, n)
+            pairs = [(1 + 2 * k, 2 + 2 * k) for k in range(pairs_count)]
+            started = time.perf_counter()
+            tour, length, initial = solve(latitudes, longitudes, pairs, start=0)
+            timings.append(time.perf_counter() - started)
+            gains.append(1 - length / initial if initial else 0)
+
+        timings = np.array(timings) * 1000
+        self.stdout.write(f'stops={2 * pairs_count} runs={options["runs"]}')
+        self.stdout.write(f'shorter than nearest neighbour: {np.mean(gains):.1%}')
+        self.stdout.write(self.style.SUCCESS(
+            f'solve: median {np.median(timings):.1f} ms, p95 {np.percentile(timings, 95):.1f} ms, max {timings.max():.1f} ms'
+        ))
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.distances import distance_matrix
+
+
+class Command(BaseCommand):
+    help = 'Полная сборка матрицы расстояний по маршрутам заказов (DISTANCE_MATRIX_DIR)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--missing-only', action='store_true',
+            help='собрать, только если файла ещё нет (при старте контейнера)',
+        )
+
+    def handle(self, *args, **options):
+        if options['missing_only'] and distance_matrix._read_meta() is not None:
+            self.stdout.write('Distance matrix already built')
+            return
+        started = time.perf_counter()
+        distance_matrix.rebuild()
+        meta = distance_matrix._read_meta()
+        self.stdout.write(self.style.SUCCESS(
+            f'{meta["count"] - len(meta["free"])} cities, capacity {meta["capacity"]}, '
+            f'{meta["routes_count"]} routes: {time.perf_counter() - started:.2f} s'
+        ))
@@ -0,0 +1,36 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.bulk_import import IMPORTERS, ImportFileError, read_rows
+
+
+class Command(BaseCommand):
+    help = 'Массовый импорт водителей, машин или городов из CSV / JSON / NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', choices=sorted(IMPORTERS))
+        parser.add_argument('path')
+        parser.add_argument('--skip-errors', action='store_true', help='сохранить валидные строки, ошибочные пропустить')
+        parser.add_argument('--chunk-size', type=int, default=None)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        with open(options['path'], 'rb') as file:
+            try:
+                rows = read_rows(file, options['path'])
+                created, errors = IMPORTERS[options['target']].run(
+                    rows, skip_errors=options['skip_errors'], chunk_size=options['chunk_size'],
+                )
+            except ImportFileError as exc:
+                raise CommandError(str(exc))
+
+        for error in errors:
+            self.stderr.write(f'row {error["row"]}: {json.dumps(error["errors"], ensure_ascii=False)}')
+        elapsed = time.perf_counter() - started
+        if errors and not options['skip_errors']:
+            raise CommandError(f'{len(errors)} invalid rows, nothing imported ({elapsed:.2f} s)')
+        self.stdout.write(self.style.SUCCESS(
+            f'{options["target"]}: {created} created, {len(errors)} skipped, {elapsed:.2f} s'
+        ))
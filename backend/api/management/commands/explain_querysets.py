@@ -0,0 +1,73 @@
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api.models import CustomUser, Driver, Order, Shipment, Vehicle
+from api.views import (
+    CityViewSet,
+    ClientOrderViewSet,
+    ClientShipmentViewSet,
+    DispatcherOrderViewSet,
+    DispatcherShipmentViewSet,
+    DriverViewSet,
+    VehicleViewSet,
+)
+
+
+VIEWSETS = [
+    ('client/orders', ClientOrderViewSet, CustomUser.RoleChoices.CLIENT),
+    ('client/shipments', ClientShipmentViewSet, CustomUser.RoleChoices.CLIENT),
+    ('dispatcher/orders', DispatcherOrderViewSet, CustomUser.RoleChoices.DISPATCHER),
+    ('dispatcher/shipments', DispatcherShipmentViewSet, CustomUser.RoleChoices.DISPATCHER),
+    ('drivers', DriverViewSet, CustomUser.RoleChoices.DISPATCHER),
+    ('vehicles', VehicleViewSet, CustomUser.RoleChoices.DISPATCHER),
+    ('cities', CityViewSet, CustomUser.RoleChoices.CLIENT),
+]
+
+
+class Command(BaseCommand):
+    help = 'Печатает EXPLAIN для querysets вьюсетов и горячих фильтров, чтобы проверить использование индексов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--analyze', action='store_true', help='EXPLAIN ANALYZE (только PostgreSQL)')
+
+    def handle(self, *args, **options):
+        explain_options = {'analyze': True, 'buffers': True} if options['analyze'] else {}
+        for title, queryset in self.querysets():
+            self.stdout.write(self.style.MIGRATE_HEADING(title))
+            self.stdout.write(str(queryset.query))
+            self.stdout.write(queryset.explain(**explain_options))
+            self.stdout.write('')
+
+    def get_user(self, role):
+        # Для плана важна только форма запроса, поэтому подойдёт и несохранённый пользователь
+        return CustomUser.objects.filter(role=role).first() or CustomUser(role=role)
+
+    def querysets(self):
+        page_size = settings.REST_FRAMEWORK['PAGE_SIZE']
+        for url, viewset_class, role in VIEWSETS:
+            view = viewset_class(action='list', kwargs={}, format_kwarg=None)
+            view.request = SimpleNamespace(user=self.get_user(role), query_params={})
+            queryset = view.get_queryset()
+            paginator = view.paginator
+            if paginator is not None:
+                ordering = paginator.get_ordering(view.request, queryset, view)
+                queryset = queryset.order_by(*ordering)
+            yield f'GET /api/{url}/', queryset[:page_size]
+
+        now = timezone.now()
+        yield 'Pending orders', Order.objects.filter(
+            status=Order.StatusChoices.PENDING
+        ).order_by('-created_at')[:page_size]
+        yield 'Orders by status', Order.objects.filter(
+            status=Order.StatusChoices.CONFIRMED
+        ).order_by('-created_at')[:page_size]
+        yield 'Available drivers', Driver.objects.filter(is_available=True)[:page_size]
+        yield 'Available vehicles by capacity', Vehicle.objects.filter(
+            is_available=True, max_weight__gte=1000, max_volume__gte=10,
+        ).order_by('max_weight')[:page_size]
+        yield 'Overdue shipments', Shipment.objects.filter(
+            status=Shipment.StatusChoices.IN_PROGRESS, arrival_time__lt=now,
+        )
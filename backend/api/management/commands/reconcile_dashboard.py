@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from api.dashboard import reconcile
+
+
+class Command(BaseCommand):
+    help = 'Пересчёт счётчиков дашборда диспетчера по заказам и перевозкам (исправляет расхождения)'
+
+    def handle(self, *args, **options):
+        drift = reconcile()
+        for key, (before, after) in sorted(drift.items()):
+            self.stdout.write(f'{key}: {before} -> {after}')
+        self.stdout.write(self.style.SUCCESS(f'dashboard reconciled, {len(drift)} counters corrected'))
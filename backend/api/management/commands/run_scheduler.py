@@ -0,0 +1,28 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from api.scheduler import Scheduler, default_jobs
+
+
+class Command(BaseCommand):
+    help = 'Фоновый планировщик: просроченные перевозки -> Delayed, пересчёт is_available по интервалам'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='один прогон всех задач и выход (для cron)')
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        scheduler = Scheduler(default_jobs(), on_result=self.report)
+        if options['once']:
+            scheduler.run_pending()
+            return
+        signal.signal(signal.SIGTERM, scheduler.stop)
+        signal.signal(signal.SIGINT, scheduler.stop)
+        scheduler.run_forever()
+
+    def report(self, name, rows, elapsed):
+        self.stdout.write(f'{name}: {len(rows)} changed, {elapsed * 1000:.1f} ms')
+        if self.verbosity > 1:
+            for row in rows:
+                self.stdout.write(f'  {row[0] if isinstance(row, tuple) else row}')
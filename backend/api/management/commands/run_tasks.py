@@ -0,0 +1,28 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from api import tasks
+
+
+class Command(BaseCommand):
+    help = 'Воркеры очереди задач (api/tasks.py) отдельным процессом'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help='число потоков (по умолчанию TASKS_WORKERS)')
+        parser.add_argument('--once', action='store_true', help='выполнить всё готовое и выйти')
+        parser.add_argument('--requeue-dead', action='store_true', help='вернуть задачи из DeadTask в очередь и выйти')
+
+    def handle(self, *args, **options):
+        if options['requeue_dead']:
+            self.stdout.write(f'Requeued: {tasks.requeue_dead()}')
+            return
+        if options['once']:
+            done, failed = tasks.run_pending()
+            self.stdout.write(f'Done: {done}, failed: {failed}')
+            return
+        pool = tasks.task_pool
+        signal.signal(signal.SIGTERM, pool.stop)
+        signal.signal(signal.SIGINT, pool.stop)
+        pool.start(options['workers'])
+        pool.join()
@@ -0,0 +1,314 @@
+import threading
+import time
+from bisect import bisect_left, insort
+
+from django.conf import settings
+
+from api.models import Driver, Vehicle
+
+
+LICENCE_CATEGORIES = ('B', 'BE', 'C', 'C1', 'CE', 'C1E')
+
+# Какие категории прав позволяют управлять транспортом данного типа
+ACCEPTED_LICENCES = {
+    'B': ('B',),
+    'BE': ('BE',),
+    'C': ('C',),
+    'C1': ('C1', 'C'),
+    'CE': ('CE',),
+    'C1E': ('C1E', 'CE'),
+}
+
+# Штраф за "лишние" категории водителя: универсальных водителей бережём
+DRIVER_PENALTY = 0.01
+
+
+def driver_categories(driver):
+    return frozenset(cat for cat in LICENCE_CATEGORIES if getattr(driver, cat))
+
+
+def vehicle_waste(max_weight, max_volume, weight, volume):
+    # Недогруз по весу и объёму в долях вместимости: 0 - машина заполнена полностью
+    return (max_weight - weight) / max_weight + (max_volume - volume) / max_volume
+
+
+class FleetIndex:
+    """In-memory индекс парка: машины по типу, отсортированные по грузоподъёмности,
+    и водители по категориям прав. Обновляется инкрементально (сигналы, booking),
+    а целиком перечитывается из БД не чаще раза в FLEET_INDEX_REFRESH_SECONDS -
+    так подтягиваются изменения, сделанные другими процессами.
+
+    Перечитывание собирает новый снимок без блокировки индекса и подменяет его целиком;
+    изменения, пришедшие во время чтения, записываются в журнал и повторяются поверх
+    снимка. Пока один поток перечитывает, остальные отвечают по старому снимку."""
+
+    def __init__(self, refresh_interval=None):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.RLock()
+        self._load_lock = threading.Lock()  # перечитывает один поток
+        self._loaded_at = None
+        self._journal = None  # [(метод, аргументы)] - изменения во время перечитывания
+        self._clear()
+
+    def _clear(self):
+        self._vehicles = {}  # plate -> (transport_type, max_weight, max_volume)
+        self._by_type = {}  # transport_type -> sorted [(max_weight, max_volume, plate)]
+        self._drivers = {}  # driver_id -> frozenset категорий
+        self._by_category = {cat: [] for cat in LICENCE_CATEGORIES}  # sorted [(n_categories, driver_id)]
+        self.available_vehicles = set()
+        self.available_drivers = set()
+
+    def _refresh_interval(self):
+        if self.refresh_interval is not None:
+            return self.refresh_interval
+        return getattr(settings, 'FLEET_INDEX_REFRESH_SECONDS', 30)
+
+    def _stale(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self._refresh_interval()
+
+    def ensure_loaded(self):
+        if not self._stale():
+            return
+        if self._loaded_at is None:
+            # без первого снимка отвечать нечем - ждём
+            with self._load_lock:
+                if self._stale():
+                    self._load()
+        elif self._load_lock.acquire(blocking=False):
+            try:
+                if self._stale():
+                    self._load()
+            finally:
+                self._load_lock.release()
+
+    def load(self):
+        with self._load_lock:
+            self._load()
+
+    def _load(self):
+        with self._lock:
+            self._journal = []
+        try:
+            snapshot = self._read()
+        except BaseException:
+            with self._lock:
+                self._journal = None
+            raise
+        with self._lock:
+            journal, self._journal = self._journal, None
+            # у снимка только поля данных (_clear) - подменяем их целиком
+            self.__dict__.update(snapshot.__dict__)
+            self._loaded_at = time.monotonic()
+            for method, args in journal:
+                method(*args)
+
+    def _read(self):
+        """Новый снимок из БД (без блокировки индекса)."""
+        snapshot = FleetIndex.__new__(FleetIndex)
+        snapshot._clear()
+        vehicles = Vehicle.objects.values_list(
+            'license_plate', 'transport_type', 'max_weight', 'max_volume', 'is_available',
+        )
+        drivers = Driver.objects.values_list('driver_id', 'is_available', *LICENCE_CATEGORIES)
+        for plate, transport_type, max_weight, max_volume, is_available in vehicles.iterator(chunk_size=5000):
+            snapshot._vehicles[plate] = (transport_type, max_weight, max_volume)
+            snapshot._by_type.setdefault(transport_type, []).append((max_weight, max_volume, plate))
+            if is_available:
+                snapshot.available_vehicles.add(plate)
+        for driver_id, is_available, *flags in drivers.iterator(chunk_size=5000):
+            categories = frozenset(cat for cat, flag in zip(LICENCE_CATEGORIES, flags) if flag)
+            snapshot._drivers[driver_id] = categories
+            for cat in categories:
+                snapshot._by_category[cat].append((len(categories), driver_id))
+            if is_available:
+                snapshot.available_drivers.add(driver_id)
+        # при полной загрузке сортируем один раз, а не insort на каждую строку
+        for items in (*snapshot._by_type.values(), *snapshot._by_category.values()):
+            items.sort()
+        return snapshot
+
+    # Инкрементальные обновления
+
+    def _record(self, method, *args):
+        """Идёт перечитывание - изменение повторится поверх нового снимка.
+        False - индекса ещё нет, применять некуда (его соберёт первая загрузка)."""
+        if self._journal is not None:
+            self._journal.append((method, args))
+        return self._loaded_at is not None
+
+    def _add_vehicle(self, plate, transport_type, max_weight, max_volume, is_available, add=insort):
+        self._vehicles[plate] = (transport_type, max_weight, max_volume)
+        add(self._by_type.setdefault(transport_type, []), (max_weight, max_volume, plate))
+        if is_available:
+            self.available_vehicles.add(plate)
+
+    def _add_driver(self, driver_id, categories, is_available, add=insort):
+        self._drivers[driver_id] = categories
+        for cat in categories:
+            add(self._by_category[cat], (len(categories), driver_id))
+        if is_available:
+            self.available_drivers.add(driver_id)
+
+    def _remove_vehicle(self, plate):
+        entry = self._vehicles.pop(plate, None)
+        if entry is None:
+            return
+        transport_type, max_weight, max_volume = entry
+        items = self._by_type[transport_type]
+        del items[bisect_left(items, (max_weight, max_volume, plate))]
+        self.available_vehicles.discard(plate)
+
+    def _remove_driver(self, driver_id):
+        categories = self._drivers.pop(driver_id, None)
+        if categories is None:
+            return
+        for cat in categories:
+            items = self._by_category[cat]
+            del items[bisect_left(items, (len(categories), driver_id))]
+        self.available_drivers.discard(driver_id)
+
+    def remove_vehicle(self, plate):
+        with self._lock:
+            if self._record(self.remove_vehicle, plate):
+                self._remove_vehicle(plate)
+
+    def remove_driver(self, driver_id):
+        with self._lock:
+            if self._record(self.remove_driver, driver_id):
+                self._remove_driver(driver_id)
+
+    def upsert_vehicle(self, vehicle):
+        self.upsert_vehicles([vehicle])
+
+    def upsert_driver(self, driver):
+        self.upsert_drivers([driver])
+
+    # Пачки (импорт): списки досортировываются один раз, а не insort на каждую строку
+
+    def upsert_vehicles(self, vehicles):
+        with self._lock:
+            if not self._record(self.upsert_vehicles, vehicles):
+                return
+            for vehicle in vehicles:
+                self._remove_vehicle(vehicle.pk)
+            add = insort if len(vehicles) == 1 else list.append
+            for vehicle in vehicles:
+                self._add_vehicle(
+                    vehicle.pk, vehicle.transport_type, vehicle.max_weight, vehicle.max_volume,
+                    vehicle.is_available, add=add,
+                )
+            if add is list.append:
+                for items in self._by_type.values():
+                    items.sort()
+
+    def upsert_drivers(self, drivers):
+        with self._lock:
+            if not self._record(self.upsert_drivers, drivers):
+                return
+            for driver in drivers:
+                self._remove_driver(driver.pk)
+            add = insort if len(drivers) == 1 else list.append
+            for driver in drivers:
+                self._add_driver(driver.pk, driver_categories(driver), driver.is_available, add=add)
+            if add is list.append:
+                for items in self._by_category.values():
+                    items.sort()
+
+    def set_availability(self, drivers=(), vehicles=(), available=False):
+        drivers, vehicles = tuple(drivers), tuple(vehicles)
+        with self._lock:
+            if not self._record(self.set_availability, drivers, vehicles, available):
+                return
+            for driver_id in drivers:
+                if driver_id in self._drivers:
+                    (self.available_drivers.add if available else self.available_drivers.discard)(driver_id)
+            for plate in vehicles:
+                if plate in self._vehicles:
+                    (self.available_vehicles.add if available else self.available_vehicles.discard)(plate)
+
+    # Запросы
+
+    def feasible_vehicles(self, weight, volume, limit, vehicle_ok=None):
+        """До limit самых плотно загружаемых машин каждого типа, вмещающих груз."""
+        found = []
+        with self._lock:
+            vehicle_ok = vehicle_ok or self.available_vehicles.__contains__
+            for transport_type, items in self._by_type.items():
+                taken = 0
+                # машины отсортированы по грузоподъёмности - начинаем с самой "тесной"
+                for i in range(bisect_left(items, (weight,)), len(items)):
+                    max_weight, max_volume, plate = items[i]
+                    if max_volume < volume or max_volume <= 0 or max_weight <= 0 or not vehicle_ok(plate):
+                        continue
+                    found.append((vehicle_waste(max_weight, max_volume, weight, volume), plate, transport_type))
+                    taken += 1
+                    if taken >= limit:
+                        break
+        found.sort()
+        return found
+
+    def drivers_for(self, transport_type, limit, driver_ok=None):
+        """До limit водителей с подходящими правами, сначала наименее универсальные."""
+        candidates = []
+        with self._lock:
+            driver_ok = driver_ok or self.available_drivers.__contains__
+            for cat in ACCEPTED_LICENCES.get(transport_type, ()):
+                taken = 0
+                for n_categories, driver_id in self._by_category[cat]:
+                    if driver_ok(driver_id):
+                        candidates.append((n_categories, driver_id))
+                        taken += 1
+                        if taken >= limit:
+                            break
+        return [(driver_id, n_categories) for n_categories, driver_id in sorted(set(candidates))[:limit]]
+
+    def suggest(self, weight, volume, limit=10, vehicle_ok=None, driver_ok=None):
+        """Ранжированные пары (водитель, машина) для груза weight/volume."""
+        self.ensure_loaded()
+        weight, volume = float(weight), float(volume)
+        pairs = []
+        drivers_by_type = {}
+        for waste, plate, transport_type in self.feasible_vehicles(weight, volume, limit, vehicle_ok):
+            if transport_type not in drivers_by_type:
+                drivers_by_type[transport_type] = self.drivers_for(transport_type, limit, driver_ok)
+            for driver_id, n_categories in drivers_by_type[transport_type]:
+                score = waste + DRIVER_PENALTY * (n_categories - 1)
+                pairs.append((score, driver_id, plate))
+        pairs.sort(key=lambda pair: pair[0])
+
+        # Сначала пары без повторов водителя и машины, чтобы у диспетчера были реальные альтернативы
+        distinct, rest = [], []
+        used_drivers, used_vehicles = set(), set()
+        for pair in pairs:
+            _, driver_id, plate = pair
+            if driver_id in used_drivers or plate in used_vehicles:
+                rest.append(pair)
+            else:
+                distinct.append(pair)
+                used_drivers.add(driver_id)
+                used_vehicles.add(plate)
+        return (distinct + rest)[:limit]
+
+
+fleet_index = FleetIndex()
+
+
+def suggest_for_order(order, limit=10):
+    """Подсказки для заказа. Кандидаты из индекса перепроверяются в БД
+    одним запросом на водителей и одним на машины - индекс другого процесса мог отстать."""
+    pairs = fleet_index.suggest(order.weight, order.volume, limit=limit * 2)
+    driver_ids = {driver_id for _, driver_id, _ in pairs}
+    plates = {plate for _, _, plate in pairs}
+    free_drivers = set(Driver.objects.filter(pk__in=driver_ids, is_available=True).values_list('pk', flat=True))
+    free_vehicles = set(Vehicle.objects.filter(pk__in=plates, is_available=True).values_list('pk', flat=True))
+
+    stale_drivers = driver_ids - free_drivers
+    stale_vehicles = plates - free_vehicles
+    if stale_drivers or stale_vehicles:
+        fleet_index.set_availability(drivers=stale_drivers, vehicles=stale_vehicles, available=False)
+
+    return [
+        {'driver': driver_id, 'vehicle': plate, 'score': round(score, 4)}
+        for score, driver_id, plate in pairs
+        if driver_id in free_drivers and plate in free_vehicles
+    ][:limit]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.3 on 2026-10-18 10:03
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0003_shipment_arrival_time_shipment_price_shipment_status_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="shipment",
+            name="created_at",
+            field=models.DateTimeField(
+                auto_now_add=True, default=django.utils.timezone.now
+            ),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name="shipment",
+            name="review_created_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="order",
+            index=models.Index(
+                fields=["-created_at", "-order_id"], name="order_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="order",
+            index=models.Index(
+                fields=["client", "-created_at"], name="order_client_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="shipment",
+            index=models.Index(
+                fields=["-created_at", "-shipment_id"], name="shipment_created_idx"
+            ),
+        ),
+    ]
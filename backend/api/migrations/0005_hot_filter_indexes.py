@@ -0,0 +1,67 @@
+# Generated by Django 5.2.3 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0004_shipment_created_at_and_pagination_indexes"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="order",
+            name="order_client_created_idx",
+        ),
+        migrations.AddIndex(
+            model_name="driver",
+            index=models.Index(
+                condition=models.Q(("is_available", True)),
+                fields=["driver_id"],
+                name="driver_available_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="order",
+            index=models.Index(
+                fields=["client", "-created_at", "-order_id"],
+                name="order_client_created_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="order",
+            index=models.Index(
+                fields=["dispatcher", "-created_at", "-order_id"],
+                name="order_dispatcher_created_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="order",
+            index=models.Index(
+                fields=["status", "-created_at"], name="order_status_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="order",
+            index=models.Index(
+                condition=models.Q(("status", "Pending")),
+                fields=["-created_at"],
+                name="order_pending_created_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="shipment",
+            index=models.Index(
+                fields=["status", "arrival_time"], name="shipment_status_arrival_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="vehicle",
+            index=models.Index(
+                condition=models.Q(("is_available", True)),
+                fields=["max_weight", "max_volume"],
+                name="vehicle_available_capacity_idx",
+            ),
+        ),
+    ]
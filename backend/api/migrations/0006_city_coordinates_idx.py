@@ -0,0 +1,19 @@
+# Generated by Django 5.2.3 on 2026-10-18 10:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0005_hot_filter_indexes"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="city",
+            index=models.Index(
+                fields=["latitude", "longitude"], name="city_coordinates_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 5.2.3 on 2026-10-18 10:43
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def fill_counters(apps, schema_editor):
+    # начальные значения по уже существующим данным (то же, что manage.py reconcile_dashboard)
+    Order = apps.get_model("api", "Order")
+    Shipment = apps.get_model("api", "Shipment")
+    DashboardCounter = apps.get_model("api", "DashboardCounter")
+    values = {}
+    for status, count in Order.objects.values_list("status").annotate(n=Count("pk")).order_by():
+        values[f"orders:{status}"] = count
+    for status, count in Shipment.objects.values_list("status").annotate(n=Count("pk")).order_by():
+        values[f"shipments:{status}"] = count
+    totals = Shipment.objects.aggregate(
+        revenue=Sum("price"), rating_sum=Sum("review_rating"), rating_count=Count("review_rating"),
+    )
+    values["revenue"] = totals["revenue"] or 0
+    values["rating:sum"] = totals["rating_sum"] or 0
+    values["rating:count"] = totals["rating_count"]
+    DashboardCounter.objects.bulk_create(
+        DashboardCounter(key=key, shard=0, value=value) for key, value in values.items()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0007_updated_at"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DashboardCounter",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("key", models.CharField(max_length=50)),
+                ("shard", models.PositiveSmallIntegerField()),
+                (
+                    "value",
+                    models.DecimalField(decimal_places=3, default=0, max_digits=20),
+                ),
+            ],
+            options={
+                "verbose_name": "Dashboard counter",
+                "verbose_name_plural": "Dashboard counters",
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("key", "shard"), name="dashboard_counter_key_shard_uniq"
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.3 on 2026-10-18 10:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0008_dashboard_counter"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="order",
+            index=models.Index(
+                fields=["created_at", "city_from", "city_to"],
+                name="order_created_route_idx",
+            ),
+        ),
+    ]
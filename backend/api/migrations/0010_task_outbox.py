@@ -0,0 +1,77 @@
+# Generated by Django 5.2.3 on 2026-10-18 10:50
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0009_order_created_route_idx"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DeadTask",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=100)),
+                (
+                    "payload",
+                    models.JSONField(
+                        default=dict,
+                        encoder=django.core.serializers.json.DjangoJSONEncoder,
+                    ),
+                ),
+                ("attempts", models.PositiveIntegerField()),
+                ("error", models.TextField()),
+                ("created_at", models.DateTimeField()),
+                ("failed_at", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "verbose_name": "Dead task",
+                "verbose_name_plural": "Dead tasks",
+            },
+        ),
+        migrations.CreateModel(
+            name="Task",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=100)),
+                (
+                    "payload",
+                    models.JSONField(
+                        default=dict,
+                        encoder=django.core.serializers.json.DjangoJSONEncoder,
+                    ),
+                ),
+                ("run_after", models.DateTimeField()),
+                ("attempts", models.PositiveIntegerField(default=0)),
+                ("last_error", models.TextField(blank=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "verbose_name": "Task",
+                "verbose_name_plural": "Tasks",
+                "indexes": [
+                    models.Index(fields=["run_after", "id"], name="task_run_after_idx")
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,121 @@
+# Generated by Django 5.2.3 on 2026-10-18 10:54
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F
+
+
+def fill_departure_time(apps, schema_editor):
+    # у существующих рейсов время отправления неизвестно - считаем, что уехали при подтверждении
+    Shipment = apps.get_model("api", "Shipment")
+    Shipment.objects.update(departure_time=F("created_at"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0010_task_outbox"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Downtime",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("start", models.DateTimeField()),
+                ("end", models.DateTimeField()),
+                ("reason", models.CharField(blank=True, max_length=200)),
+            ],
+            options={
+                "verbose_name": "Downtime",
+                "verbose_name_plural": "Downtimes",
+            },
+        ),
+        migrations.AddField(
+            model_name="shipment",
+            name="departure_time",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(fill_departure_time, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="shipment",
+            index=models.Index(
+                condition=models.Q(("status__in", ["In Progress", "Delayed"])),
+                fields=["driver", "-departure_time"],
+                name="shipment_driver_busy_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="shipment",
+            index=models.Index(
+                condition=models.Q(("status__in", ["In Progress", "Delayed"])),
+                fields=["vehicle", "-departure_time"],
+                name="shipment_vehicle_busy_idx",
+            ),
+        ),
+        migrations.AddField(
+            model_name="downtime",
+            name="driver",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="downtimes",
+                to="api.driver",
+            ),
+        ),
+        migrations.AddField(
+            model_name="downtime",
+            name="vehicle",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="downtimes",
+                to="api.vehicle",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="downtime",
+            index=models.Index(
+                condition=models.Q(("driver__isnull", False)),
+                fields=["driver", "-start"],
+                name="downtime_driver_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="downtime",
+            index=models.Index(
+                condition=models.Q(("vehicle__isnull", False)),
+                fields=["vehicle", "-start"],
+                name="downtime_vehicle_idx",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="downtime",
+            constraint=models.CheckConstraint(
+                condition=models.Q(
+                    models.Q(("driver__isnull", False), ("vehicle__isnull", True)),
+                    models.Q(("driver__isnull", True), ("vehicle__isnull", False)),
+                    _connector="OR",
+                ),
+                name="downtime_one_resource",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="downtime",
+            constraint=models.CheckConstraint(
+                condition=models.Q(("end__gt", models.F("start"))),
+                name="downtime_end_after_start",
+            ),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.3 on 2026-10-18 10:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0011_availability_intervals"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="order",
+            name="consolidated_shipment",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="consolidated_orders",
+                to="api.shipment",
+            ),
+        ),
+    ]
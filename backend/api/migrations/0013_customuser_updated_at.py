@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-18 11:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0012_order_consolidated_shipment"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="customuser",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
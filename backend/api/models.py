@@ -1,7 +1,9 @@
 import uuid
 from django.contrib.auth.models import AbstractUser
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.utils import timezone
 
 
 class CustomUser(AbstractUser):
@@ -12,6 +14,8 @@ class CustomUser(AbstractUser):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     email = models.EmailField(unique=True)
     role = models.CharField(max_length=20, choices=RoleChoices.choices)
+    # пользователь вложен в ответы диспетчера (client) - для ETag/Last-Modified, см. conditional
+    updated_at = models.DateTimeField(auto_now=True)
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username']
@@ -35,6 +39,10 @@ class City(models.Model):
     class Meta:
         verbose_name = 'City'
         verbose_name_plural = 'Cities'
+        indexes = [
+            # bounding-box префильтр для поиска городов по радиусу
+            models.Index(fields=['latitude', 'longitude'], name='city_coordinates_idx'),
+        ]
 
     def __str__(self):
         return f"City {self.city_name} at {self.latitude} {self.longitude}"
@@ -82,15 +90,51 @@ class Order(models.Model):
         on_delete=models.CASCADE,
         related_name='orders_to',
     )
+    # Сборный рейс (см. api/consolidation.py): все заказы, которые везёт одна машина,
+    # включая основной (Shipment.order). У обычного рейса - пусто
+    consolidated_shipment = models.ForeignKey(
+        'Shipment',
+        on_delete=models.SET_NULL,
+        related_name='consolidated_orders',
+        null=True,
+        blank=True,
+    )
     created_at = models.DateTimeField(auto_now_add=True)
+    # queryset.update() не трогает auto_now - там updated_at проставляется явно (см. booking)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         verbose_name = 'Order'
         verbose_name_plural = 'Orders'
+        indexes = [
+            # для курсорной пагинации списков заказов
+            models.Index(fields=['-created_at', '-order_id'], name='order_created_idx'),
+            models.Index(fields=['client', '-created_at', '-order_id'], name='order_client_created_idx'),
+            models.Index(fields=['dispatcher', '-created_at', '-order_id'], name='order_dispatcher_created_idx'),
+            models.Index(fields=['status', '-created_at'], name='order_status_created_idx'),
+            # свёртки аналитики: диапазон по created_at, группировка по маршруту
+            models.Index(fields=['created_at', 'city_from', 'city_to'], name='order_created_route_idx'),
+            # очередь диспетчера: необработанных заказов мало, индекс маленький
+            models.Index(
+                fields=['-created_at'],
+                condition=models.Q(status='Pending'),
+                name='order_pending_created_idx',
+            ),
+        ]
 
     def __str__(self):
         return f"Order {self.order_id} by {self.client}"
 
+    @property
+    def route_distance_km(self):
+        # из общей матрицы расстояний, без запросов к БД за городами;
+        # списки подставляют значения всей страницы сразу (distances.prefetch_route_distances)
+        try:
+            return self._route_distance_km
+        except AttributeError:
+            from api.distances import distance_matrix
+            return distance_matrix.distance(self.city_from_id, self.city_to_id)
+
 
 class Vehicle(models.Model):
     license_plate = models.CharField(
@@ -103,10 +147,18 @@ class Vehicle(models.Model):
     max_volume = models.IntegerField()
     max_weight = models.IntegerField()
     is_available = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         verbose_name = 'Vehicle'
         verbose_name_plural = 'Vehicles'
+        indexes = [
+            models.Index(
+                fields=['max_weight', 'max_volume'],
+                condition=models.Q(is_available=True),
+                name='vehicle_available_capacity_idx',
+            ),
+        ]
 
     def __str__(self):
         return f"Vehicle {self.license_plate}"
@@ -136,10 +188,18 @@ class Driver(models.Model):
     CE = models.BooleanField()
     C1E = models.BooleanField()
     is_available = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         verbose_name = 'Driver'
         verbose_name_plural = 'Drivers'
+        indexes = [
+            models.Index(
+                fields=['driver_id'],
+                condition=models.Q(is_available=True),
+                name='driver_available_idx',
+            ),
+        ]
 
     def __str__(self):
         return f"Driver {self.first_name} {self.last_name} ({self.driver_id})"
@@ -172,12 +232,15 @@ class Shipment(models.Model):
         on_delete=models.CASCADE,
         related_name='shipments',
     )
+    # рейс занимает водителя и машину на [departure_time, arrival_time), см. api/availability.py
+    departure_time = models.DateTimeField(default=timezone.now)
     arrival_time = models.DateTimeField()
     price = models.DecimalField(max_digits=10, decimal_places=3)
     status = models.CharField(
         choices=StatusChoices.choices,
         default=StatusChoices.IN_PROGRESS
     )
+    created_at = models.DateTimeField(auto_now_add=True)
 
     review_rating = models.IntegerField(
         blank=True,
@@ -191,11 +254,136 @@ class Shipment(models.Model):
         blank=True,
         null=True,
     )
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         verbose_name = 'Shipment'
         verbose_name_plural = 'Shipments'
+        indexes = [
+            models.Index(fields=['-created_at', '-shipment_id'], name='shipment_created_idx'),
+            models.Index(fields=['status', 'arrival_time'], name='shipment_status_arrival_idx'),
+            # интервалы занятости: только активные рейсы, по ресурсу и началу
+            models.Index(
+                fields=['driver', '-departure_time'],
+                condition=models.Q(status__in=['In Progress', 'Delayed']),
+                name='shipment_driver_busy_idx',
+            ),
+            models.Index(
+                fields=['vehicle', '-departure_time'],
+                condition=models.Q(status__in=['In Progress', 'Delayed']),
+                name='shipment_vehicle_busy_idx',
+            ),
+        ]
 
     def __str__(self):
         return f"Shipment {self.shipment_id} (Order {self.order.order_id})"
 
+
+
+class Downtime(models.Model):
+    """Плановый простой водителя или машины: на [start, end) ресурс не назначается.
+
+    Простои одного ресурса не пересекаются ни друг с другом, ни с его рейсами -
+    на этом держится проверка пересечения за один index seek (см. api/availability.py)."""
+
+    driver = models.ForeignKey(
+        Driver,
+        on_delete=models.CASCADE,
+        related_name='downtimes',
+        blank=True,
+        null=True,
+    )
+    vehicle = models.ForeignKey(
+        Vehicle,
+        on_delete=models.CASCADE,
+        related_name='downtimes',
+        blank=True,
+        null=True,
+    )
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    reason = models.CharField(max_length=200, blank=True)
+
+    class Meta:
+        verbose_name = 'Downtime'
+        verbose_name_plural = 'Downtimes'
+        constraints = [
+            models.CheckConstraint(
+                condition=models.Q(driver__isnull=False, vehicle__isnull=True)
+                | models.Q(driver__isnull=True, vehicle__isnull=False),
+                name='downtime_one_resource',
+            ),
+            models.CheckConstraint(condition=models.Q(end__gt=models.F('start')), name='downtime_end_after_start'),
+        ]
+        indexes = [
+            models.Index(fields=['driver', '-start'], condition=models.Q(driver__isnull=False), name='downtime_driver_idx'),
+            models.Index(fields=['vehicle', '-start'], condition=models.Q(vehicle__isnull=False), name='downtime_vehicle_idx'),
+        ]
+
+    def __str__(self):
+        return f"Downtime {self.driver_id or self.vehicle_id} {self.start:%Y-%m-%d %H:%M} - {self.end:%Y-%m-%d %H:%M}"
+
+
+class DashboardCounter(models.Model):
+    """Счётчики дашборда диспетчера (см. api/dashboard.py).
+
+    Каждый счётчик разбит на шарды: параллельные транзакции прибавляют к разным строкам
+    и не ждут друг друга на одной блокировке. Значение = сумма по шардам."""
+
+    key = models.CharField(max_length=50)
+    shard = models.PositiveSmallIntegerField()
+    value = models.DecimalField(max_digits=20, decimal_places=3, default=0)
+
+    class Meta:
+        verbose_name = 'Dashboard counter'
+        verbose_name_plural = 'Dashboard counters'
+        constraints = [
+            models.UniqueConstraint(fields=['key', 'shard'], name='dashboard_counter_key_shard_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.key}[{self.shard}] = {self.value}"
+
+
+class Task(models.Model):
+    """Отложенная задача (transactional outbox, см. api/tasks.py).
+
+    Пишется в той же транзакции, что и переход статуса: откат перехода откатывает
+    и задачу. Воркеры забирают готовые (run_after <= now) через SELECT ... FOR UPDATE
+    SKIP LOCKED и удаляют после успешного выполнения."""
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(encoder=DjangoJSONEncoder, default=dict)
+    run_after = models.DateTimeField()
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Task'
+        verbose_name_plural = 'Tasks'
+        indexes = [
+            models.Index(fields=['run_after', 'id'], name='task_run_after_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.pk}"
+
+
+class DeadTask(models.Model):
+    """Задача, исчерпавшая TASKS_MAX_ATTEMPTS попыток: лежит для разбора,
+    вернуть в очередь - manage.py run_tasks --requeue-dead."""
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(encoder=DjangoJSONEncoder, default=dict)
+    attempts = models.PositiveIntegerField()
+    error = models.TextField()
+    created_at = models.DateTimeField()
+    failed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Dead task'
+        verbose_name_plural = 'Dead tasks'
+
+    def __str__(self):
+        return f"{self.name} #{self.pk} (dead)"
@@ -0,0 +1,151 @@
+import json
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, _reverse_ordering
+
+
+class CreatedAtCursorPagination(CursorPagination):
+    # Курсорная (keyset) пагинация: страница N стоит столько же, сколько первая,
+    # потому что фильтр идёт по индексу (created_at, pk), а не через OFFSET.
+    ordering = ('-created_at', '-pk')
+    page_size_query_param = 'page_size'
+    max_page_size = getattr(settings, 'MAX_PAGE_SIZE', 500)
+
+    def get_ordering(self, request, queryset, view):
+        # Вьюсеты моделей без created_at задают свой порядок через cursor_ordering
+        ordering = getattr(view, 'cursor_ordering', None)
+        if ordering:
+            return tuple(ordering)
+        return super().get_ordering(request, queryset, view)
+
+    # Позиция курсора в DRF - значение только первого поля порядка. При одинаковых created_at
+    # (пакетная вставка) ссылка "назад" с такой страницы указывала в пустоту. Здесь позиция -
+    # значения всех полей порядка, фильтр - (created_at, pk) < (T, P) в лексикографическом смысле
+
+    def _get_position_from_instance(self, instance, ordering):
+        values = []
+        for field in ordering:
+            name = field.lstrip('-')
+            values.append(str(instance[name] if isinstance(instance, dict) else getattr(instance, name)))
+        return json.dumps(values)
+
+    def decode_cursor(self, request):
+        cursor = super().decode_cursor(request)
+        if cursor is not None and cursor.position is not None:
+            self._position_values = self._parse_position(cursor.position)
+        return cursor
+
+    def _parse_position(self, position):
+        # Значения позиции приводятся к типам полей здесь: подделанный курсор (не дата,
+        # не UUID) - 404, а не ValidationError из фильтра queryset и 500
+        try:
+            values = json.loads(position)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        opts = self._model._meta
+        parsed = []
+        for field, value in zip(self.ordering, values):
+            name = field.lstrip('-')
+            model_field = opts.pk if name == 'pk' else opts.get_field(name)
+            try:
+                value = model_field.to_python(value) if isinstance(value, str) else None
+            except ValidationError:
+                value = None
+            if value is None:
+                raise NotFound(self.invalid_cursor_message)
+            parsed.append(value)
+        return parsed
+
+    def _position_filter(self, values, reverse):
+        condition, equal = Q(), {}
+        for field, value in zip(self.ordering, values):
+            name = field.lstrip('-')
+            lookup = 'lt' if reverse != field.startswith('-') else 'gt'
+            condition |= Q(**equal, **{f'{name}__{lookup}': value})
+            equal[name] = value
+        return condition
+
+    # paginate_queryset из DRF, разделённый на построение запроса и разбор результата,
+    # чтобы страницу можно было прочитать и через async ORM (apaginate_queryset)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        queryset = self._page_queryset(queryset, request, view)
+        if queryset is None:
+            return None
+        return self._set_page(list(queryset))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        queryset = self._page_queryset(queryset, request, view)
+        if queryset is None:
+            return None
+        return self._set_page([obj async for obj in queryset])
+
+    def page_queryset(self, queryset, request, view=None):
+        """Запрос текущей страницы (с лишней строкой), не выполняя его: по нему
+        ConditionalGetMixin считает валидаторы. None - пагинация выключена."""
+        return self._page_queryset(queryset, request, view)
+
+    def _page_queryset(self, queryset, request, view):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self._model = queryset.model
+
+        self.cursor = self.decode_cursor(request)
+        if self.cursor is None:
+            (offset, reverse, current_position) = (0, False, None)
+        else:
+            (offset, reverse, current_position) = self.cursor
+        self._reverse, self._current_position, self._offset = reverse, current_position, offset
+
+        if reverse:
+            queryset = queryset.order_by(*_reverse_ordering(self.ordering))
+        else:
+            queryset = queryset.order_by(*self.ordering)
+
+        if current_position is not None:
+            queryset = queryset.filter(self._position_filter(self._position_values, reverse))
+
+        # лишний элемент показывает, есть ли следующая страница
+        return queryset[offset:offset + self.page_size + 1]
+
+    def _set_page(self, results):
+        reverse, current_position, offset = self._reverse, self._current_position, self._offset
+        self.page = list(results[:self.page_size])
+
+        if len(results) > len(self.page):
+            has_following_position = True
+            following_position = self._get_position_from_instance(results[-1], self.ordering)
+        else:
+            has_following_position = False
+            following_position = None
+
+        if reverse:
+            self.page = list(reversed(self.page))
+            self.has_next = (current_position is not None) or (offset > 0)
+            self.has_previous = has_following_position
+            if self.has_next:
+                self.next_position = current_position
+            if self.has_previous:
+                self.previous_position = following_position
+        else:
+            self.has_next = has_following_position
+            self.has_previous = (current_position is not None) or (offset > 0)
+            if self.has_next:
+                self.next_position = following_position
+            if self.has_previous:
+                self.previous_position = current_position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+
+        return self.page
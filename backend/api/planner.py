@@ -0,0 +1,213 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+
+from api.matching import ACCEPTED_LICENCES, LICENCE_CATEGORIES
+from api.models import Driver, Order, Vehicle
+
+
+# Сколько самых "плотных" машин оставляем каждому заказу в разреженном графе
+CANDIDATES_PER_ORDER = 8
+# Заказы обрабатываются блоками, чтобы не держать в памяти матрицу n x m целиком
+CHUNK_SIZE = 512
+MAX_ROUNDS = 3
+
+# accepted[t, c] - водитель с категорией c может вести транспорт типа t
+ACCEPTED_MATRIX = np.array([
+    [cat in ACCEPTED_LICENCES[vehicle_type] for cat in LICENCE_CATEGORIES]
+    for vehicle_type in LICENCE_CATEGORIES
+])
+
+
+def waste_matrix(order_weights, order_volumes, vehicle_weights, vehicle_volumes):
+    """Недогруз для каждой пары заказ x машина; inf, если груз не влезает."""
+    w = order_weights[:, None]
+    v = order_volumes[:, None]
+    cost = (vehicle_weights - w) / vehicle_weights + (vehicle_volumes - v) / vehicle_volumes
+    cost[(vehicle_weights < w) | (vehicle_volumes < v)] = np.inf
+    return cost
+
+
+def greedy_fit(order_weights, order_volumes, vehicle_weights, vehicle_volumes):
+    """Best fit decreasing: крупные заказы первыми, каждому - самая плотная свободная машина.
+    Нужен как гарантированно достижимое решение внутри разреженного графа."""
+    free = np.ones(len(vehicle_weights), dtype=bool)
+    result = np.full(len(order_weights), -1)
+    size = np.maximum(
+        order_weights / max(order_weights.max(), 1e-9), order_volumes / max(order_volumes.max(), 1e-9),
+    )
+    for i in np.argsort(-size):
+        cost = waste_matrix(order_weights[i:i + 1], order_volumes[i:i + 1], vehicle_weights, vehicle_volumes)[0]
+        cost[~free] = np.inf
+        j = int(np.argmin(cost))
+        if np.isfinite(cost[j]):
+            result[i] = j
+            free[j] = False
+    return result
+
+
+def match_orders(order_weights, order_volumes, vehicle_weights, vehicle_volumes, candidates=CANDIDATES_PER_ORDER):
+    """Min-cost паросочетание заказов и машин: максимум назначенных заказов, затем минимум недогруза.
+
+    Полная матрица 5k x 5k для венгерского алгоритма слишком медленная, поэтому строим
+    разреженный граф: каждому заказу k лучших машин + машина из жадного решения
+    + фиктивная вершина "не назначен" с большим штрафом (она гарантирует полное паросочетание)."""
+    n, m = len(order_weights), len(vehicle_weights)
+    result = np.full(n, -1)
+    if n == 0 or m == 0:
+        return result
+    greedy = greedy_fit(order_weights, order_volumes, vehicle_weights, vehicle_volumes)
+    k = min(candidates, m)
+
+    rows, cols, costs = [], [], []
+    for start in range(0, n, CHUNK_SIZE):
+        stop = min(start + CHUNK_SIZE, n)
+        cost = waste_matrix(order_weights[start:stop], order_volumes[start:stop], vehicle_weights, vehicle_volumes)
+        best = np.argpartition(cost, k - 1, axis=1)[:, :k]
+        fallback = greedy[start:stop]
+        idx = np.concatenate([best, np.where(fallback >= 0, fallback, best[:, 0])[:, None]], axis=1)
+        chunk_costs = np.take_along_axis(cost, idx, axis=1)
+        feasible = np.isfinite(chunk_costs)
+        chunk_rows = np.broadcast_to(np.arange(start, stop)[:, None], idx.shape)
+        rows.append(chunk_rows[feasible])
+        cols.append(idx[feasible])
+        costs.append(chunk_costs[feasible])
+
+    # штраф за неназначенный заказ больше суммарного недогруза любого решения
+    penalty = 2.0 * n + 10
+    rows.append(np.arange(n))
+    cols.append(m + np.arange(n))
+    costs.append(np.full(n, penalty))
+    rows, cols, costs = np.concatenate(rows), np.concatenate(cols), np.concatenate(costs)
+    # машина из жадного решения часто уже есть среди k лучших: csr_matrix сложил бы веса
+    # повторяющихся рёбер, поэтому оставляем каждое ребро один раз
+    _, first = np.unique(rows * (m + n) + cols, return_index=True)
+    # нулевые веса разреженная матрица считает отсутствующими рёбрами
+    graph = csr_matrix((costs[first] + 1e-9, (rows[first], cols[first])), shape=(n, m + n))
+    order_idx, vehicle_idx = min_weight_full_bipartite_matching(graph)
+    matched = vehicle_idx < m
+    result[order_idx[matched]] = vehicle_idx[matched]
+    return result
+
+
+def assign_drivers(vehicle_types, driver_categories, priority=None):
+    """Водители для выбранных машин. Сначала типы с самым узким кругом водителей,
+    внутри типа - водители с наименьшим числом категорий (универсальных бережём).
+    Если водителей не хватает, их получают машины с меньшим priority (недогрузом)."""
+    result = np.full(len(vehicle_types), -1)
+    if len(driver_categories) == 0:
+        return result
+    free = np.ones(len(driver_categories), dtype=bool)
+    n_categories = driver_categories.sum(axis=1)
+    eligible = (driver_categories.astype(np.int32) @ ACCEPTED_MATRIX.T.astype(np.int32)) > 0  # D x T
+    present = np.unique(vehicle_types)
+    for t in sorted(present, key=lambda t: eligible[:, t].sum()):
+        vehicles = np.flatnonzero(vehicle_types == t)
+        if priority is not None:
+            vehicles = vehicles[np.argsort(priority[vehicles], kind='stable')]
+        drivers = np.flatnonzero(eligible[:, t] & free)
+        drivers = drivers[np.argsort(n_categories[drivers], kind='stable')][:len(vehicles)]
+        result[vehicles[:len(drivers)]] = drivers
+        free[drivers] = False
+    return result
+
+
+def solve(order_weights, order_volumes, vehicle_weights, vehicle_volumes, vehicle_types, driver_categories):
+    """Ядро планировщика на массивах numpy.
+
+    vehicle_types - индексы в LICENCE_CATEGORIES, driver_categories - bool-матрица D x 6.
+    Возвращает массивы (vehicle, driver) для каждого заказа, -1 - не назначен."""
+    n = len(order_weights)
+    order_vehicle = np.full(n, -1)
+    order_driver = np.full(n, -1)
+    vehicles_left = np.ones(len(vehicle_weights), dtype=bool)
+    drivers_left = np.ones(len(driver_categories), dtype=bool)
+
+    # Машины, для которых не нашлось водителя, выбрасываем и перепланируем оставшиеся заказы
+    for _ in range(MAX_ROUNDS):
+        orders = np.flatnonzero(order_vehicle < 0)
+        vehicles = np.flatnonzero(vehicles_left)
+        drivers = np.flatnonzero(drivers_left)
+        if len(orders) == 0 or len(vehicles) == 0 or len(drivers) == 0:
+            break
+        has_driver = (driver_categories[drivers].astype(np.int32) @ ACCEPTED_MATRIX.T.astype(np.int32)).any(axis=0)
+        vehicles = vehicles[has_driver[vehicle_types[vehicles]]]
+        if len(vehicles) == 0:
+            break
+
+        matched = match_orders(
+            order_weights[orders], order_volumes[orders], vehicle_weights[vehicles], vehicle_volumes[vehicles],
+        )
+        assigned = matched >= 0
+        chosen_orders = orders[assigned]
+        chosen_vehicles = vehicles[matched[assigned]]
+        waste = (
+            (vehicle_weights[chosen_vehicles] - order_weights[chosen_orders]) / vehicle_weights[chosen_vehicles]
+            + (vehicle_volumes[chosen_vehicles] - order_volumes[chosen_orders]) / vehicle_volumes[chosen_vehicles]
+        )
+        chosen_drivers = assign_drivers(vehicle_types[chosen_vehicles], driver_categories[drivers], priority=waste)
+
+        ok = chosen_drivers >= 0
+        order_vehicle[chosen_orders[ok]] = chosen_vehicles[ok]
+        order_driver[chosen_orders[ok]] = drivers[chosen_drivers[ok]]
+        vehicles_left[chosen_vehicles[ok]] = False
+        drivers_left[drivers[chosen_drivers[ok]]] = False
+        if ok.all():
+            break
+        vehicles_left[chosen_vehicles[~ok]] = False
+    return order_vehicle, order_driver
+
+
+def load_free_fleet():
+    """Свободный сейчас парк массивами: (plates, vehicle_types, vehicle_weights, vehicle_volumes,
+    driver_ids, driver_categories)."""
+    vehicles = list(
+        Vehicle.objects.filter(is_available=True, transport_type__in=LICENCE_CATEGORIES, max_weight__gt=0, max_volume__gt=0)
+        .values_list('license_plate', 'transport_type', 'max_weight', 'max_volume')
+    )
+    drivers = list(Driver.objects.filter(is_available=True).values_list('driver_id', *LICENCE_CATEGORIES))
+    return (
+        [row[0] for row in vehicles],
+        np.array([LICENCE_CATEGORIES.index(row[1]) for row in vehicles], dtype=np.int64),
+        np.array([row[2] for row in vehicles], dtype=np.float64),
+        np.array([row[3] for row in vehicles], dtype=np.float64),
+        [row[0] for row in drivers],
+        np.array([row[1:] for row in drivers], dtype=bool).reshape(len(drivers), len(LICENCE_CATEGORIES)),
+    )
+
+
+def build_plan(limit=5000):
+    """Dry-run: план назначения для самых старых Pending-заказов по текущему свободному парку."""
+    orders = list(
+        Order.objects.filter(status=Order.StatusChoices.PENDING)
+        .order_by('created_at')
+        .values_list('order_id', 'weight', 'volume')[:limit]
+    )
+    plates, vehicle_types, vehicle_weights, vehicle_volumes, driver_ids, driver_categories = load_free_fleet()
+
+    order_ids = [row[0] for row in orders]
+    order_weights = np.array([row[1] for row in orders], dtype=np.float64)
+    order_volumes = np.array([row[2] for row in orders], dtype=np.float64)
+
+    order_vehicle, order_driver = solve(
+        order_weights, order_volumes, vehicle_weights, vehicle_volumes, vehicle_types, driver_categories,
+    )
+
+    assignments, unassigned = [], []
+    for i, order_id in enumerate(order_ids):
+        j, d = order_vehicle[i], order_driver[i]
+        if j < 0:
+            unassigned.append(order_id)
+            continue
+        waste = (vehicle_weights[j] - order_weights[i]) / vehicle_weights[j] \
+            + (vehicle_volumes[j] - order_volumes[i]) / vehicle_volumes[j]
+        assignments.append({
+            'order': order_id, 'driver': driver_ids[d], 'vehicle': plates[j], 'waste': round(float(waste), 4),
+        })
+    return {
+        'assignments': assignments,
+        'unassigned': unassigned,
+        'orders': len(order_ids),
+        'vehicles': len(plates),
+        'drivers': len(driver_ids),
+    }
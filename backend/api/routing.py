@@ -0,0 +1,223 @@
+import time
+
+import numpy as np
+from django.conf import settings
+from rest_framework.exceptions import ValidationError
+
+from api.geo import haversine_matrix
+from api.models import City, Order
+
+
+# Расстояния - float32, как в матрице api/distances.py. Улучшения короче метра - шум округления
+EPSILON_KM = 1e-3
+MAX_SEGMENT = 3
+# Ходы ищем только к ближайшим соседям точки: n x k вместо n x n на каждом шаге
+NEIGHBOURS = 12
+
+
+def nearest_neighbour(dist, before, after, start, end):
+    """Начальный маршрут: из текущей точки - в ближайшую из тех, куда уже можно.
+    Точка выгрузки становится доступной после своей погрузки."""
+    n = len(dist)
+    visited = np.zeros(n, dtype=bool)
+    visited[[start, end]] = True
+    ready = before < 0
+    tour = [start]
+    current = start
+    for _ in range(n - 2):
+        candidates = np.flatnonzero(ready & ~visited)
+        current = candidates[np.argmin(dist[current, candidates])]
+        tour.append(current)
+        visited[current] = True
+        if after[current] >= 0:
+            ready[after[current]] = True
+    tour.append(end)
+    return np.array(tour)
+
+
+def neighbours(dist, real, k=NEIGHBOURS):
+    """k ближайших настоящих точек для каждой точки (служебные в списки не попадают)."""
+    far = dist.copy()
+    far[:, real:] = np.inf
+    np.fill_diagonal(far, np.inf)
+    k = max(min(k, real - 1), 1)
+    return np.argpartition(far, k - 1, axis=1)[:, :k]
+
+
+def _between(dist, a, b):
+    # поэлементно dist[a, b]: take по плоскому индексу в разы быстрее двумерной выборки
+    return dist.ravel().take(a * len(dist) + b)
+
+
+def _best_two_opt(dist, near, tour, pos, before):
+    """Лучший разворот отрезка tour[i..j]: новое ребро (tour[i-1], tour[j]) - к соседу tour[i-1].
+    Разворот меняет порядок внутри отрезка, поэтому недопустим, если в отрезок целиком
+    попала пара погрузка - выгрузка: отрезок должен кончаться раньше ближайшей такой выгрузки."""
+    n = len(tour)
+    # limit[i] - наименьшая позиция выгрузки, чья погрузка стоит не раньше i
+    limit = np.full(n, n - 1)
+    drops = np.flatnonzero(before[tour] >= 0)
+    np.minimum.at(limit, pos[before[tour[drops]]], drops)
+    limit = np.minimum.accumulate(limit[::-1])[::-1]
+
+    i = np.arange(1, n - 1)
+    last = near[tour[i - 1]]
+    i = i[:, None]
+    prev, first = tour[i - 1], tour[i]
+    j = pos[last]
+    nxt = tour[j + 1]  # в списках соседей только настоящие точки, j <= n - 2
+    delta = (_between(dist, prev, last) + _between(dist, first, nxt)
+             - _between(dist, prev, first) - _between(dist, last, nxt))
+    delta[(j <= i) | (j >= limit[i])] = np.inf
+    row, col = np.unravel_index(np.argmin(delta), delta.shape)
+    return delta[row, col], row + 1, int(j[row, col])
+
+
+def _best_or_opt(dist, near, tour, pos, before, after):
+    """Лучший перенос отрезка tour[i..i+length-1] длиной до MAX_SEGMENT (без разворота)
+    между tour[k] и tour[k+1], где tour[k] - сосед начала отрезка или tour[k+1] - сосед конца.
+    Погрузки отрезка нельзя унести за их выгрузки, выгрузки - поставить раньше погрузок."""
+    n = len(tour)
+    # все отрезки всех длин сразу; отрезок не трогает концы маршрута
+    i = np.concatenate([np.arange(1, n - length) for length in range(1, MAX_SEGMENT + 1)])
+    if len(i) == 0:
+        return np.inf, 0, 0, 0
+    length = np.concatenate([np.full(max(n - 1 - length, 0), length) for length in range(1, MAX_SEGMENT + 1)])
+    ends = i + length - 1
+    latest = np.full(len(i), n - 2)
+    earliest = np.zeros(len(i), dtype=np.int64)
+    for offset in range(MAX_SEGMENT):
+        # у коротких отрезков последняя точка повторяется - на min/max это не влияет
+        node = tour[np.minimum(i + offset, ends)]
+        drop_at = np.where(after[node] >= 0, pos[after[node]], n)
+        latest = np.minimum(latest, np.where(drop_at > ends, drop_at - 1, n - 2))
+        pick_at = np.where(before[node] >= 0, pos[before[node]], -1)
+        earliest = np.maximum(earliest, np.where(pick_at < i, pick_at, 0))
+
+    head, tail = tour[i], tour[ends]
+    prev, nxt = tour[i - 1], tour[ends + 1]
+    removed = _between(dist, prev, head) + _between(dist, tail, nxt) - _between(dist, prev, nxt)
+    # k от -1 до n-2: tour[-1] - служебный конец, такие k отсекает маска ниже
+    k = np.concatenate([pos[near[head]], pos[near[tail]] - 1], axis=1)
+    x, y = tour[k], tour[k + 1]
+    delta = (_between(dist, x, head[:, None]) + _between(dist, tail[:, None], y)
+             - _between(dist, x, y) - removed[:, None])
+    allowed = (((k > ends[:, None]) & (k <= latest[:, None]))
+               | ((k < i[:, None] - 1) & (k >= earliest[:, None])))
+    delta[~allowed] = np.inf
+    row, col = np.unravel_index(np.argmin(delta), delta.shape)
+    return delta[row, col], int(i[row]), int(k[row, col]), int(length[row])
+
+
+def _length(dist, tour):
+    return float(_between(dist, tour[:-1], tour[1:]).sum(dtype=np.float64))
+
+
+def improve(dist, near, tour, before, after, deadline=None):
+    """2-opt и Or-opt с учётом порядка погрузка -> выгрузка: на каждом шаге - лучший
+    из всех допустимых ходов, пока они улучшают маршрут или не вышло время."""
+    tour = tour.copy()
+    # pos[-1] для "нет пары" - позиция конца маршрута, её маски и так отсекают
+    pos = np.empty(len(tour) + 1, dtype=np.int64)
+    while deadline is None or time.perf_counter() < deadline:
+        pos[tour] = np.arange(len(tour))
+        pos[-1] = len(tour) - 1
+        moves = [(*_best_two_opt(dist, near, tour, pos, before), 0),
+                 _best_or_opt(dist, near, tour, pos, before, after)]
+        delta, i, j, length = min(moves, key=lambda move: move[0])
+        if not delta < -EPSILON_KM:
+            break
+        if length == 0:
+            tour[i:j + 1] = tour[i:j + 1][::-1].copy()
+        else:
+            segment = tour[i:i + length]
+            rest = np.concatenate([tour[:i], tour[i + length:]])
+            at = j + 1 if j < i else j + 1 - length
+            tour = np.concatenate([rest[:at], segment, rest[at:]])
+    return tour
+
+
+def solve(latitudes, longitudes, pairs, start=None, time_limit=None):
+    """Ядро: порядок объезда точек на массивах numpy.
+
+    latitudes/longitudes - координаты точек; pairs - [(погрузка, выгрузка)] индексами точек;
+    start - индекс точки, с которой маршрут начинается (иначе - с любой погрузки).
+    Маршрут открытый: после последней выгрузки возвращаться не нужно.
+    Возвращает (порядок точек, длина км, длина начального маршрута км)."""
+    n = len(latitudes)
+    # служебный конец (и начало, если оно не задано) - точки с нулевым расстоянием до всех:
+    # так открытый маршрут становится путём с закреплёнными концами
+    size = n + (1 if start is not None else 2)
+    dist = np.zeros((size, size), dtype=np.float32)
+    dist[:n, :n] = haversine_matrix(latitudes, longitudes, latitudes, longitudes)
+    first = n if start is None else start
+    before = np.full(size, -1)
+    after = np.full(size, -1)
+    for pickup, dropoff in pairs:
+        before[dropoff] = pickup
+        after[pickup] = dropoff
+
+    initial = nearest_neighbour(dist, before, after, first, size - 1)
+    deadline = None if time_limit is None else time.perf_counter() + time_limit
+    tour = improve(dist, neighbours(dist, n), initial, before, after, deadline)
+    return tour[tour < n], _length(dist, tour), _length(dist, initial)
+
+
+def build_route(stops, start=None):
+    """Маршрут по городам из БД. stops - [dict(pickup, dropoff, [order])] с id городов,
+    start - id города, откуда выезжает машина. Неизвестный город - ValidationError."""
+    ids = {city_id for stop in stops for city_id in (stop['pickup'], stop['dropoff'])}
+    if start is not None:
+        ids.add(start)
+    cities = {
+        row[0]: row for row in City.objects.filter(pk__in=ids).values_list(
+            'city_id', 'city_name', 'latitude', 'longitude',
+        )
+    }
+    missing = ids - cities.keys()
+    if missing:
+        raise ValidationError({'cities': [f'City not found: {city_id}' for city_id in sorted(map(str, missing))]})
+
+    # точки: [начало], затем погрузка и выгрузка каждой остановки
+    points = [] if start is None else [(start, 'start', None)]
+    pairs = []
+    for index, stop in enumerate(stops):
+        pairs.append((len(points), len(points) + 1))
+        points.append((stop['pickup'], 'pickup', index))
+        points.append((stop['dropoff'], 'dropoff', index))
+    latitudes = np.array([float(cities[city_id][2]) for city_id, _, _ in points])
+    longitudes = np.array([float(cities[city_id][3]) for city_id, _, _ in points])
+
+    started = time.perf_counter()
+    tour, length, initial = solve(
+        latitudes, longitudes, pairs, start=None if start is None else 0,
+        time_limit=settings.ROUTING_TIME_LIMIT_MS / 1000,
+    )
+    elapsed = time.perf_counter() - started
+
+    route = []
+    for point in tour:
+        city_id, kind, index = points[point]
+        item = {'city': city_id, 'city_name': cities[city_id][1], 'action': kind}
+        if index is not None:
+            item['stop'] = index
+            if 'order' in stops[index]:
+                item['order'] = stops[index]['order']
+        route.append(item)
+    return {
+        'route': route,
+        'distance_km': round(length, 3),
+        'initial_distance_km': round(initial, 3),
+        'solve_ms': round(elapsed * 1000, 1),
+    }
+
+
+def stops_for_orders(order_ids):
+    """Остановки для заказов: погрузка в city_from, выгрузка в city_to."""
+    orders = {
+        row[0]: row for row in Order.objects.filter(pk__in=order_ids).values_list('order_id', 'city_from_id', 'city_to_id')
+    }
+    missing = [order_id for order_id in order_ids if order_id not in orders]
+    if missing:
+        raise ValidationError({'orders': [f'Order not found: {order_id}' for order_id in missing]})
+    return [{'pickup': orders[order_id][1], 'dropoff': orders[order_id][2], 'order': order_id} for order_id in order_ids]
@@ -0,0 +1,101 @@
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+
+from api import availability, dashboard, events
+from api.models import Order, Shipment
+
+
+def _column(model, field):
+    return connection.ops.quote_name(model._meta.get_field(field).column)
+
+
+def flag_overdue_shipments(now=None):
+    """Все In Progress с arrival_time в прошлом -> Delayed одним UPDATE ... RETURNING.
+
+    Идёт по индексу shipment_status_arrival_idx (status, arrival_time) и трогает только
+    просроченные строки, размер таблицы на время не влияет. Возвращает
+    [(shipment_id, order_id, client_id, dispatcher_id)] переведённых перевозок."""
+    now = now or timezone.now()
+    table = connection.ops.quote_name(Shipment._meta.db_table)
+    sql = (
+        f'UPDATE {table} SET {_column(Shipment, "status")} = %s, {_column(Shipment, "updated_at")} = %s '
+        f'WHERE {_column(Shipment, "status")} = %s AND {_column(Shipment, "arrival_time")} < %s '
+        f'RETURNING {_column(Shipment, "shipment_id")}, {_column(Shipment, "order")}'
+    )
+    moment = connection.ops.adapt_datetimefield_value(now)
+    params = [Shipment.StatusChoices.DELAYED, moment, Shipment.StatusChoices.IN_PROGRESS, moment]
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            updated = [
+                (Shipment._meta.pk.to_python(shipment_id), Order._meta.pk.to_python(order_id))
+                for shipment_id, order_id in cursor.fetchall()
+            ]
+        if not updated:
+            return []
+        # получатели событий (клиент и диспетчер заказа) - одним запросом на всю пачку
+        recipients = {
+            order_id: (client_id, dispatcher_id)
+            for order_id, client_id, dispatcher_id in Order.objects.filter(
+                pk__in=[order_id for _, order_id in updated],
+            ).values_list('pk', 'client_id', 'dispatcher_id')
+        }
+        rows = [(shipment_id, order_id, *recipients[order_id]) for shipment_id, order_id in updated]
+        # остальные заказы сборных рейсов тоже узнают о задержке
+        consolidated = list(
+            Order.objects.filter(consolidated_shipment__in=[shipment_id for shipment_id, _ in updated])
+            .exclude(pk__in=recipients)
+            .values_list('consolidated_shipment_id', 'pk', 'client_id', 'dispatcher_id')
+        )
+        dashboard.record(dashboard.shipment_transition(
+            Shipment.StatusChoices.IN_PROGRESS, Shipment.StatusChoices.DELAYED, len(rows),
+        ))
+        events.shipments_changed(rows + consolidated, Shipment.StatusChoices.DELAYED)
+    return rows
+
+
+class Scheduler:
+    """Периодические задачи в одном процессе: jobs - [(name, interval_seconds, func)].
+
+    Задачи идемпотентны (условный UPDATE), поэтому два параллельных планировщика
+    не сделают работу дважды - второй просто не найдёт строк."""
+
+    def __init__(self, jobs, on_result=None):
+        self.jobs = jobs
+        self.on_result = on_result
+        self.next_run = {name: 0.0 for name, _, _ in jobs}
+        self.stopped = False
+
+    def stop(self, *args):
+        self.stopped = True
+
+    def run_pending(self):
+        for name, interval, func in self.jobs:
+            if time.monotonic() < self.next_run[name]:
+                continue
+            started = time.perf_counter()
+            result = func()
+            if self.on_result is not None:
+                self.on_result(name, result, time.perf_counter() - started)
+            self.next_run[name] = time.monotonic() + interval
+
+    def run_forever(self):
+        while not self.stopped:
+            # как между запросами: упавшее или устаревшее по CONN_MAX_AGE соединение переоткрывается
+            close_old_connections()
+            self.run_pending()
+            wait = min(self.next_run.values()) - time.monotonic()
+            # короткими шагами, чтобы SIGTERM не ждал весь интервал
+            while wait > 0 and not self.stopped:
+                time.sleep(min(wait, 1))
+                wait -= 1
+
+
+def default_jobs():
+    return [
+        ('flag_overdue_shipments', settings.SCHEDULER_OVERDUE_SECONDS, flag_overdue_shipments),
+        ('sync_availability', settings.SCHEDULER_AVAILABILITY_SECONDS, availability.sync_all),
+    ]
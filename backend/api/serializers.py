@@ -1,8 +1,15 @@
 # backend/yourapp/serializers.py
+from datetime import timedelta
+
 from rest_framework import serializers
+from django.conf import settings
+from django.utils import timezone
 from django.contrib.auth import get_user_model
+from django.db import models
 from rest_framework.authtoken.models import Token
-from .models import Order, City, Driver, Vehicle, Shipment, CustomUser
+from .models import Order, City, Driver, Vehicle, Shipment, CustomUser, Downtime
+from .analytics import MAX_WINDOW
+from .distances import prefetch_route_distances
 
 User = get_user_model()
 
@@ -43,7 +50,15 @@ class UserSerializer(serializers.ModelSerializer):
         return value
 
     def create(self, validated_data):
-        user = CustomUser.objects.create_user(**validated_data)
+        # RegisterView передаёт уже готовый хэш (считается в пуле, см. api/hashing.py)
+        password_hash = validated_data.pop('password_hash', None)
+        if password_hash is None:
+            user = CustomUser.objects.create_user(**validated_data)
+        else:
+            validated_data.pop('password')
+            validated_data['email'] = CustomUser.objects.normalize_email(validated_data['email'])
+            validated_data['username'] = CustomUser.normalize_username(validated_data['username'])
+            user = CustomUser.objects.create(password=password_hash, **validated_data)
         Token.objects.create(user=user)
         return user
 
@@ -54,12 +69,34 @@ class LoginSerializer(serializers.Serializer):
 
 ## Orders
 
+class OrderListSerializer(serializers.ListSerializer):
+    # distance_km всей страницы - одним вызовом матрицы, а не по вызову на строку
+    def route_orders(self, items):
+        return items
+
+    def to_representation(self, data):
+        items = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        prefetch_route_distances(self.route_orders(items))
+        return super().to_representation(items)
+
+
+class ShipmentListSerializer(OrderListSerializer):
+    def route_orders(self, items):
+        return [shipment.order for shipment in items]
+
+
 class OrderSerializer(serializers.ModelSerializer):
     # Для клиента: только создание и просмотр
+    distance_km = serializers.FloatField(source='route_distance_km', read_only=True, allow_null=True)
+
     class Meta:
         model = Order
-        fields = ('order_id', 'weight', 'volume', 'status', 'city_from', 'city_to', 'created_at')
-        read_only_fields = ('order_id', 'status', 'created_at')
+        fields = (
+            'order_id', 'weight', 'volume', 'status', 'city_from', 'city_to', 'distance_km',
+            'consolidated_shipment', 'created_at', 'updated_at',
+        )
+        read_only_fields = ('order_id', 'status', 'consolidated_shipment', 'created_at', 'updated_at')
+        list_serializer_class = OrderListSerializer
 
     def create(self, validated_data):
         # client будет установлен в ViewSet.perform_create
@@ -68,17 +105,20 @@ class OrderSerializer(serializers.ModelSerializer):
 class DispatcherOrderSerializer(serializers.ModelSerializer):
     # Поля для диспетчера: можно видеть client, city_from, city_to, weight, volume, status, driver, vehicle
     client = UserSerializer(read_only=True)
+    distance_km = serializers.FloatField(source='route_distance_km', read_only=True, allow_null=True)
+
     class Meta:
         model = Order
         fields = (
             'order_id', 'client', 'weight', 'volume',
-            'status', 'city_from', 'city_to',
-            'dispatcher', 'created_at',
+            'status', 'city_from', 'city_to', 'distance_km',
+            'dispatcher', 'consolidated_shipment', 'created_at', 'updated_at',
         )
         read_only_fields = (
             'order_id', 'client', 'weight', 'volume',
-            'city_from', 'city_to', 'dispatcher', 'created_at'
+            'city_from', 'city_to', 'dispatcher', 'consolidated_shipment', 'created_at', 'updated_at'
         )
+        list_serializer_class = OrderListSerializer
 
     def validate(self, data):
         order = self.instance
@@ -94,15 +134,150 @@ class DispatcherOrderSerializer(serializers.ModelSerializer):
         return data
 
 class DispatcherAcceptSerializer(serializers.Serializer):
-    order_id = serializers.UUIDField()
+    # заказ берётся из URL
+    order_id = serializers.UUIDField(required=False)
     driver = serializers.UUIDField()
     vehicle = serializers.CharField(max_length=9)
+    # по умолчанию рейс начинается сейчас; будущий рейс не мешает назначениям до него
+    departure_time = serializers.DateTimeField(required=False)
     arrival_time = serializers.DateTimeField()
     price = serializers.DecimalField(max_digits=10, decimal_places=3)
 
 
 class DispatcherRejectSerializer(serializers.Serializer):
-    order_id = serializers.UUIDField()
+    order_id = serializers.UUIDField(required=False)
+
+class DispatcherBulkAcceptSerializer(serializers.Serializer):
+    order = serializers.UUIDField()
+    driver = serializers.UUIDField()
+    vehicle = serializers.CharField(max_length=9)
+    # по умолчанию рейс начинается сейчас; будущий рейс не мешает назначениям до него
+    departure_time = serializers.DateTimeField(required=False)
+    arrival_time = serializers.DateTimeField()
+    price = serializers.DecimalField(max_digits=10, decimal_places=3)
+
+
+class DispatcherBulkRejectSerializer(serializers.Serializer):
+    order = serializers.UUIDField()
+
+
+class DispatcherConsolidateSerializer(serializers.Serializer):
+    # сборный рейс: заказы одного маршрута в одну машину, перевозка - на первый из них
+    orders = serializers.ListField(
+        child=serializers.UUIDField(), min_length=1, max_length=settings.BULK_ACTION_MAX_ITEMS,
+    )
+    driver = serializers.UUIDField()
+    vehicle = serializers.CharField(max_length=9)
+    departure_time = serializers.DateTimeField(required=False)
+    arrival_time = serializers.DateTimeField()
+    price = serializers.DecimalField(max_digits=10, decimal_places=3)
+
+
+class ExportParamsSerializer(serializers.Serializer):
+    # не format: этот параметр DRF использует для выбора рендерера
+    output = serializers.ChoiceField(choices=('csv', 'ndjson'), default='csv')
+    created_after = serializers.DateTimeField(required=False)
+    created_before = serializers.DateTimeField(required=False)
+
+
+class BulkImportSerializer(serializers.Serializer):
+    # CSV с заголовком, JSON-массив или NDJSON (.json / .ndjson / .jsonl)
+    file = serializers.FileField()
+    skip_errors = serializers.BooleanField(default=False)
+
+
+class CityDistanceSerializer(serializers.Serializer):
+    city_from = serializers.UUIDField()
+    city_to = serializers.UUIDField()
+
+
+class CitySearchSerializer(serializers.Serializer):
+    # Центр поиска: либо город, либо координаты
+    city = serializers.UUIDField(required=False)
+    lat = serializers.FloatField(required=False, min_value=-90, max_value=90)
+    lon = serializers.FloatField(required=False, min_value=-180, max_value=180)
+    radius = serializers.FloatField(required=False, min_value=0, max_value=20038)
+    k = serializers.IntegerField(required=False, default=10, min_value=1, max_value=1000)
+    limit = serializers.IntegerField(required=False, default=100, min_value=1, max_value=1000)
+    source = serializers.ChoiceField(choices=('index', 'db'), default='index')
+
+    def validate(self, data):
+        if 'city' in data:
+            try:
+                city = City.objects.get(pk=data['city'])
+            except City.DoesNotExist:
+                raise serializers.ValidationError({'city': 'City not found'})
+            data['lat'], data['lon'] = float(city.latitude), float(city.longitude)
+        elif 'lat' not in data or 'lon' not in data:
+            raise serializers.ValidationError('Either city or lat and lon are required')
+        return data
+
+
+class RouteAnalyticsParamsSerializer(serializers.Serializer):
+    # по умолчанию - последние 30 дней; точность окна - час
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+    city_from = serializers.UUIDField(required=False)
+    city_to = serializers.UUIDField(required=False)
+    limit = serializers.IntegerField(required=False, default=100, min_value=1, max_value=1000)
+
+    def validate(self, data):
+        data.setdefault('until', timezone.now())
+        data.setdefault('since', data['until'] - timedelta(days=30))
+        if data['since'] >= data['until']:
+            raise serializers.ValidationError('since must be earlier than until')
+        if data['until'] - data['since'] > MAX_WINDOW:
+            raise serializers.ValidationError(f'Window is limited to {MAX_WINDOW.days} days')
+        return data
+
+
+class RouteStopSerializer(serializers.Serializer):
+    pickup = serializers.UUIDField()
+    dropoff = serializers.UUIDField()
+
+
+class RoutePlanSerializer(serializers.Serializer):
+    # остановки - явно парами городов или заказами (city_from -> city_to)
+    start = serializers.UUIDField(required=False)
+    stops = RouteStopSerializer(many=True, required=False, min_length=1)
+    orders = serializers.ListField(child=serializers.UUIDField(), required=False, min_length=1)
+
+    def validate(self, data):
+        if ('stops' in data) == ('orders' in data):
+            raise serializers.ValidationError('Either stops or orders is required')
+        points = 2 * len(data.get('stops') or data.get('orders')) + ('start' in data)
+        if points > settings.ROUTING_MAX_STOPS:
+            raise serializers.ValidationError(f'Route is limited to {settings.ROUTING_MAX_STOPS} stops')
+        return data
+
+
+class FreeWindowSerializer(serializers.Serializer):
+    free_from = serializers.DateTimeField()
+    free_to = serializers.DateTimeField()
+
+    def validate(self, data):
+        if data['free_from'] >= data['free_to']:
+            raise serializers.ValidationError('free_from must be earlier than free_to')
+        return data
+
+
+class DowntimeSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Downtime
+        fields = ('id', 'driver', 'vehicle', 'start', 'end', 'reason')
+        read_only_fields = ('id',)
+
+    def validate(self, data):
+        driver = data.get('driver', getattr(self.instance, 'driver', None))
+        vehicle = data.get('vehicle', getattr(self.instance, 'vehicle', None))
+        if (driver is None) == (vehicle is None):
+            raise serializers.ValidationError('Exactly one of driver and vehicle is required')
+        start = data.get('start', getattr(self.instance, 'start', None))
+        end = data.get('end', getattr(self.instance, 'end', None))
+        if start >= end:
+            raise serializers.ValidationError('start must be earlier than end')
+        return data
+
 
 class DispatcherDeliverSerializer(serializers.Serializer):
     shipment_id = serializers.UUIDField()
@@ -140,9 +315,10 @@ class DispatcherShipmentSerializer(serializers.ModelSerializer):
     class Meta:
         model =  Shipment
         fields = '__all__'
+        list_serializer_class = ShipmentListSerializer
         read_only_fields = (
             'shipment_id', 'order', 'driver',
-            'vehicle', 'price', 'arrival_time', 'review_rating',
+            'vehicle', 'price', 'departure_time', 'arrival_time', 'review_rating',
             'review_text', 'review_created_at'
         )
 
@@ -152,6 +328,6 @@ class ClientShipmentSerializer(serializers.ModelSerializer):
         fields = '__all__'
         read_only_fields = (
             'shipment_id', 'order', 'driver',
-            'vehicle', 'price', 'arrival_time', 'status'
+            'vehicle', 'price', 'departure_time', 'arrival_time', 'status'
         )
 
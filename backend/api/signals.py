@@ -0,0 +1,79 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from rest_framework.authtoken.models import Token
+
+from api.authentication import invalidate_user_tokens
+from api.caching import invalidate_cities
+from api.distances import distance_matrix
+from api.matching import fleet_index
+from api.models import City, CustomUser, Driver, Order, Vehicle
+from api.spatial import city_index
+
+
+# Индекс парка, как и городов, обновляем только после коммита: откат не должен оставлять в нём ресурс
+@receiver(post_save, sender=Driver)
+def driver_saved(sender, instance, **kwargs):
+    transaction.on_commit(lambda: fleet_index.upsert_driver(instance))
+
+
+@receiver(post_delete, sender=Driver)
+def driver_deleted(sender, instance, **kwargs):
+    driver_id = instance.pk
+    transaction.on_commit(lambda: fleet_index.remove_driver(driver_id))
+
+
+@receiver(post_save, sender=Vehicle)
+def vehicle_saved(sender, instance, **kwargs):
+    transaction.on_commit(lambda: fleet_index.upsert_vehicle(instance))
+
+
+@receiver(post_delete, sender=Vehicle)
+def vehicle_deleted(sender, instance, **kwargs):
+    plate = instance.pk
+    transaction.on_commit(lambda: fleet_index.remove_vehicle(plate))
+
+
+# Индекс и кэш городов трогаем только после коммита: откат не должен оставлять в них город.
+# Матрицу расстояний обновляет воркер очереди задач - задача пишется в той же транзакции
+@receiver(post_save, sender=City)
+def city_saved(sender, instance, **kwargs):
+    distance_matrix.queue_cities([instance.pk])
+
+    def update():
+        city_index.upsert_city(instance)
+        invalidate_cities()
+    transaction.on_commit(update)
+
+
+@receiver(post_delete, sender=City)
+def city_deleted(sender, instance, **kwargs):
+    city_id = instance.pk
+    distance_matrix.queue_cities([city_id])
+
+    def update():
+        city_index.remove_city(city_id)
+        invalidate_cities()
+    transaction.on_commit(update)
+
+
+# Новый маршрут заказа попадает в матрицу расстояний через воркер, известный - ничего не стоит
+@receiver(post_save, sender=Order)
+def order_saved(sender, instance, created, **kwargs):
+    if created:
+        distance_matrix.queue_routes([(instance.city_from_id, instance.city_to_id)])
+
+
+# Любое изменение пользователя (пароль, роль, is_active) и удаление токена
+# сбрасывают закэшированную аутентификацию во всех процессах
+@receiver(post_save, sender=CustomUser)
+def user_saved(sender, instance, **kwargs):
+    user_id = instance.pk
+    transaction.on_commit(lambda: invalidate_user_tokens(user_id))
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    user_id = instance.user_id
+    transaction.on_commit(lambda: invalidate_user_tokens(user_id))
@@ -0,0 +1,207 @@
+import math
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Q
+from scipy.spatial import cKDTree
+
+from api.geo import EARTH_RADIUS_KM, haversine
+from api.models import City
+
+
+# Сколько изменений копим в буфере, прежде чем перестроить дерево целиком
+REBUILD_THRESHOLD = 256
+
+
+def to_unit_vectors(latitudes, longitudes):
+    """Точки на единичной сфере: евклидова (хордовая) близость монотонна расстоянию по дуге."""
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lon = np.radians(np.asarray(longitudes, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+def chord_for(radius_km):
+    return 2 * math.sin(min(radius_km / EARTH_RADIUS_KM, math.pi) / 2)
+
+
+def arc_for(chord):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(np.asarray(chord) / 2, 0.0, 1.0))
+
+
+class CityIndex:
+    """KD-дерево по городам (3D-векторы на единичной сфере, без проблем с полюсами и 180-м меридианом).
+
+    Записи не перестраивают дерево сразу: новые/перемещённые города попадают в маленький
+    буфер, который просматривается перебором, а старые позиции помечаются удалёнными.
+    Дерево перестраивается, когда буфер вырастает до REBUILD_THRESHOLD, и целиком
+    перечитывается из БД не чаще раза в CITY_INDEX_REFRESH_SECONDS."""
+
+    def __init__(self, refresh_interval=None):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.RLock()
+        self._loaded_at = None
+        self._build([])
+
+    def _refresh_interval(self):
+        if self.refresh_interval is not None:
+            return self.refresh_interval
+        return getattr(settings, 'CITY_INDEX_REFRESH_SECONDS', 300)
+
+    def _build(self, cities):
+        # cities: [(city_id, city_name, latitude, longitude)]
+        self._cities = {city[0]: city for city in cities}
+        self._ids = [city[0] for city in cities]
+        points = to_unit_vectors([city[2] for city in cities], [city[3] for city in cities])
+        self._tree = cKDTree(points) if cities else None
+        self._removed = set()  # позиции в дереве, которые больше не актуальны
+        self._positions = {city_id: i for i, city_id in enumerate(self._ids)}
+        self._extra = {}  # city_id -> unit vector, города вне дерева
+
+    def ensure_loaded(self):
+        with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at > self._refresh_interval():
+                self.load()
+
+    def load(self):
+        cities = list(City.objects.values_list('city_id', 'city_name', 'latitude', 'longitude'))
+        with self._lock:
+            self._build(cities)
+            self._loaded_at = time.monotonic()
+
+    def _rebuild(self):
+        self._build(list(self._cities.values()))
+
+    # Инкрементальные обновления
+
+    def _detach(self, city_id):
+        position = self._positions.pop(city_id, None)
+        if position is not None:
+            self._removed.add(position)
+        self._extra.pop(city_id, None)
+
+    def upsert_city(self, city):
+        self.upsert_cities([city])
+
+    def upsert_cities(self, cities):
+        # пачка (импорт) перестраивает дерево не больше одного раза
+        if self._loaded_at is None:
+            return
+        points = to_unit_vectors([city.latitude for city in cities], [city.longitude for city in cities])
+        with self._lock:
+            for city, point in zip(cities, points):
+                self._detach(city.pk)
+                self._cities[city.pk] = (city.pk, city.city_name, city.latitude, city.longitude)
+                self._extra[city.pk] = point
+            if len(self._extra) + len(self._removed) >= REBUILD_THRESHOLD:
+                self._rebuild()
+
+    def remove_city(self, city_id):
+        with self._lock:
+            self._detach(city_id)
+            self._cities.pop(city_id, None)
+
+    # Запросы
+
+    def _extra_points(self):
+        ids = list(self._extra)
+        points = np.array([self._extra[city_id] for city_id in ids]).reshape(len(ids), 3)
+        return ids, points
+
+    def _result(self, found, limit):
+        found.sort(key=lambda item: item[1])
+        return [
+            {
+                'city_id': city_id, 'city_name': self._cities[city_id][1],
+                'latitude': self._cities[city_id][2], 'longitude': self._cities[city_id][3],
+                'distance_km': round(float(distance), 3),
+            }
+            for city_id, distance in found[:limit]
+        ]
+
+    def nearby(self, latitude, longitude, radius_km, limit=100, exclude=None):
+        """Города в радиусе radius_km, ближайшие первыми."""
+        self.ensure_loaded()
+        point = to_unit_vectors([latitude], [longitude])[0]
+        chord = chord_for(radius_km)
+        found = []
+        with self._lock:
+            if self._tree is not None:
+                positions = [i for i in self._tree.query_ball_point(point, chord) if i not in self._removed]
+                if positions:
+                    chords = np.linalg.norm(self._tree.data[positions] - point, axis=1)
+                    found.extend(zip((self._ids[i] for i in positions), arc_for(chords)))
+            ids, points = self._extra_points()
+            if ids:
+                chords = np.linalg.norm(points - point, axis=1)
+                found.extend((ids[i], arc_for(chords[i])) for i in np.flatnonzero(chords <= chord))
+            found = [item for item in found if item[0] != exclude]
+            return self._result(found, limit)
+
+    def nearest(self, latitude, longitude, k=10, exclude=None):
+        """k ближайших городов."""
+        self.ensure_loaded()
+        point = to_unit_vectors([latitude], [longitude])[0]
+        found = []
+        with self._lock:
+            if self._tree is not None:
+                # удалённые позиции и исключённый город могут занять часть из k мест - берём с запасом
+                want = min(k + len(self._removed) + 1, self._tree.n)
+                chords, positions = self._tree.query(point, k=want)
+                chords, positions = np.atleast_1d(chords), np.atleast_1d(positions)
+                found.extend(
+                    (self._ids[i], arc_for(c)) for c, i in zip(chords, positions)
+                    if i < self._tree.n and i not in self._removed
+                )
+            ids, points = self._extra_points()
+            if ids:
+                chords = np.linalg.norm(points - point, axis=1)
+                found.extend(zip(ids, arc_for(chords)))
+            found = [item for item in found if item[0] != exclude]
+            return self._result(found, k)
+
+
+city_index = CityIndex()
+
+
+def nearby_from_db(latitude, longitude, radius_km, limit=100, exclude=None):
+    """Тот же поиск по радиусу без in-memory индекса: bounding box по индексу
+    city_coordinates_idx в БД, затем точное расстояние по haversine."""
+    dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    queryset = City.objects.filter(latitude__gte=max(latitude - dlat, -90), latitude__lte=min(latitude + dlat, 90))
+    max_abs_lat = abs(latitude) + dlat
+    if max_abs_lat < 90:
+        dlon = math.degrees(
+            math.asin(min(math.sin(radius_km / EARTH_RADIUS_KM) / math.cos(math.radians(latitude)), 1.0))
+        ) if radius_km / EARTH_RADIUS_KM < math.pi / 2 else 180
+        if dlon < 180:
+            west, east = longitude - dlon, longitude + dlon
+            if west < -180:
+                lon_filter = Q(longitude__gte=west + 360) | Q(longitude__lte=east)
+            elif east > 180:
+                lon_filter = Q(longitude__gte=west) | Q(longitude__lte=east - 360)
+            else:
+                lon_filter = Q(longitude__gte=west, longitude__lte=east)
+            queryset = queryset.filter(lon_filter)
+    if exclude is not None:
+        queryset = queryset.exclude(pk=exclude)
+
+    rows = list(queryset.values_list('city_id', 'city_name', 'latitude', 'longitude'))
+    if not rows:
+        return []
+    distances = haversine(
+        latitude, longitude, [row[2] for row in rows], [row[3] for row in rows],
+    )
+    found = sorted(
+        ((row, distance) for row, distance in zip(rows, distances) if distance <= radius_km),
+        key=lambda item: item[1],
+    )
+    return [
+        {
+            'city_id': row[0], 'city_name': row[1], 'latitude': row[2], 'longitude': row[3],
+            'distance_km': round(float(distance), 3),
+        }
+        for row, distance in found[:limit]
+    ]
@@ -0,0 +1,163 @@
+import threading
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+from django.utils import timezone
+
+from api.models import DeadTask, Task
+
+
+_handlers = {}
+
+
+def handler(name):
+    """Регистрирует обработчик задачи: @handler('events.publish') def publish(**payload)."""
+    def register(func):
+        _handlers[name] = func
+        return func
+    return register
+
+
+def get_handler(name):
+    return _handlers[name]
+
+
+def call(name, **payload):
+    return Task(name=name, payload=payload)
+
+
+def enqueue(*calls, delay=None):
+    """Ставит задачи (см. call) в очередь одним INSERT в текущей транзакции.
+
+    Сколько бы побочных эффектов ни висело на переходе, запрос платит за один
+    INSERT, а сама работа выполняется воркерами после коммита."""
+    run_after = timezone.now() + (delay or timedelta(0))
+    for task in calls:
+        task.run_after = run_after
+    Task.objects.bulk_create(calls)
+    transaction.on_commit(task_pool.wake)
+
+
+def retry_delay(attempts):
+    """Экспоненциальная задержка перед повтором: 2, 4, 8 ... TASKS_RETRY_BASE_SECONDS, не больше TASKS_RETRY_MAX_SECONDS."""
+    return timedelta(seconds=min(settings.TASKS_RETRY_BASE_SECONDS * 2 ** (attempts - 1), settings.TASKS_RETRY_MAX_SECONDS))
+
+
+def _fail(task, error, now):
+    task.attempts += 1
+    if task.attempts >= settings.TASKS_MAX_ATTEMPTS or task.name not in _handlers:
+        DeadTask.objects.create(
+            name=task.name, payload=task.payload, attempts=task.attempts, error=error, created_at=task.created_at,
+        )
+        task.delete()
+        return
+    task.run_after = now + retry_delay(task.attempts)
+    task.last_error = error
+    task.save(update_fields=['attempts', 'run_after', 'last_error'])
+
+
+def run_batch(limit=None):
+    """Забирает до TASKS_BATCH_SIZE готовых задач и выполняет их. Возвращает (выполнено, упало).
+
+    Всё в одной транзакции: строки заблокированы до конца пачки, параллельные воркеры
+    их пропускают (SKIP LOCKED) и берут следующие. Каждая задача - в своей точке
+    сохранения, поэтому её изменения в БД фиксируются вместе с удалением задачи:
+    для БД-эффектов это ровно один раз, для внешних (публикация событий) - хотя бы один."""
+    now = timezone.now()
+    done = failed = 0
+    with transaction.atomic():
+        tasks = list(
+            Task.objects.select_for_update(skip_locked=True)
+            .filter(run_after__lte=now)
+            .order_by('run_after', 'id')[:limit or settings.TASKS_BATCH_SIZE]
+        )
+        for task in tasks:
+            func = _handlers.get(task.name)
+            try:
+                if func is None:
+                    raise LookupError(f'Unknown task {task.name}')
+                with transaction.atomic():
+                    func(**task.payload)
+            except Exception:
+                _fail(task, traceback.format_exc(), now)
+                failed += 1
+            else:
+                task.delete()
+                done += 1
+    return done, failed
+
+
+def run_pending():
+    """Выполняет всё, что готово сейчас (для тестов и run_tasks --once)."""
+    done = failed = 0
+    while True:
+        batch_done, batch_failed = run_batch()
+        done += batch_done
+        failed += batch_failed
+        if not batch_done and not batch_failed:
+            return done, failed
+
+
+def requeue_dead(ids=None):
+    """Возвращает задачи из DeadTask в очередь с обнулённым счётчиком попыток."""
+    dead = DeadTask.objects.all() if ids is None else DeadTask.objects.filter(pk__in=ids)
+    with transaction.atomic():
+        tasks = [Task(name=task.name, payload=task.payload, run_after=timezone.now()) for task in dead]
+        Task.objects.bulk_create(tasks)
+        dead.delete()
+    return len(tasks)
+
+
+class TaskWorkerPool:
+    """Потоки-воркеры очереди задач внутри процесса.
+
+    Воркер спит TASKS_POLL_SECONDS между пустыми проходами; задача, поставленная
+    в этом же процессе, будит его сразу после коммита (enqueue -> wake). Задачи других
+    процессов подхватываются на следующем опросе."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self, workers=None):
+        with self._lock:
+            if self._threads:
+                return
+            self._stopped.clear()
+            for i in range(settings.TASKS_WORKERS if workers is None else workers):
+                thread = threading.Thread(target=self._run, name=f'task-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stop(self, *args):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _run(self):
+        while not self._stopped.is_set():
+            close_old_connections()
+            try:
+                done, failed = run_batch()
+            except DatabaseError:
+                # БД недоступна или занята ("database is locked" в SQLite) - повторим на следующем опросе
+                done = failed = 0
+            if done or failed:
+                continue
+            self._wakeup.wait(settings.TASKS_POLL_SECONDS)
+            self._wakeup.clear()
+        close_old_connections()
+
+
+task_pool = TaskWorkerPool()
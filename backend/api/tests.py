@@ -1,3 +1,1852 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import json
+import shutil
+import tempfile
+from base64 import b64decode, b64encode
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from pathlib import Path
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlencode, urlsplit
+from uuid import uuid4
 
-# Create your tests here.
+import numpy as np
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from drf_spectacular.drainage import GENERATOR_STATS
+from drf_spectacular.generators import SchemaGenerator
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient, APIRequestFactory, APITestCase
+
+from api.authentication import token_cache
+from api import availability, booking, consolidation, dashboard, events, planner, routing, scheduler, tasks
+from api.distances import distance_matrix
+from api.hashing import HashingPoolBusy, hashing_pool
+from api.matching import LICENCE_CATEGORIES, fleet_index
+from api.pagination import CreatedAtCursorPagination
+from api.spatial import city_index
+from api.models import City, CustomUser, DashboardCounter, DeadTask, Downtime, Driver, Order, Shipment, Task, Vehicle
+
+
+# Сколько SQL-запросов может сделать эндпоинт (включая проверку токена).
+# Число не должно зависеть от размера страницы.
+# 3 = токен + агрегат для ETag/Last-Modified + данные.
+QUERY_BUDGETS = {
+    'client-orders-list': 3,
+    'client-orders-detail': 3,
+    'dispatcher-orders-list': 3,
+    'dispatcher-orders-detail': 3,
+    'dispatcher-shipments-list': 3,
+    'dispatcher-shipments-detail': 3,
+    'client-shipments-list': 3,
+    'client-shipments-detail': 3,
+    'driver-list': 3,
+    'driver-detail': 3,
+    'vehicle-list': 3,
+    'vehicle-detail': 3,
+    'city-list': 2,
+    'city-detail': 2,
+}
+
+
+def make_client(n=0):
+    return CustomUser.objects.create_user(
+        email=f'client{n}@example.com', username=f'client{n}',
+        password='clientpassword', role=CustomUser.RoleChoices.CLIENT,
+    )
+
+
+def make_dispatcher(n=0):
+    return CustomUser.objects.create_user(
+        email=f'dispatcher{n}@example.com', username=f'dispatcher{n}',
+        password='dispatcherpassword', role=CustomUser.RoleChoices.DISPATCHER,
+    )
+
+
+def make_driver(n=0, **kwargs):
+    licences = dict(B=True, BE=False, C=True, C1=False, CE=False, C1E=False)
+    licences.update(kwargs)
+    return Driver.objects.create(first_name=f'Ivan{n}', last_name='Petrov', **licences)
+
+
+def make_vehicle(n=0, **kwargs):
+    fields = dict(transport_type='C', max_weight=10000, max_volume=40)
+    fields.update(kwargs)
+    return Vehicle.objects.create(license_plate=f'A{n:03d}AA77', **fields)
+
+
+class DistanceMatrixDirMixin:
+    # у каждого класса тестов своя матрица во временном каталоге
+    @classmethod
+    def setUpClass(cls):
+        cls.distance_dir = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, cls.distance_dir, ignore_errors=True)
+        override = override_settings(DISTANCE_MATRIX_DIR=cls.distance_dir)
+        override.enable()
+        cls.addClassCleanup(override.disable)
+        super().setUpClass()
+
+
+class QueryBudgetTests(DistanceMatrixDirMixin, APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.client_user = make_client()
+        cls.dispatcher = make_dispatcher()
+        cls.city_from = City.objects.create(city_name='Moscow', latitude='55.755800', longitude='37.617300')
+        cls.city_to = City.objects.create(city_name='Kazan', latitude='55.796100', longitude='49.106100')
+        distance_matrix.rebuild()
+
+    def add_shipments(self, count):
+        start = Shipment.objects.count()
+        for i in range(start, start + count):
+            order = Order.objects.create(
+                weight=100, volume=1, client=self.client_user, dispatcher=self.dispatcher,
+                city_from=self.city_from, city_to=self.city_to,
+                status=Order.StatusChoices.CONFIRMED,
+            )
+            Shipment.objects.create(
+                order=order, driver=make_driver(i), vehicle=make_vehicle(i),
+                arrival_time=timezone.now() + timedelta(days=1), price=1000,
+            )
+
+    def login(self, user):
+        token, _ = Token.objects.get_or_create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+    def count_queries(self, url):
+        # бюджет считаем для промаха кэша
+        cache.clear()
+        token_cache.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        return len(ctx.captured_queries)
+
+    def check_budget(self, user, name, detail_object):
+        self.login(user)
+        list_url = reverse(f'{name}-list')
+        sizes = []
+        for count in (1, 20):
+            self.add_shipments(count)
+            sizes.append(self.count_queries(list_url))
+        self.assertEqual(sizes[0], sizes[1], f'{name}-list: N+1 ({sizes})')
+        self.assertLessEqual(sizes[1], QUERY_BUDGETS[f'{name}-list'], name)
+
+        detail_url = reverse(f'{name}-detail', args=[detail_object().pk])
+        self.assertLessEqual(self.count_queries(detail_url), QUERY_BUDGETS[f'{name}-detail'], name)
+
+    def test_client_orders(self):
+        self.check_budget(self.client_user, 'client-orders', lambda: Order.objects.first())
+
+    def test_dispatcher_orders(self):
+        self.check_budget(self.dispatcher, 'dispatcher-orders', lambda: Order.objects.first())
+
+    def test_dispatcher_shipments(self):
+        self.check_budget(self.dispatcher, 'dispatcher-shipments', lambda: Shipment.objects.first())
+
+    def test_client_shipments(self):
+        self.check_budget(self.client_user, 'client-shipments', lambda: Shipment.objects.first())
+
+    def test_drivers(self):
+        self.check_budget(self.dispatcher, 'driver', lambda: Driver.objects.first())
+
+    def test_vehicles(self):
+        self.check_budget(self.dispatcher, 'vehicle', lambda: Vehicle.objects.first())
+
+    def test_cities(self):
+        self.check_budget(self.client_user, 'city', lambda: City.objects.first())
+
+
+class ExplainCommandTests(DistanceMatrixDirMixin, APITestCase):
+    def test_explains_every_queryset(self):
+        make_client()
+        out = io.StringIO()
+        call_command('explain_querysets', stdout=out)
+        output = out.getvalue()
+        for url in ('client/orders', 'client/shipments', 'dispatcher/orders', 'dispatcher/shipments',
+                    'drivers', 'vehicles', 'cities'):
+            self.assertIn(f'GET /api/{url}/', output)
+        for title in ('Pending orders', 'Available vehicles by capacity', 'Overdue shipments'):
+            self.assertIn(title, output)
+        # под каждым заголовком - SQL и план
+        self.assertGreaterEqual(output.count('SELECT'), 12)
+
+
+class CursorPaginationTests(DistanceMatrixDirMixin, APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.client_user = make_client()
+        city = City.objects.create(city_name='Moscow', latitude='55.755800', longitude='37.617300')
+        cls.orders = [
+            Order.objects.create(weight=1, volume=1, client=cls.client_user, city_from=city, city_to=city)
+            for _ in range(7)
+        ]
+        # у всех заказов одинаковый created_at: порядок держится на pk
+        Order.objects.update(created_at=timezone.now())
+
+    def setUp(self):
+        self.client.force_authenticate(self.client_user)
+
+    def walk(self, url):
+        pages = []
+        while url:
+            data = self.client.get(url).data
+            pages.append(data)
+            url = data['next']
+        return pages
+
+    def test_next_and_previous_with_tied_created_at(self):
+        expected = sorted((order.pk for order in self.orders), reverse=True)
+        pages = self.walk(reverse('client-orders-list') + '?page_size=3')
+        self.assertEqual([len(page['results']) for page in pages], [3, 3, 1])
+        self.assertEqual([item['order_id'] for page in pages for item in page['results']], list(map(str, expected)))
+        self.assertIsNone(pages[0]['previous'])
+
+        # previous со второй страницы возвращает первую
+        back = self.client.get(pages[1]['previous']).data
+        self.assertEqual(back['results'], pages[0]['results'])
+        self.assertIsNone(back['previous'])
+        back = self.client.get(pages[2]['previous']).data
+        self.assertEqual(back['results'], pages[1]['results'])
+        self.assertEqual(self.client.get(back['next']).data['results'], pages[2]['results'])
+
+    def test_page_size_clamped(self):
+        url = reverse('client-orders-list')
+        with patch.object(CreatedAtCursorPagination, 'max_page_size', 4):
+            self.assertEqual(len(self.client.get(url, {'page_size': 100}).data['results']), 4)
+        self.assertEqual(len(self.client.get(url, {'page_size': 2}).data['results']), 2)
+        # некорректный page_size - размер по умолчанию
+        self.assertEqual(len(self.client.get(url, {'page_size': 'x'}).data['results']), 7)
+
+    def test_tampered_cursor_is_not_found(self):
+        url = reverse('client-orders-list')
+        real = json.loads(parse_qs(b64decode(parse_qs(urlsplit(
+            self.client.get(url, {'page_size': 3}).data['next'],
+        ).query)['cursor'][0]).decode())['p'][0])
+        for position in (
+            ['not-a-date', real[1]],  # created_at не дата
+            [real[0], 'not-a-uuid'],  # pk не UUID
+            [real[0], 42],
+            'not-a-list',
+        ):
+            cursor = b64encode(urlencode({'p': json.dumps(position)}).encode()).decode()
+            response = self.client.get(url, {'cursor': cursor})
+            self.assertEqual(response.status_code, 404, position)
+            self.assertEqual(response.data['detail'], CreatedAtCursorPagination.invalid_cursor_message)
+        cursor = b64encode(urlencode({'p': json.dumps(real)}).encode()).decode()
+        self.assertEqual(len(self.client.get(url, {'cursor': cursor}).data['results']), 4)
+
+
+class ConcurrentAcceptTests(DistanceMatrixDirMixin, TransactionTestCase):
+    ATTEMPTS = 200
+
+    def setUp(self):
+        self.dispatcher = make_dispatcher()
+        client_user = make_client()
+        city = City.objects.create(city_name='Moscow', latitude='55.755800', longitude='37.617300')
+        self.driver = make_driver()
+        self.orders = [
+            Order.objects.create(weight=100, volume=1, client=client_user, city_from=city, city_to=city)
+            for _ in range(self.ATTEMPTS)
+        ]
+        self.vehicles = [make_vehicle(i) for i in range(self.ATTEMPTS)]
+
+    def accept(self, order, vehicle):
+        api = APIClient()
+        api.force_authenticate(self.dispatcher)
+        try:
+            response = api.post(
+                reverse('dispatcher-orders-accept', args=[order.pk]),
+                {
+                    'driver': str(self.driver.pk), 'vehicle': vehicle.pk,
+                    'arrival_time': (timezone.now() + timedelta(days=1)).isoformat(), 'price': '1000',
+                },
+                format='json',
+            )
+            return response.status_code
+        finally:
+            connection.close()
+
+    def test_parallel_accepts_book_driver_once(self):
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            codes = list(pool.map(self.accept, self.orders, self.vehicles))
+
+        self.assertEqual(codes.count(200), 1, codes)
+        self.assertLessEqual(set(codes), {200, 400, 409})
+        self.assertEqual(Shipment.objects.count(), 1)
+        self.assertEqual(Order.objects.filter(status=Order.StatusChoices.CONFIRMED).count(), 1)
+        self.assertEqual(Vehicle.objects.filter(is_available=False).count(), 1)
+        self.driver.refresh_from_db()
+        self.assertFalse(self.driver.is_available)
+
+    def test_deliver_releases_resources_once(self):
+        self.assertEqual(self.accept(self.orders[0], self.vehicles[0]), 200)
+        shipment = Shipment.objects.get()
+        api = APIClient()
+        api.force_authenticate(self.dispatcher)
+        url = reverse('dispatcher-shipments-deliver', args=[shipment.pk])
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            codes = list(pool.map(lambda _: api.post(url).status_code, range(8)))
+        connection.close()
+
+        self.assertEqual(codes.count(200), 1, codes)
+        self.assertLessEqual(set(codes), {200, 400, 409})
+        self.driver.refresh_from_db()
+        self.assertTrue(self.driver.is_available)
+        self.assertTrue(Vehicle.objects.get(pk=self.vehicles[0].pk).is_available)
+
+
+    def test_only_lock_errors_become_conflicts(self):
+        def reject(error):
+            with patch.object(booking, '_pending_order', side_effect=error):
+                booking.reject_order(self.orders[0].pk, self.dispatcher)
+
+        with self.assertRaises(booking.BookingError) as cm:
+            reject(OperationalError('database is locked'))
+        self.assertEqual(cm.exception.status_code, 409)
+        for error in (OperationalError('no such column: x'), IntegrityError('constraint failed')):
+            with self.assertRaises(type(error)):
+                reject(error)
+
+
+class BulkActionTests(DistanceMatrixDirMixin, APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dispatcher = make_dispatcher()
+        client_user = make_client()
+        city = City.objects.create(city_name='Moscow', latitude='55.755800', longitude='37.617300')
+        cls.orders = [
+            Order.objects.create(weight=100, volume=1, client=client_user, city_from=city, city_to=city)
+            for _ in range(12)
+        ]
+        cls.drivers = [make_driver(i) for i in range(12)]
+        cls.vehicles = [make_vehicle(i) for i in range(12)]
+
+    def setUp(self):
+        self.client.force_authenticate(self.dispatcher)
+        self.arrival = timezone.now() + timedelta(days=1)
+
+    def item(self, order, driver, vehicle, **extra):
+        return {'order': str(order), 'driver': str(driver), 'vehicle': vehicle,
+                'arrival_time': self.arrival.isoformat(), 'price': '100', **extra}
+
+    def test_bulk_accept_reports_each_item(self):
+        orders, drivers, vehicles = self.orders, self.drivers, self.vehicles
+        items = [
+            self.item(orders[0].pk, drivers[0].pk, vehicles[0].pk),
+            # тот же заказ второй раз в пачке
+            self.item(orders[0].pk, drivers[1].pk, vehicles[1].pk),
+            self.item(uuid4(), drivers[1].pk, vehicles[1].pk),
+            self.item(orders[1].pk, uuid4(), vehicles[1].pk),
+            # водитель уже занят первым пунктом пачки
+            self.item(orders[2].pk, drivers[0].pk, vehicles[2].pk),
+            self.item(orders[3].pk, drivers[3].pk, vehicles[3].pk, departure_time=self.arrival.isoformat()),
+            self.item(orders[4].pk, drivers[4].pk, vehicles[4].pk),
+        ]
+        response = self.client.post(reverse('dispatcher-orders-bulk-accept'), items, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual([result.get('error') for result in response.data], [
+            None, 'Order not pending', 'Order not found', 'Driver or Vehicle not found',
+            'Driver or Vehicle not available', 'arrival_time must be later than departure_time', None,
+        ])
+        created = dict(Shipment.objects.values_list('order_id', 'pk'))
+        self.assertEqual(set(created), {orders[0].pk, orders[4].pk})
+        self.assertEqual(response.data[0]['shipment'], created[orders[0].pk])
+        self.assertEqual(response.data[6]['shipment'], created[orders[4].pk])
+        statuses = dict(Order.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses[orders[0].pk], Order.StatusChoices.CONFIRMED)
+        self.assertEqual(statuses[orders[1].pk], Order.StatusChoices.PENDING)
+        self.assertEqual(statuses[orders[2].pk], Order.StatusChoices.PENDING)
+
+    def test_bulk_reject_reports_each_item(self):
+        booking.reject_order(self.orders[5].pk, self.dispatcher)
+        items = [{'order': str(order_id)} for order_id in
+                 (self.orders[0].pk, self.orders[0].pk, uuid4(), self.orders[5].pk, self.orders[1].pk)]
+        response = self.client.post(reverse('dispatcher-orders-bulk-reject'), items, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual([result.get('error') for result in response.data],
+                         [None, 'Order not pending', 'Order not found', 'Order not pending', None])
+        self.assertEqual(Order.objects.filter(status=Order.StatusChoices.CANCELLED).count(), 3)
+
+    def count_queries(self, action, size):
+        with transaction.atomic(), CaptureQueriesContext(connection) as queries:
+            action(size)
+            transaction.set_rollback(True)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_batch(self):
+        def accept(size):
+            items = [
+                {'order': order.pk, 'driver': driver.pk, 'vehicle': vehicle.pk,
+                 'arrival_time': self.arrival, 'price': 100}
+                for order, driver, vehicle in list(zip(self.orders, self.drivers, self.vehicles))[:size]
+            ]
+            results = booking.accept_orders(items, self.dispatcher)
+            self.assertTrue(all('shipment' in result for result in results))
+
+        def reject(size):
+            results = booking.reject_orders([order.pk for order in self.orders[:size]], self.dispatcher)
+            self.assertTrue(all('status' in result for result in results))
+
+        for action in (accept, reject):
+            self.assertEqual(self.count_queries(action, 2), self.count_queries(action, 12), action.__name__)
+
+
+class FleetMatchingTests(DistanceMatrixDirMixin, APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dispatcher = make_dispatcher()
+        city = City.objects.create(city_name='Moscow', latitude='55.755800', longitude='37.617300')
+        cls.order = Order.objects.create(weight=1500, volume=5, client=make_client(), city_from=city, city_to=city)
+        cls.van = make_vehicle(0, transport_type='B', max_weight=2000, max_volume=10)
+        cls.truck = make_vehicle(1, transport_type='C', max_weight=10000, max_volume=40)
+        make_vehicle(2, transport_type='B', max_weight=1000, max_volume=10)  # не вмещает груз
+        cls.universal = make_driver(0, B=True, C=True)
+        cls.car_driver = make_driver(1, B=True, C=False)
+        cls.truck_driver = make_driver(2, B=False, C=True)
+
+    def setUp(self):
+        # индекс общий для процесса: начинаем с состояния БД этого теста
+        fleet_index.load()
+        self.client.force_authenticate(self.dispatcher)
+
+    def suggest(self, **params):
+        response = self.client.get(reverse('dispatcher-orders-suggest', args=[self.order.pk]), params)
+        self.assertEqual(response.status_code, 200, response.data)
+        return [(item['driver'], item['vehicle']) for item in response.data['suggestions']]
+
+    def test_suggest_ranks_pairs(self):
+        # сначала самая "тесная" машина и наименее универсальный водитель, без повторов;
+        # затем пары с уже предложенными водителями и машинами
+        self.assertEqual(self.suggest(), [
+            (self.car_driver.pk, self.van.pk), (self.truck_driver.pk, self.truck.pk),
+            (self.universal.pk, self.van.pk), (self.universal.pk, self.truck.pk),
+        ])
+        self.assertEqual(self.suggest(limit=1), [(self.car_driver.pk, self.van.pk)])
+
+    def test_suggest_rechecks_stale_index(self):
+        # update() без сигналов: индекс об этом не знает, перепроверка в БД отсекает водителя
+        Driver.objects.filter(pk=self.car_driver.pk).update(is_available=False)
+        self.assertNotIn(self.car_driver.pk, {driver for driver, _ in self.suggest()})
+        self.assertNotIn(self.car_driver.pk, fleet_index.available_drivers)
+
+        booking.reject_order(self.order.pk, self.dispatcher)
+        response = self.client.get(reverse('dispatcher-orders-suggest', args=[self.order.pk]))
+        self.assertEqual(response.status_code, 400)
+
+    def test_index_follows_commit(self):
+        try:
+            with transaction.atomic():
+                rolled_back = make_driver(3, B=True)
+                Vehicle.objects.filter(pk=self.van.pk).delete()
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertNotIn(rolled_back.pk, fleet_index._drivers)
+        self.assertIn(self.van.pk, fleet_index._vehicles)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            driver = make_driver(4, B=True)
+            Vehicle.objects.filter(pk=self.truck.pk).delete()
+        self.assertIn(driver.pk, fleet_index.available_drivers)
+        self.assertNotIn(self.truck.pk, fleet_index._vehicles)
+
+    def test_refresh_does_not_block_readers(self):
+        read = fleet_index._read
+        during = []
+
+        def slow_read():
+            # пока этот поток читает БД, другие отвечают по старому снимку и пишут изменения
+            with ThreadPoolExecutor(1) as pool:
+                during.append(pool.submit(fleet_index.suggest, 1500, 5).result(timeout=5))
+                pool.submit(
+                    fleet_index.set_availability, drivers=[self.car_driver.pk], available=False,
+                ).result(timeout=5)
+            return read()
+
+        fleet_index._loaded_at -= 3600
+        with patch.object(fleet_index, '_read', side_effect=slow_read):
+            fleet_index.ensure_loaded()
+        self.assertIn((self.car_driver.pk, self.van.pk), [pair[1:] for pair in during[0]])
+        # изменение во время чтения повторено поверх нового снимка
+        self.assertNotIn(self.car_driver.pk, fleet_index.available_drivers)
+        self.assertIn(self.universal.pk, fleet_index.available_drivers)
+
+
+class PlannerTests(DistanceMatrixDirMixin, APITestCase):
+    # Заказы (вес, объём): 0 - (900, 5), 1 - (4000, 20), 2 - (20000, 10), 3 - (500, 2).
+    # Машины: 0 - B 1000/10, 1 - C 5000/30, 2 - CE 30000/80, 3 - B 2000/10.
+    # Водители: один с правами B, один с C; машину CE вести некому.
+    # Заказ 1 влезает только в машину 1, заказ 2 - только в CE. Из двух машин B водитель
+    # один: его получает машина 0 с меньшим недогрузом (заказ 0), заказ 3 остаётся без машины.
+    ORDERS = [(900, 5), (4000, 20), (20000, 10), (500, 2)]
+    VEHICLES = [('B', 1000, 10), ('C', 5000, 30), ('CE', 30000, 80), ('B', 2000, 10)]
+
+    def test_solve(self):
+        order_weights, order_volumes = np.array(self.ORDERS, dtype=np.float64).T
+        vehicle_weights = np.array([row[1] for row in self.VEHICLES], dtype=np.float64)
+        vehicle_volumes = np.array([row[2] for row in self.VEHICLES], dtype=np.float64)
+        vehicle_types = np.array([LICENCE_CATEGORIES.index(row[0]) for row in self.VEHICLES])
+        driver_categories = np.array([[cat == 'B' for cat in LICENCE_CATEGORIES],
+                                      [cat == 'C' for cat in LICENCE_CATEGORIES]])
+
+        order_vehicle, order_driver = planner.solve(
+            order_weights, order_volumes, vehicle_weights, vehicle_volumes, vehicle_types, driver_categories,
+        )
+        self.assertEqual(order_vehicle.tolist(), [0, 1, -1, -1])
+        self.assertEqual(order_driver.tolist(), [0, 1, -1, -1])
+
+    def test_plan_endpoint(self):
+        dispatcher = make_dispatcher()
+        client_user = make_client()
+        city = City.objects.create(city_name='Moscow', latitude='55.755800', longitude='37.617300')
+        orders = []
+        for days, (weight, volume) in enumerate(self.ORDERS):
+            order = Order.objects.create(weight=weight, volume=volume, client=client_user, city_from=city, city_to=city)
+            Order.objects.filter(pk=order.pk).update(created_at=timezone.now() - timedelta(days=10 - days))
+            orders.append(order)
+        vehicles = [
+            make_vehicle(n, transport_type=transport_type, max_weight=max_weight, max_volume=max_volume)
+            for n, (transport_type, max_weight, max_volume) in enumerate(self.VEHICLES)
+        ]
+        b_driver = make_driver(0, B=True, C=False)
+        c_driver = make_driver(1, B=False, C=True)
+
+        self.client.force_authenticate(dispatcher)
+        plan = self.client.get(reverse('dispatcher-orders-plan')).data
+        self.assertEqual(
+            [(item['order'], item['driver'], item['vehicle']) for item in plan['assignments']],
+            [(orders[0].pk, b_driver.pk, vehicles[0].pk), (orders[1].pk, c_driver.pk, vehicles[1].pk)],
+        )
+        self.assertEqual(plan['unassigned'], [orders[2].pk, orders[3].pk])
+        self.assertEqual(plan['assignments'][0]['waste'], 0.6)
+        # план - dry-run: в БД ничего не меняется
+        self.assertFalse(Shipment.objects.exists())
+
+
+class DistanceMatrixTests(DistanceMatrixDirMixin, APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.client_user = make_client()
+        cls.moscow = City.objects.create(city_name='Moscow', latitude='55.755800', longitude='37.617300')
+        cls.kazan = City.objects.create(city_name='Kazan', latitude='55.796100', longitude='49.106100')
+        distance_matrix.rebuild()
+
+    def setUp(self):
+        token, _ = Token.objects.get_or_create(user=self.client_user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+    def test_order_distance(self):
+        order = Order(city_from=self.moscow, city_to=self.kazan, weight=1, volume=1)
+        self.assertAlmostEqual(order.route_distance_km, 719.0, delta=2)
+        with self.assertNumQueries(0):
+            self.assertEqual(order.route_distance_km, distance_matrix.distance(self.kazan.pk, self.moscow.pk))
+
+    def test_city_changes_update_matrix(self):
+        spb = City.objects.create(city_name='Saint Petersburg', latitude='59.938600', longitude='30.314100')
+        # город в матрицу записывает воркер очереди задач
+        self.assertIsNone(distance_matrix.distance(self.moscow.pk, spb.pk))
+        tasks.run_pending()
+        self.assertAlmostEqual(distance_matrix.distance(self.moscow.pk, spb.pk), 634.0, delta=2)
+
+        # новый маршрут заказа - тоже через воркер, дальше расстояние берётся из матрицы без тригонометрии
+        Order.objects.create(weight=1, volume=1, client=self.client_user, city_from=spb, city_to=self.moscow)
+        self.assertEqual(tasks.run_pending(), (1, 0))
+        with patch('api.distances.haversine') as trig:
+            self.assertAlmostEqual(distance_matrix.distance(self.moscow.pk, spb.pk), 634.0, delta=2)
+        trig.assert_not_called()
+        # известный маршрут задач не ставит
+        Order.objects.create(weight=1, volume=1, client=self.client_user, city_from=self.moscow, city_to=spb)
+        self.assertFalse(Task.objects.exists())
+
+        # перемещение пересчитывает маршруты через город
+        spb.latitude, spb.longitude = self.kazan.latitude, self.kazan.longitude
+        spb.save()
+        tasks.run_pending()
+        with patch('api.distances.haversine') as trig:
+            self.assertAlmostEqual(distance_matrix.distance(spb.pk, self.moscow.pk), 719.0, delta=2)
+        trig.assert_not_called()
+
+        spb_id = spb.pk
+        spb.delete()
+        tasks.run_pending()
+        self.assertIsNone(distance_matrix.distance(self.moscow.pk, spb_id))
+
+    def test_list_distances_in_one_call(self):
+        Order.objects.bulk_create([
+            Order(weight=1, volume=1, client=self.client_user, city_from=self.moscow, city_to=self.kazan)
+            for _ in range(5)
+        ])
+        with patch.object(distance_matrix, 'distances', wraps=distance_matrix.distances) as distances:
+            response = self.client.get(reverse('client-orders-list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(distances.call_count, 1)
+        self.assertEqual(len(response.data['results']), 5)
+        for row in response.data['results']:
+            self.assertAlmostEqual(row['distance_km'], 719.0, delta=2)
+
+    def test_growth_without_rebuild(self):
+        meta = distance_matrix._read_meta()
+        capacity = meta['capacity']
+        City.objects.bulk_create([
+            City(city_name=f'City{i}', latitude='50.000000', longitude=f'{i / 100:.6f}') for i in range(capacity)
+        ])
+        city_ids = [City.objects.get(city_name=f'City{i}').pk for i in range(capacity)]
+        with patch.object(distance_matrix, 'rebuild') as rebuild:
+            distance_matrix.sync_cities(city_ids)
+        rebuild.assert_not_called()
+        grown = distance_matrix._read_meta()
+        self.assertEqual(grown['capacity'], capacity * 2)
+        self.assertEqual(grown['count'], capacity + 2)
+        # старые слоты скопированы, новые на месте
+        self.assertAlmostEqual(distance_matrix.distance(self.moscow.pk, self.kazan.pk), 719.0, delta=2)
+        self.assertAlmostEqual(distance_matrix.distance(city_ids[0], city_ids[100]), 71.5, delta=0.5)
+
+    def test_cold_matrix_is_built_by_command_only(self):
+        cold_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cold_dir, ignore_errors=True)
+        with override_settings(DISTANCE_MATRIX_DIR=cold_dir):
+            # без файла расстояния неизвестны, а чтение и запись города его не собирают
+            with self.assertLogs('api.distances', 'WARNING'):
+                self.assertIsNone(distance_matrix.distance(self.moscow.pk, self.kazan.pk))
+            with self.captureOnCommitCallbacks(execute=True):
+                City.objects.create(city_name='Tver', latitude='56.858700', longitude='35.917600')
+            self.assertEqual(list(Path(cold_dir).iterdir()), [])
+
+            call_command('build_distance_matrix', '--missing-only', stdout=io.StringIO())
+            self.assertAlmostEqual(distance_matrix.distance(self.moscow.pk, self.kazan.pk), 719.0, delta=2)
+            files = distance_matrix._read_meta()['ids']
+            call_command('build_distance_matrix', '--missing-only', stdout=io.StringIO())
+            self.assertEqual(distance_matrix._read_meta()['ids'], files)
+
+    def test_distances_endpoint(self):
+        response = self.client.post(reverse('city-distances'), [
+            {'city_from': str(self.moscow.pk), 'city_to': str(self.kazan.pk)},
+            {'city_from': str(self.moscow.pk), 'city_to': str(self.moscow.pk)},
+            {'city_from': str(self.moscow.pk), 'city_to': '00000000-0000-0000-0000-000000000000'},
+        ], format='json')
+        self.assertEqual(response.status_code, 200)
+        distances = [row['distance_km'] for row in response.json()]
+        self.assertAlmostEqual(distances[0], 719.0, delta=2)
+        self.assertEqual(distances[1:], [0.0, None])
+
+
+class CitySearchTests(DistanceMatrixDirMixin, APITestCase):
+    COORDINATES = {
+        'Moscow': ('55.755800', '37.617300'),
+        'Tver': ('56.858700', '35.917600'),
+        'Kazan': ('55.796100', '49.106100'),
+        'Saint Petersburg': ('59.938600', '30.314100'),
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.dispatcher = make_dispatcher()
+        cls.cities = {
+            name: City.objects.create(city_name=name, latitude=lat, longitude=lon)
+            for name, (lat, lon) in cls.COORDINATES.items()
+        }
+
+    def setUp(self):
+        city_index.load()
+        token, _ = Token.objects.get_or_create(user=self.dispatcher)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+    def names(self, response):
+        self.assertEqual(response.status_code, 200, response.content)
+        return [row['city_name'] for row in response.json()]
+
+    def test_nearby_index_matches_db(self):
+        for params in (
+            {'city': self.cities['Moscow'].pk, 'radius': 800},
+            {'lat': 55.0, 'lon': 37.0, 'radius': 200},
+            {'lat': 58.0, 'lon': 33.0, 'radius': 500},
+        ):
+            by_index = self.names(self.client.get(reverse('city-nearby'), params))
+            by_db = self.names(self.client.get(reverse('city-nearby'), {**params, 'source': 'db'}))
+            self.assertEqual(by_index, by_db, params)
+        self.assertEqual(by_index, ['Tver', 'Saint Petersburg', 'Moscow'])
+
+    def test_nearest(self):
+        response = self.client.get(reverse('city-nearest'), {'city': self.cities['Moscow'].pk, 'k': 2})
+        self.assertEqual(self.names(response), ['Tver', 'Saint Petersburg'])
+
+    def test_index_follows_writes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            klin = City.objects.create(city_name='Klin', latitude='56.331000', longitude='36.729000')
+            tver = self.cities['Tver']
+            tver.latitude, tver.longitude = '57.000000', '60.000000'
+            tver.save()
+            self.cities['Saint Petersburg'].delete()
+        self.assertEqual(
+            [row['city_name'] for row in city_index.nearest(55.7558, 37.6173, k=3)], ['Moscow', 'Klin', 'Kazan'],
+        )
+        self.assertEqual(klin.pk, city_index.nearby(56.3, 36.7, 10)[0]['city_id'])
+
+
+class CityCacheTests(DistanceMatrixDirMixin, APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.client_user = make_client()
+        cls.dispatcher = make_dispatcher()
+        cls.moscow = City.objects.create(city_name='Moscow', latitude='55.755800', longitude='37.617300')
+
+    def setUp(self):
+        cache.clear()
+        self.login(self.client_user)
+
+    def login(self, user):
+        token, _ = Token.objects.get_or_create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+    def test_etag_and_not_modified(self):
+        url = reverse('city-detail', args=[self.moscow.pk])
+        first = self.client.get(url)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json()['city_name'], 'Moscow')
+        self.assertIn('private', first['Cache-Control'])
+        etag = first['ETag']
+
+        # повторный запрос: и токен, и город из кэша
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).content, first.content)
+        with self.assertNumQueries(0):
+            not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], etag)
+
+    def test_writes_invalidate_cache(self):
+        url = reverse('city-list')
+        etag = self.client.get(url)['ETag']
+
+        self.login(self.dispatcher)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, {'city_name': 'Kazan', 'latitude': '55.796100', 'longitude': '49.106100'})
+        self.assertEqual(response.status_code, 201)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(sorted(city['city_name'] for city in response.json()), ['Kazan', 'Moscow'])
+
+
+class TokenAuthTests(DistanceMatrixDirMixin, APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dispatcher = make_dispatcher()
+
+    def setUp(self):
+        cache.clear()
+        token_cache.clear()
+
+    def login(self):
+        response = self.client.post(
+            reverse('login'), {'email': self.dispatcher.email, 'password': 'dispatcherpassword'},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {response.json()["token"]}')
+        return response.json()['token']
+
+    def test_warm_request_skips_db_for_auth(self):
+        self.login()
+        url = reverse('driver-list')
+        with CaptureQueriesContext(connection) as cold:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        with CaptureQueriesContext(connection) as warm:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(len(warm.captured_queries), len(cold.captured_queries) - 1)
+
+    def test_logout_and_role_change_invalidate_cache(self):
+        self.login()
+        url = reverse('driver-list')
+        self.assertEqual(self.client.get(url).status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.dispatcher.role = CustomUser.RoleChoices.CLIENT
+            self.dispatcher.save()
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.post(reverse('logout')).status_code, 204)
+        self.assertEqual(self.client.get(url).status_code, 401)
+
+    def test_expiry_and_rotation(self):
+        old_key = self.login()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('token-refresh'))
+        new_key = response.json()['token']
+        self.assertNotEqual(new_key, old_key)
+        self.assertEqual(self.client.get(reverse('driver-list')).status_code, 401)
+
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {new_key}')
+        self.assertEqual(self.client.get(reverse('driver-list')).status_code, 200)
+        Token.objects.filter(key=new_key).update(created=timezone.now() - timedelta(days=365))
+        with override_settings(TOKEN_CACHE_TTL=0):
+            token_cache.clear()
+            self.assertEqual(self.client.get(reverse('driver-list')).status_code, 401)
+        # логин с истёкшим токеном выдаёт новый
+        self.assertNotEqual(self.login(), new_key)
+
+
+class AsyncAuthTests(DistanceMatrixDirMixin, APITestCase):
+    def setUp(self):
+        cache.clear()
+
+    def register(self, email):
+        return self.client.post(reverse('register'), {
+            'email': email, 'username': email.split('@')[0], 'password': 'secret-password',
+            'role': 'client', 'first_name': 'Ivan', 'last_name': 'Petrov',
+        }, format='json')
+
+    def test_register_then_login(self):
+        response = self.register('new@example.com')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(self.register('new@example.com').status_code, 400)
+
+        user = CustomUser.objects.get(email='new@example.com')
+        self.assertTrue(user.check_password('secret-password'))
+        response = self.client.post(
+            reverse('login'), {'email': 'new@example.com', 'password': 'secret-password'}, format='json',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['token'], Token.objects.get(user=user).key)
+        response = self.client.post(reverse('login'), {'email': 'new@example.com', 'password': 'wrong'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_rejects_body_that_is_not_an_object(self):
+        for name in ('register', 'login'):
+            for body in ('[]', '"x"', '1', 'null', '{'):
+                response = self.client.post(reverse(name), body, content_type='application/json')
+                self.assertEqual(response.status_code, 400, (name, body))
+                self.assertEqual(response.json(), {'error': 'Invalid JSON'})
+
+    @override_settings(AUTH_THROTTLE_EMAIL_PER_MINUTE=3)
+    def test_login_throttled_per_email(self):
+        make_client()
+        codes = [
+            self.client.post(reverse('login'), {'email': 'client0@example.com', 'password': 'wrong'}).status_code
+            for _ in range(5)
+        ]
+        self.assertEqual(codes, [400, 400, 400, 429, 429])
+        response = self.client.post(reverse('login'), {'email': 'client1@example.com', 'password': 'wrong'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_busy_pool_rejects_instead_of_queueing(self):
+        make_client()
+        with patch.object(hashing_pool, 'run', side_effect=HashingPoolBusy):
+            response = self.client.post(
+                reverse('login'), {'email': 'client0@example.com', 'password': 'clientpassword'},
+            )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+
+    def test_auth_endpoints_in_schema(self):
+        # предупреждения генератора про остальные вью к проверке не относятся
+        with GENERATOR_STATS.silence():
+            schema = SchemaGenerator().get_schema(request=None, public=True)
+        for path, request_schema in (('/api/register/', 'User'), ('/api/login/', 'Login')):
+            operation = schema['paths'][path]['post']
+            self.assertEqual(
+                operation['requestBody']['content']['application/json']['schema']['$ref'],
+                f'#/components/schemas/{request_schema}',
+            )
+        self.assertIn('201', schema['paths']['/api/register/']['post']['responses'])
+        self.assertIn('token', schema['components']['schemas']['AuthResponse']['properties'])
+
+    def test_only_post_allowed(self):
+        self.assertEqual(self.client.get(reverse('login')).status_code, 405)
+
+
+class AsyncReadPathTests(DistanceMatrixDirMixin, APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.client_user = make_client()
+        cls.dispatcher = make_dispatcher()
+        city_from = City.objects.create(city_name='Moscow', latitude='55.755800', longitude='37.617300')
+        city_to = City.objects.create(city_name='Kazan', latitude='55.796100', longitude='49.106100')
+        for i in range(5):
+            order = Order.objects.create(
+                weight=100, volume=1, client=cls.client_user, dispatcher=cls.dispatcher,
+                city_from=city_from, city_to=city_to, status=Order.StatusChoices.CONFIRMED,
+            )
+            Shipment.objects.create(
+                order=order, driver=make_driver(i), vehicle=make_vehicle(i),
+                arrival_time=timezone.now() + timedelta(days=1), price=1000,
+            )
+        distance_matrix.rebuild()
+
+    def setUp(self):
+        cache.clear()
+
+    def get_both(self, user, url):
+        token, _ = Token.objects.get_or_create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        # тестовый клиент - WSGI, там маршруты синхронные; async-вью собираем как под ASGI
+        match = resolve(urlsplit(url).path)
+        with override_settings(ASYNC_READ_PATH=True):
+            view = match.func.cls.as_view(match.func.actions, **match.func.initkwargs)
+        self.assertTrue(asyncio.iscoroutinefunction(view))
+        request = APIRequestFactory().get(url, HTTP_AUTHORIZATION=f'Token {token.key}')
+        async_response = async_to_sync(view)(request, *match.args, **match.kwargs)
+        if hasattr(async_response, 'render'):
+            async_response.render()  # ответ из кэша - уже готовый HttpResponse
+        cache.clear()
+        sync_response = self.client.get(url)
+        self.assertEqual(async_response.status_code, sync_response.status_code, url)
+        self.assertEqual(json.loads(async_response.content), sync_response.json(), url)
+        return sync_response
+
+    def test_sync_views_under_wsgi(self):
+        # по умолчанию (WSGI) list/retrieve - обычные синхронные вью, без async_to_sync на запрос
+        match = resolve(reverse('client-orders-list'))
+        self.assertFalse(asyncio.iscoroutinefunction(match.func))
+
+    def test_async_matches_sync(self):
+        for user, name, model in (
+            (self.client_user, 'client-orders', Order),
+            (self.client_user, 'client-shipments', Shipment),
+            (self.dispatcher, 'dispatcher-shipments', Shipment),
+            (self.client_user, 'city', City),
+        ):
+            url = reverse(f'{name}-list')
+            if name != 'city':
+                # вторая страница по курсору
+                url = self.get_both(user, f'{url}?page_size=2').json()['next']
+            self.get_both(user, url)
+            self.get_both(user, reverse(f'{name}-detail', args=[model.objects.first().pk]))
+
+    def test_permissions_and_missing_objects(self):
+        self.assertEqual(self.get_both(self.dispatcher, reverse('client-orders-list')).status_code, 403)
+        missing = reverse('client-shipments-detail', args=['00000000-0000-0000-0000-000000000000'])
+        self.assertEqual(self.get_both(self.client_user, missing).status_code, 404)
+        self.assertEqual(self.get_both(self.client_user, reverse('city-detail', args=['not-a-uuid'])).status_code, 404)
+
+
+class ExportTests(DistanceMatrixDirMixin, APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dispatcher = make_dispatcher()
+        cls.other_dispatcher = make_dispatcher(1)
+        client_user = make_client()
+        moscow = City.objects.create(city_name='Moscow', latitude='55.755800', longitude='37.617300')
+        kazan = City.objects.create(city_name='=Kazan', latitude='55.796100', longitude='49.106100')
+        for i in range(7):
+            order = Order.objects.create(
+                weight=100 + i, volume=1, client=client_user,
+                dispatcher=cls.dispatcher if i < 5 else cls.other_dispatcher,
+                city_from=moscow, city_to=kazan, status=Order.StatusChoices.CONFIRMED,
+            )
+            Shipment.objects.create(
+                order=order, driver=make_driver(i), vehicle=make_vehicle(i),
+                arrival_time=timezone.now() + timedelta(days=1), price=1000 + i,
+            )
+        Order.objects.create(weight=1, volume=1, client=client_user, city_from=moscow, city_to=kazan)
+
+    def setUp(self):
+        token, _ = Token.objects.get_or_create(user=self.dispatcher)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+    def export(self, name, **params):
+        response = self.client.get(reverse(f'{name}-export'), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    @override_settings(EXPORT_CHUNK_SIZE=2)
+    def test_shipments_csv(self):
+        rows = list(csv.DictReader(io.StringIO(self.export('dispatcher-shipments'))))
+        # только перевозки своих заказов, в порядке создания
+        self.assertEqual([row['price'] for row in rows], [f'{1000 + i}.000' for i in range(5)])
+        self.assertEqual(rows[0]['city_from'], 'Moscow')
+        # значения, похожие на формулы, экранируются для табличных редакторов
+        self.assertEqual(rows[0]['city_to'], "'=Kazan")
+        self.assertEqual(rows[0]['vehicle'], 'A000AA77')
+
+    def test_orders_ndjson(self):
+        rows = [json.loads(line) for line in self.export('dispatcher-orders', output='ndjson').splitlines()]
+        self.assertEqual(len(rows), 8)
+        self.assertEqual(rows[0]['city_to'], '=Kazan')
+        self.assertEqual(rows[0]['driver_first_name'], 'Ivan0')
+        self.assertIsNone(rows[-1]['shipment_id'])
+
+    def test_single_query(self):
+        self.export('dispatcher-shipments')  # прогрев кэша токена
+        with self.assertNumQueries(1):
+            self.export('dispatcher-shipments', output='ndjson')
+
+
+class BulkImportTests(DistanceMatrixDirMixin, APITestCase):
+    def setUp(self):
+        token, _ = Token.objects.get_or_create(user=make_dispatcher())
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        make_vehicle(0)
+
+    def upload(self, name, filename, content, **data):
+        file = io.BytesIO(content.encode())
+        file.name = filename
+        return self.client.post(reverse(f'{name}-bulk-import'), {'file': file, **data}, format='multipart')
+
+    def test_csv_reports_row_errors_and_rolls_back(self):
+        content = (
+            'license_plate,transport_type,max_weight,max_volume\n'
+            'B001BB77,C,10000,40\n'
+            'A000AA77,C,10000,40\n'  # уже есть в БД
+            'B001BB77,C,10000,40\n'  # дубликат внутри файла
+            'B002BB77,C,,40\n'
+        )
+        response = self.upload('vehicle', 'vehicles.csv', content)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['created'], 0)
+        self.assertEqual(
+            [(error['row'], sorted(error['errors'])) for error in response.data['errors']],
+            [(4, ['max_weight']), (2, ['license_plate']), (3, ['license_plate'])],
+        )
+        self.assertEqual(Vehicle.objects.count(), 1)
+
+        response = self.upload('vehicle', 'vehicles.csv', content, skip_errors='true')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['created'], 1)
+        self.assertTrue(Vehicle.objects.filter(pk='B001BB77').exists())
+
+    @override_settings(BULK_IMPORT_CHUNK_SIZE=100)
+    def test_json_drivers_in_chunks(self):
+        rows = [
+            dict(first_name=f'Ivan{i}', last_name='Petrov', B=True, BE=False, C=i % 2 == 0, C1=False, CE=False, C1E=False)
+            for i in range(250)
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('driver-bulk-import'), rows, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.data, {'created': 250, 'errors': []})
+        self.assertEqual(Driver.objects.filter(C=True).count(), 125)
+        self.assertLess(len(queries), 20)
+
+    def test_cities_update_matrix_and_index(self):
+        # матрицы ещё нет: импорт её не создаёт
+        content = json.dumps({'city_name': 'Moscow', 'latitude': '55.755800', 'longitude': '37.617300'})
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.upload('city', 'cities.ndjson', content)
+        self.assertEqual(response.status_code, 201, response.data)
+        tasks.run_pending()
+        self.assertIsNone(distance_matrix._read_meta())
+        self.assertFalse(any(distance_matrix.directory.glob('ids-*')))
+
+        # есть матрица и индекс: импорт дополняет их, а не пересобирает
+        distance_matrix.rebuild()
+        city_index.load()
+        content = json.dumps({'city_name': 'Kazan', 'latitude': '55.796100', 'longitude': '49.106100'})
+        with patch.object(distance_matrix, 'rebuild') as rebuild, patch.object(city_index, 'load') as load, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.upload('city', 'cities.ndjson', content)
+            self.assertEqual(response.status_code, 201, response.data)
+            tasks.run_pending()
+        rebuild.assert_not_called()
+        load.assert_not_called()
+        moscow, kazan = (City.objects.get(city_name=name).pk for name in ('Moscow', 'Kazan'))
+        self.assertAlmostEqual(distance_matrix.distance(moscow, kazan), 719, delta=5)
+        found = city_index.nearby(55.7961, 49.1061, 50)
+        self.assertEqual([row['city_id'] for row in found], [kazan])
+
+    def test_fleet_index_updated_in_place(self):
+        fleet_index.load()
+        rows = [
+            {'license_plate': f'B{i:03d}BB77', 'transport_type': 'C', 'max_weight': 1000 + i, 'max_volume': 10}
+            for i in range(3)
+        ]
+        with patch.object(fleet_index, 'load') as load, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('vehicle-bulk-import'), rows, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        load.assert_not_called()
+        plates = [plate for _, plate, _ in fleet_index.feasible_vehicles(1000, 10, limit=10)]
+        self.assertEqual(plates[:3], ['B000BB77', 'B001BB77', 'B002BB77'])
+
+        # откат строгого импорта индекс не трогает
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('vehicle-bulk-import'), [
+                {'license_plate': 'B010BB77', 'transport_type': 'C', 'max_weight': 1000, 'max_volume': 10},
+                {'license_plate': 'B011BB77', 'transport_type': 'C', 'max_volume': 10},
+            ], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn('B010BB77', fleet_index.available_vehicles)
+
+
+class EventStreamTests(DistanceMatrixDirMixin, APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.client_user = make_client()
+        cls.other_client = make_client(1)
+        cls.dispatcher = make_dispatcher()
+        cls.token = Token.objects.create(user=cls.client_user)
+        moscow = City.objects.create(city_name='Moscow', latitude='55.755800', longitude='37.617300')
+        cls.orders = [
+            Order.objects.create(weight=1, volume=1, client=user, city_from=moscow, city_to=moscow)
+            for user in (cls.client_user, cls.other_client)
+        ]
+
+    def setUp(self):
+        patcher = patch.object(events, '_broker', events.InMemoryBroker())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_publish_in_process_or_through_queue(self):
+        # брокер в памяти процесса: публикация здесь же после коммита, без очереди задач
+        with self.captureOnCommitCallbacks(execute=True):
+            booking.reject_order(self.orders[0].pk, self.dispatcher)
+        self.assertEqual(len(events.get_broker()._buffer), 1)
+        # в очереди только счётчики дашборда
+        self.assertEqual(list(Task.objects.exclude(name__startswith='distances.').values_list('name', flat=True)), [
+            'dashboard.record',
+        ])
+        tasks.run_pending()
+
+        # общий брокер: публикует воркер очереди (manage.py run_tasks)
+        broker = events.InMemoryBroker()
+        broker.shared = True
+        with patch.object(events, '_broker', broker), self.captureOnCommitCallbacks(execute=True):
+            booking.reject_order(self.orders[1].pk, self.dispatcher)
+            self.assertEqual(len(broker._buffer), 0)
+            self.assertEqual(tasks.run_pending(), (2, 0))
+        [(_, user_ids, event)] = broker._buffer
+        self.assertEqual(user_ids, {self.other_client.pk, self.dispatcher.pk})
+        self.assertEqual(event['data'], {'order': str(self.orders[1].pk), 'status': 'Cancelled'})
+
+    async def test_resume_from_last_event_id(self):
+        broker = events.get_broker()
+        user_id = self.client_user.pk
+        first = broker.publish([user_id], 'order', {'n': 1})
+        broker.publish([self.other_client.pk], 'order', {'n': 2})
+        broker.publish([user_id, self.dispatcher.pk], 'order', {'n': 3})
+
+        stream = broker.subscribe(user_id, first['id'])
+        self.assertEqual((await anext(stream))['data'], {'n': 3})
+        # публикация из другого потока доходит до подписчика в цикле событий
+        await sync_to_async(broker.publish, thread_sensitive=False)([user_id], 'order', {'n': 4})
+        self.assertEqual((await asyncio.wait_for(anext(stream), 1))['data'], {'n': 4})
+        await stream.aclose()
+
+        # id из другого процесса (или после рестарта) - reset вместо молчаливой потери событий
+        stream = broker.subscribe(user_id, 'otherepoch-2')
+        self.assertEqual((await anext(stream))['type'], 'reset')
+        await stream.aclose()
+
+    def test_stream_requires_asgi(self):
+        # под WSGI поток занял бы поток воркера навсегда - сразу 501
+        response = self.client.get(reverse('events'), headers={'Authorization': f'Token {self.token.key}'})
+        self.assertEqual(response.status_code, 501)
+
+    async def test_stream_receives_status_change(self):
+        response = await self.async_client.get(
+            reverse('events'), headers={'Authorization': f'Token {self.token.key}'},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = response.streaming_content
+        self.assertTrue((await anext(content)).startswith(b'retry:'))
+        chunk = asyncio.ensure_future(anext(content))
+        await asyncio.sleep(0.05)  # подписка регистрируется при первом чтении потока
+
+        @sync_to_async
+        def reject():
+            with self.captureOnCommitCallbacks(execute=True):
+                booking.reject_order(self.orders[1].pk, self.dispatcher)
+                booking.reject_order(self.orders[0].pk, self.dispatcher)
+
+        await reject()
+        message = (await asyncio.wait_for(chunk, 1)).decode()
+        self.assertIn('event: order', message)
+        self.assertIn(f'"order": "{self.orders[0].pk}"', message)
+        self.assertIn('"status": "Cancelled"', message)
+        await content.aclose()
+
+    async def test_requires_token(self):
+        response = await self.async_client.get(reverse('events'), {'token': 'nope'})
+        self.assertEqual(response.status_code, 401)
+
+
+class ConditionalGetTests(DistanceMatrixDirMixin, APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.client_user = make_client()
+        cls.dispatcher = make_dispatcher()
+        city = City.objects.create(city_name='Moscow', latitude='55.755800', longitude='37.617300')
+        order = Order.objects.create(
+            weight=1, volume=1, client=cls.client_user, dispatcher=cls.dispatcher,
+            city_from=city, city_to=city, status=Order.StatusChoices.CONFIRMED,
+        )
+        cls.shipment = Shipment.objects.create(
+            order=order, driver=make_driver(), vehicle=make_vehicle(),
+            arrival_time=timezone.now() + timedelta(days=1), price=1000,
+        )
+
+    def setUp(self):
+        token, _ = Token.objects.get_or_create(user=self.dispatcher)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+    def test_list_and_detail_revalidate(self):
+        for url in (reverse('dispatcher-shipments-list'),
+                    reverse('dispatcher-shipments-detail', args=[self.shipment.pk])):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response['ETag']
+            self.assertIn('Last-Modified', response)
+
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], etag)
+            self.assertEqual(len(queries), 1)  # только валидаторы, токен из кэша
+
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            self.assertEqual(response.status_code, 304)
+
+    def test_status_change_invalidates(self):
+        url = reverse('dispatcher-shipments-list')
+        etag = self.client.get(url)['ETag']
+        self.client.post(reverse('dispatcher-shipments-delay', args=[self.shipment.pk]))
+        self.shipment.refresh_from_db()
+        self.assertEqual(self.shipment.status, Shipment.StatusChoices.DELAYED)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        # изменение вложенного водителя тоже меняет ответ
+        etag = response['ETag']
+        Driver.objects.filter(pk=self.shipment.driver_id).update(
+            first_name='Oleg', updated_at=timezone.now() + timedelta(seconds=1),
+        )
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_list_validators_cover_page_and_nested_client(self):
+        city = City.objects.get()
+        orders = [
+            Order.objects.create(weight=1, volume=1, client=self.client_user, city_from=city, city_to=city)
+            for _ in range(3)
+        ]
+        for days, order in enumerate(orders):
+            Order.objects.filter(pk=order.pk).update(created_at=timezone.now() + timedelta(days=days + 1))
+        url = reverse('dispatcher-orders-list') + '?page_size=1'
+        with CaptureQueriesContext(connection) as queries:
+            etag = self.client.get(url)['ETag']
+        # валидаторы - по странице (page_size + 1 строк), без агрегата по всей таблице
+        self.assertNotIn('COUNT(', queries.captured_queries[0]['sql'])
+        self.assertIn('LIMIT 2', queries.captured_queries[0]['sql'])
+
+        # заказ за пределами страницы ответ первой страницы не меняет
+        Order.objects.filter(pk=orders[0].pk).update(weight=2, updated_at=timezone.now() + timedelta(seconds=1))
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # вложенный client - меняет
+        self.client_user.first_name = 'Anna'
+        self.client_user.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_deletion_changes_list_etag(self):
+        url = reverse('driver-list')
+        make_driver(1)
+        etag = self.client.get(url)['ETag']
+        Driver.objects.filter(first_name='Ivan1').delete()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class DashboardTests(DistanceMatrixDirMixin, APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.client_user = make_client()
+        cls.dispatcher = make_dispatcher()
+        cls.city = City.objects.create(city_name='Moscow', latitude='55.755800', longitude='37.617300')
+        cls.drivers = [make_driver(i) for i in range(3)]
+        cls.vehicles = [make_vehicle(i) for i in range(3)]
+
+    def as_user(self, user):
+        token, _ = Token.objects.get_or_create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+    def test_counters_follow_transitions(self):
+        self.as_user(self.client_user)
+        order_ids = [
+            self.client.post(reverse('client-orders-list'), {
+                'weight': 10, 'volume': 1, 'city_from': self.city.pk, 'city_to': self.city.pk,
+            }).data['order_id']
+            for _ in range(5)
+        ]
+
+        self.as_user(self.dispatcher)
+        arrival = (timezone.now() + timedelta(days=1)).isoformat()
+        response = self.client.post(reverse('dispatcher-orders-accept', args=[order_ids[0]]), {
+            'driver': self.drivers[0].pk, 'vehicle': self.vehicles[0].pk, 'arrival_time': arrival, 'price': '100.500',
+        })
+        self.assertEqual(response.status_code, 200, response.data)
+        self.client.post(reverse('dispatcher-orders-bulk-accept'), [
+            {'order': order_ids[i], 'driver': self.drivers[i].pk, 'vehicle': self.vehicles[i].pk,
+             'arrival_time': arrival, 'price': '200'}
+            for i in (1, 2)
+        ], format='json')
+        self.client.post(reverse('dispatcher-orders-reject', args=[order_ids[3]]))
+        # неудачный переход счётчики не трогает
+        self.client.post(reverse('dispatcher-orders-reject', args=[order_ids[3]]))
+
+        shipments = {str(s.order_id): s.pk for s in Shipment.objects.all()}
+        self.client.post(reverse('dispatcher-shipments-deliver', args=[shipments[order_ids[0]]]))
+        self.client.post(reverse('dispatcher-shipments-delay', args=[shipments[order_ids[1]]]))
+        self.as_user(self.client_user)
+        for rating in (3, 5):
+            response = self.client.patch(
+                reverse('client-shipments-detail', args=[shipments[order_ids[0]]]), {'review_rating': rating},
+            )
+            self.assertEqual(response.status_code, 200, response.data)
+
+        # счётчики обновляет воркер очереди задач
+        tasks.run_pending()
+        self.as_user(self.dispatcher)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('dispatcher-dashboard'))
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(response.data, {
+            'orders': {'Pending': 1, 'Cancelled': 1, 'Confirmed': 3},
+            'shipments': {'In Progress': 1, 'Delivered': 1, 'Delayed': 1},
+            'revenue': Decimal('500.500'),
+            'reviews': 1,
+            'average_rating': 5.0,
+        })
+        self.assertEqual(dashboard.reconcile(), {})
+
+    def test_side_effects_go_through_outbox(self):
+        broker = events.InMemoryBroker()
+        broker.shared = True
+        order = Order.objects.create(weight=1, volume=1, client=self.client_user, city_from=self.city, city_to=self.city)
+        tasks.run_pending()
+        arrival = (timezone.now() + timedelta(days=1)).isoformat()
+        with patch.object(events, '_broker', broker):
+            self.as_user(self.dispatcher)
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(reverse('dispatcher-orders-accept', args=[order.pk]), {
+                    'driver': self.drivers[0].pk, 'vehicle': self.vehicles[0].pk,
+                    'arrival_time': arrival, 'price': '100',
+                })
+            self.assertEqual(response.status_code, 200, response.data)
+            shipment = Shipment.objects.get(order=order)
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(reverse('dispatcher-shipments-deliver', args=[shipment.pk]))
+            self.assertEqual(response.status_code, 200, response.data)
+            self.as_user(self.client_user)
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.patch(
+                    reverse('client-shipments-detail', args=[shipment.pk]), {'review_rating': 4},
+                )
+            self.assertEqual(response.status_code, 200, response.data)
+
+            # запросы только пишут задачи: счётчики и брокер не тронуты
+            self.assertEqual(sorted(Task.objects.values_list('name', flat=True)), [
+                'dashboard.record', 'dashboard.record', 'dashboard.record', 'events.publish', 'events.shipment',
+            ])
+            self.assertFalse(DashboardCounter.objects.exclude(value=0).exists())
+            self.assertEqual(len(broker._buffer), 0)
+
+            self.assertEqual(tasks.run_pending(), (5, 0))
+        self.assertFalse(Task.objects.exists())
+        summary = dashboard.read()
+        self.assertEqual(summary['orders']['Confirmed'], 1)
+        self.assertEqual(summary['shipments']['Delivered'], 1)
+        self.assertEqual(summary['revenue'], Decimal('100.000'))
+        self.assertEqual(summary['average_rating'], 4.0)
+        self.assertEqual([event['type'] for _, _, event in broker._buffer], ['order', 'shipment', 'shipment'])
+
+    def test_reconcile_command_fixes_drift(self):
+        Order.objects.create(weight=1, volume=1, client=self.client_user, city_from=self.city, city_to=self.city)
+        dashboard.record({dashboard.REVENUE: 42})
+        tasks.run_pending()
+        out = io.StringIO()
+        call_command('reconcile_dashboard', stdout=out)
+        self.assertIn('2 counters corrected', out.getvalue())
+        self.assertEqual(dashboard.read()['orders']['Pending'], 1)
+        self.assertEqual(dashboard.read()['revenue'], 0)
+
+        # ещё не применённая задача: пересчёт оставляет под неё место, а не считает дважды
+        Order.objects.create(weight=1, volume=1, client=self.client_user, city_from=self.city, city_to=self.city)
+        dashboard.record({dashboard.order_key(Order.StatusChoices.PENDING): 1})
+        self.assertEqual(dashboard.reconcile(), {})
+        tasks.run_pending()
+        self.assertEqual(dashboard.read()['orders']['Pending'], 2)
+        self.assertEqual(dashboard.reconcile(), {})
+
+
+class RouteAnalyticsTests(DistanceMatrixDirMixin, APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        client_user = make_client()
+        cls.dispatcher = make_dispatcher()
+        cls.a, cls.b, cls.c = (
+            City.objects.create(city_name=name, latitude='55.000000', longitude='37.000000') for name in 'ABC'
+        )
+        now = timezone.now()
+
+        def order(city_from, city_to, created_at, price=None, n=0, **shipment):
+            item = Order.objects.create(weight=10, volume=2, client=client_user, city_from=city_from, city_to=city_to)
+            Order.objects.filter(pk=item.pk).update(created_at=created_at)
+            if price is not None:
+                Shipment.objects.create(
+                    order=item, driver=make_driver(n), vehicle=make_vehicle(n),
+                    arrival_time=created_at + timedelta(days=1), price=price, **shipment,
+                )
+
+        two_days_ago = now - timedelta(days=2)
+        order(cls.a, cls.b, two_days_ago, 100, 0, review_rating=4)
+        order(cls.a, cls.b, two_days_ago, 200, 1, review_rating=5)
+        order(cls.a, cls.b, two_days_ago, 400, 2, status=Shipment.StatusChoices.DELAYED)
+        order(cls.a, cls.b, now)
+        order(cls.b, cls.c, now - timedelta(days=1), 50, 3)
+        order(cls.b, cls.c, now - timedelta(days=10), 70, 4)  # вне окна
+
+    def setUp(self):
+        cache.clear()
+        token, _ = Token.objects.get_or_create(user=self.dispatcher)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+    def get(self, **params):
+        params.setdefault('since', (timezone.now() - timedelta(days=3)).isoformat())
+        response = self.client.get(reverse('dispatcher-route-analytics'), params)
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data['routes']
+
+    def test_route_stats(self):
+        a_b, b_c = self.get()
+        self.assertEqual((a_b['city_from'], a_b['city_to']), (str(self.a.pk), str(self.b.pk)))
+        self.assertEqual((a_b['orders'], a_b['weight'], a_b['volume'], a_b['shipments']), (4, 40, 8, 3))
+        self.assertAlmostEqual(float(a_b['price']['avg']), 233.333, places=3)
+        self.assertAlmostEqual(a_b['price']['p50'], 200, delta=200 * 0.02)
+        self.assertAlmostEqual(a_b['price']['p95'], 400, delta=400 * 0.02)
+        self.assertEqual(a_b['delayed_share'], 0.3333)
+        self.assertEqual(a_b['average_rating'], 4.5)
+        self.assertEqual((b_c['orders'], b_c['average_rating']), (1, None))
+
+        routes = self.get(city_from=self.b.pk)
+        self.assertEqual([route['orders'] for route in routes], [1])
+
+    def test_consolidated_orders_count_their_trip(self):
+        client_user = CustomUser.objects.get(role=CustomUser.RoleChoices.CLIENT)
+        created_at = timezone.now() - timedelta(days=2)
+        orders = []
+        for _ in range(3):
+            item = Order.objects.create(weight=10, volume=2, client=client_user, city_from=self.a, city_to=self.c)
+            Order.objects.filter(pk=item.pk).update(created_at=created_at)
+            orders.append(item)
+        # один сборный рейс на три заказа: перевозка - на первом, ссылка на неё - у всех
+        shipment = Shipment.objects.create(
+            order=orders[0], driver=make_driver(5), vehicle=make_vehicle(5), arrival_time=created_at + timedelta(days=1),
+            price=900, status=Shipment.StatusChoices.DELAYED, review_rating=3,
+        )
+        Order.objects.filter(pk__in=[order.pk for order in orders]).update(consolidated_shipment=shipment)
+
+        [a_c] = self.get(city_to=self.c.pk, city_from=self.a.pk)
+        self.assertEqual((a_c['orders'], a_c['shipments']), (3, 3))
+        self.assertEqual(a_c['delayed_share'], 1.0)
+        self.assertEqual(a_c['average_rating'], 3)
+        # цена - одна на машину, а не на каждый заказ
+        self.assertEqual(float(a_c['price']['avg']), 900)
+        self.assertAlmostEqual(a_c['price']['p50'], 900, delta=900 * 0.02)
+
+    def test_closed_buckets_come_from_cache(self):
+        first = self.get()
+        with CaptureQueriesContext(connection) as queries:
+            second = self.get()
+        self.assertEqual(second, first)
+        # только текущий (незакрытый) час считается заново
+        self.assertEqual(len(queries), 1)
+
+    def test_window_validation(self):
+        response = self.client.get(reverse('dispatcher-route-analytics'), {
+            'since': timezone.now().isoformat(), 'until': (timezone.now() - timedelta(days=1)).isoformat(),
+        })
+        self.assertEqual(response.status_code, 400)
+
+
+class OverdueSchedulerTests(DistanceMatrixDirMixin, APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.client_user = make_client()
+        cls.dispatcher = make_dispatcher()
+        city = City.objects.create(city_name='Moscow', latitude='55.755800', longitude='37.617300')
+        now = timezone.now()
+        cls.shipments = {}
+        for n, (status, arrival) in enumerate([
+            (Shipment.StatusChoices.IN_PROGRESS, now - timedelta(hours=2)),
+            (Shipment.StatusChoices.IN_PROGRESS, now - timedelta(minutes=1)),
+            (Shipment.StatusChoices.IN_PROGRESS, now + timedelta(hours=1)),
+            (Shipment.StatusChoices.DELIVERED, now - timedelta(hours=3)),
+        ]):
+            order = Order.objects.create(
+                weight=10, volume=1, client=cls.client_user, dispatcher=cls.dispatcher,
+                city_from=city, city_to=city, status=Order.StatusChoices.CONFIRMED,
+            )
+            cls.shipments[n] = Shipment.objects.create(
+                order=order, driver=make_driver(n), vehicle=make_vehicle(n),
+                arrival_time=arrival, price=100, status=status,
+            )
+
+    def test_flags_overdue_in_one_statement(self):
+        published = []
+        with patch.object(events.InMemoryBroker, 'publish', lambda self, *args: published.append(args)), \
+                self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as queries:
+            rows = scheduler.flag_overdue_shipments()
+        updates = [q for q in queries.captured_queries if q['sql'].startswith('UPDATE "api_shipment"')]
+        self.assertEqual(len(updates), 1)
+
+        flagged = {self.shipments[0].pk, self.shipments[1].pk}
+        self.assertEqual({row[0] for row in rows}, flagged)
+        statuses = dict(Shipment.objects.values_list('pk', 'status'))
+        self.assertEqual({pk for pk, status in statuses.items() if status == Shipment.StatusChoices.DELAYED}, flagged)
+        self.assertEqual(statuses[self.shipments[3].pk], Shipment.StatusChoices.DELIVERED)
+
+        self.assertEqual(len(published), 2)
+        for user_ids, event_type, data in published:
+            self.assertEqual(set(user_ids), {self.client_user.pk, self.dispatcher.pk})
+            self.assertEqual(data['status'], Shipment.StatusChoices.DELAYED)
+        tasks.run_pending()
+        self.assertEqual(dashboard.read()['shipments'][Shipment.StatusChoices.DELAYED], 2)
+
+        # повторный прогон ничего не находит
+        self.assertEqual(scheduler.flag_overdue_shipments(), [])
+
+    def test_command_once(self):
+        out = io.StringIO()
+        call_command('run_scheduler', '--once', stdout=out)
+        self.assertIn('flag_overdue_shipments: 2 changed', out.getvalue())
+
+
+@override_settings(TASKS_MAX_ATTEMPTS=3, TASKS_RETRY_BASE_SECONDS=10)
+class TaskQueueTests(DistanceMatrixDirMixin, APITestCase):
+    def setUp(self):
+        self.calls = []
+
+        def flaky(n):
+            self.calls.append(n)
+            DashboardCounter.objects.create(key=f'tests:{n}', shard=0, value=n)
+            if n < 0:
+                raise ValueError('boom')
+
+        patcher = patch.dict(tasks._handlers, {'tests.flaky': flaky})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_enqueued_with_transaction(self):
+        try:
+            with transaction.atomic():
+                tasks.enqueue(tasks.call('tests.flaky', n=1))
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        with transaction.atomic():
+            tasks.enqueue(tasks.call('tests.flaky', n=2), tasks.call('tests.flaky', n=3))
+
+        self.assertEqual(tasks.run_pending(), (2, 0))
+        self.assertEqual(self.calls, [2, 3])
+        self.assertFalse(Task.objects.exists())
+
+    def test_retry_backoff_and_dead_letter(self):
+        tasks.enqueue(tasks.call('tests.flaky', n=-1))
+        self.assertEqual(tasks.run_pending(), (0, 1))
+        task = Task.objects.get()
+        self.assertEqual(task.attempts, 1)
+        self.assertIn('boom', task.last_error)
+        self.assertGreater(task.run_after, timezone.now() + timedelta(seconds=9))
+        # изменения упавшей задачи откатываются вместе с ней
+        self.assertFalse(DashboardCounter.objects.filter(key__startswith='tests:').exists())
+        # до истечения задержки задача не берётся
+        self.assertEqual(tasks.run_pending(), (0, 0))
+
+        for attempt in (2, 3):
+            Task.objects.update(run_after=timezone.now())
+            self.assertEqual(tasks.run_pending(), (0, 1))
+        self.assertFalse(Task.objects.exists())
+        dead = DeadTask.objects.get()
+        self.assertEqual((dead.name, dead.payload, dead.attempts), ('tests.flaky', {'n': -1}, 3))
+
+        self.assertEqual(tasks.requeue_dead(), 1)
+        self.assertEqual(Task.objects.get().attempts, 0)
+        self.assertFalse(DeadTask.objects.exists())
+
+    def test_unknown_task_goes_to_dead_letter(self):
+        tasks.enqueue(tasks.call('tests.missing'))
+        self.assertEqual(tasks.run_pending(), (0, 1))
+        self.assertIn('Unknown task', DeadTask.objects.get().error)
+
+
+class AvailabilityWindowTests(DistanceMatrixDirMixin, APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        client_user = make_client()
+        cls.dispatcher = make_dispatcher()
+        city = City.objects.create(city_name='Moscow', latitude='55.755800', longitude='37.617300')
+        cls.orders = [
+            Order.objects.create(weight=100, volume=1, client=client_user, city_from=city, city_to=city)
+            for _ in range(4)
+        ]
+        cls.driver = make_driver()
+        cls.vehicles = [make_vehicle(i) for i in range(4)]
+
+    def setUp(self):
+        self.client.force_authenticate(self.dispatcher)
+        self.now = timezone.now()
+
+    def accept(self, order, vehicle, start_days, end_days):
+        payload = {
+            'driver': str(self.driver.pk), 'vehicle': vehicle.pk, 'price': '1000',
+            'arrival_time': (self.now + timedelta(days=end_days)).isoformat(),
+        }
+        if start_days:
+            payload['departure_time'] = (self.now + timedelta(days=start_days)).isoformat()
+        return self.client.post(reverse('dispatcher-orders-accept', args=[order.pk]), payload, format='json')
+
+    def test_trips_block_only_their_window(self):
+        self.assertEqual(self.accept(self.orders[0], self.vehicles[0], 7, 10).status_code, 200)
+        # рейс через неделю не делает водителя занятым сейчас
+        self.driver.refresh_from_db()
+        self.assertTrue(self.driver.is_available)
+
+        self.assertEqual(self.accept(self.orders[1], self.vehicles[1], 0, 3).status_code, 200)
+        self.driver.refresh_from_db()
+        self.assertFalse(self.driver.is_available)
+
+        response = self.accept(self.orders[2], self.vehicles[2], 9, 12)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], 'Driver or Vehicle not available')
+        self.assertEqual(self.accept(self.orders[2], self.vehicles[2], 3, 7).status_code, 200)
+        self.assertEqual(self.accept(self.orders[3], self.vehicles[3], 5, 4).status_code, 400)
+
+        url = reverse('driver-list')
+        window = lambda start, end: {
+            'free_from': (self.now + timedelta(days=start)).isoformat(),
+            'free_to': (self.now + timedelta(days=end)).isoformat(),
+        }
+        self.assertEqual(self.client.get(url, window(1, 2)).data['results'], [])
+        self.assertEqual(len(self.client.get(url, window(11, 12)).data['results']), 1)
+        self.assertEqual(self.client.get(url, window(2, 1)).status_code, 400)
+
+        # доставка освобождает текущее окно, будущие рейсы остаются
+        shipment = Shipment.objects.get(order=self.orders[1])
+        self.client.post(reverse('dispatcher-shipments-deliver', args=[shipment.pk]))
+        self.driver.refresh_from_db()
+        self.assertTrue(self.driver.is_available)
+        self.assertEqual(len(self.client.get(url, window(1, 2)).data['results']), 1)
+        self.assertEqual(self.client.get(url, window(8, 9)).data['results'], [])
+
+    def test_bulk_accept_checks_windows_inside_batch(self):
+        arrival = lambda days: self.now + timedelta(days=days)
+        results = self.client.post(reverse('dispatcher-orders-bulk-accept'), [
+            {'order': self.orders[0].pk, 'driver': self.driver.pk, 'vehicle': self.vehicles[0].pk,
+             'departure_time': arrival(1), 'arrival_time': arrival(2), 'price': '1'},
+            {'order': self.orders[1].pk, 'driver': self.driver.pk, 'vehicle': self.vehicles[1].pk,
+             'departure_time': arrival(2), 'arrival_time': arrival(3), 'price': '1'},
+            {'order': self.orders[2].pk, 'driver': self.driver.pk, 'vehicle': self.vehicles[2].pk,
+             'departure_time': arrival(1), 'arrival_time': arrival(4), 'price': '1'},
+        ], format='json').data
+        self.assertEqual([result.get('error') for result in results], [None, None, 'Driver or Vehicle not available'])
+
+    def test_batch_busy_check_is_two_queries_for_distinct_windows(self):
+        self.assertEqual(self.accept(self.orders[0], self.vehicles[0], 7, 10).status_code, 200)
+        Downtime.objects.create(vehicle=self.vehicles[1], start=self.now + timedelta(days=2),
+                                end=self.now + timedelta(days=3))
+        items = [
+            {'driver': self.driver.pk, 'vehicle': vehicle.pk,
+             'window': (self.now + timedelta(days=day), self.now + timedelta(days=day + 1))}
+            for day in range(12) for vehicle in self.vehicles
+        ]
+        with self.assertNumQueries(2):
+            busy = booking._busy_by_window(items)
+        self.assertEqual(len(busy), 12)
+        for (start, end), (drivers, vehicles) in busy.items():
+            self.assertEqual(drivers, availability.busy_ids(Driver, [self.driver.pk], start, end))
+            self.assertEqual(vehicles, availability.busy_ids(Vehicle, [v.pk for v in self.vehicles], start, end))
+        self.assertEqual(busy[items[7 * 4]['window']], ({self.driver.pk}, {self.vehicles[0].pk}))
+        self.assertEqual(busy[items[2 * 4]['window']], (set(), {self.vehicles[1].pk}))
+
+    def test_downtime(self):
+        vehicle = self.vehicles[0]
+        url = reverse('downtime-list')
+        response = self.client.post(url, {
+            'vehicle': vehicle.pk, 'start': self.now - timedelta(hours=1), 'end': self.now + timedelta(days=2),
+            'reason': 'ТО',
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        vehicle.refresh_from_db()
+        self.assertFalse(vehicle.is_available)
+
+        overlapping = {'vehicle': vehicle.pk, 'start': self.now + timedelta(days=1), 'end': self.now + timedelta(days=3)}
+        self.assertEqual(self.client.post(url, overlapping, format='json').status_code, 400)
+        self.assertEqual(self.client.post(url, {**overlapping, 'driver': self.driver.pk}, format='json').status_code, 400)
+        self.assertEqual(self.accept(self.orders[0], vehicle, 1, 3).status_code, 400)
+        self.assertEqual(self.accept(self.orders[0], vehicle, 2, 3).status_code, 200)
+
+        self.client.delete(reverse('downtime-detail', args=[response.data['id']]))
+        vehicle.refresh_from_db()
+        self.assertTrue(vehicle.is_available)
+
+    def test_delayed_trip_can_be_delivered_and_frees_resources(self):
+        self.assertEqual(self.accept(self.orders[0], self.vehicles[0], 0, 1).status_code, 200)
+        shipment = Shipment.objects.get(order=self.orders[0])
+        Shipment.objects.filter(pk=shipment.pk).update(arrival_time=self.now - timedelta(hours=1))
+        scheduler.flag_overdue_shipments()
+        shipment.refresh_from_db()
+        self.assertEqual(shipment.status, Shipment.StatusChoices.DELAYED)
+
+        # задержанный рейс держит ресурсы только SHIPMENT_DELAY_GRACE_SECONDS после arrival_time
+        self.assertEqual(self.accept(self.orders[1], self.vehicles[0], 0, 2).status_code, 400)
+        with override_settings(SHIPMENT_DELAY_GRACE_SECONDS=3600):
+            self.assertFalse(availability.busy_ids(
+                Driver, [self.driver.pk], self.now + timedelta(days=30), self.now + timedelta(days=31),
+            ))
+
+        response = self.client.post(reverse('dispatcher-shipments-deliver', args=[shipment.pk]))
+        self.assertEqual(response.status_code, 200, response.data)
+        tasks.run_pending()
+        self.assertEqual(dashboard.read()['shipments'][Shipment.StatusChoices.DELAYED], 0)
+        self.driver.refresh_from_db()
+        self.assertTrue(self.driver.is_available)
+        self.assertEqual(self.accept(self.orders[1], self.vehicles[0], 0, 2).status_code, 200)
+
+    def test_scheduler_syncs_flags(self):
+        Shipment.objects.create(
+            order=self.orders[0], driver=self.driver, vehicle=self.vehicles[0], price=1,
+            departure_time=self.now - timedelta(hours=1), arrival_time=self.now + timedelta(hours=1),
+        )
+        changed = availability.sync_all()
+        self.assertEqual(set(changed), {self.driver.pk, self.vehicles[0].pk})
+        self.assertFalse(Driver.objects.get().is_available)
+        self.assertEqual(availability.sync_all(), [])
+
+
+class ConsolidationTests(DistanceMatrixDirMixin, APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.clients = [make_client(i) for i in range(2)]
+        cls.dispatcher = make_dispatcher()
+        moscow = City.objects.create(city_name='Moscow', latitude='55.755800', longitude='37.617300')
+        tver = City.objects.create(city_name='Tver', latitude='56.858700', longitude='35.917600')
+        cls.orders = [
+            Order.objects.create(weight=3000, volume=10, client=cls.clients[i % 2], city_from=moscow, city_to=tver)
+            for i in range(3)
+        ]
+        cls.other_route = Order.objects.create(weight=100, volume=1, client=cls.clients[0], city_from=tver, city_to=moscow)
+        cls.driver = make_driver()
+        cls.vehicle = make_vehicle()
+
+    def setUp(self):
+        self.client.force_authenticate(self.dispatcher)
+
+    def test_solve_packs_route_into_fewest_vehicles(self):
+        order_vehicle, vehicle_driver = consolidation.solve(
+            np.array([6000., 5000., 4000., 3000., 2000.]), np.array([10., 10., 10., 10., 10.]),
+            np.array([0, 0, 0, 0, 1]),
+            np.array([10000., 10000., 10000., 3000.]), np.array([40., 40., 40., 20.]),
+            np.array([2, 2, 2, 2]), np.array([[True, False, True, False, False, False]] * 4),
+        )
+        # 6000+4000 и 5000+3000 - две машины на первый маршрут, 2000 - в маленькую машину
+        self.assertEqual(order_vehicle[0], order_vehicle[2])
+        self.assertEqual(order_vehicle[1], order_vehicle[3])
+        self.assertEqual(order_vehicle[4], 3)
+        self.assertEqual(len(set(order_vehicle)), 3)
+        self.assertTrue((vehicle_driver[order_vehicle] >= 0).all())
+
+    def test_plan_groups_orders_by_route(self):
+        plan = self.client.get(reverse('dispatcher-orders-consolidation-plan')).data
+        self.assertEqual(len(plan['shipments']), 1)
+        shipment = plan['shipments'][0]
+        self.assertEqual(shipment['vehicle'], self.vehicle.pk)
+        self.assertEqual(len(shipment['orders']), 3)
+        self.assertEqual(plan['unassigned'], [self.other_route.pk])
+        self.assertEqual(shipment['utilization'], 0.9)
+
+    def consolidate(self, orders, **extra):
+        payload = {
+            'orders': [str(order.pk) for order in orders], 'driver': str(self.driver.pk), 'vehicle': self.vehicle.pk,
+            'arrival_time': (timezone.now() + timedelta(days=1)).isoformat(), 'price': '5000', **extra,
+        }
+        return self.client.post(reverse('dispatcher-orders-consolidate'), payload, format='json')
+
+    def test_consolidate(self):
+        response = self.consolidate(self.orders[:2] + [self.other_route])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], 'Orders must share the same route')
+        self.assertEqual(self.consolidate(self.orders, vehicle=make_vehicle(1, max_weight=8000).pk).data['error'],
+                         'Orders exceed vehicle capacity')
+
+        broker = events.InMemoryBroker()
+        with patch.object(events, '_broker', broker), self.captureOnCommitCallbacks(execute=True):
+            response = self.consolidate(self.orders)
+        self.assertEqual(response.status_code, 200, response.data)
+        notified = {user_id for _, user_ids, _ in broker._buffer for user_id in user_ids}
+        self.assertEqual(notified, {self.clients[0].pk, self.clients[1].pk, self.dispatcher.pk})
+        shipment = Shipment.objects.get(pk=response.data['shipment'])
+        self.assertEqual(shipment.order, self.orders[0])
+        self.assertEqual(
+            set(Order.objects.filter(consolidated_shipment=shipment, status=Order.StatusChoices.CONFIRMED)),
+            set(self.orders),
+        )
+        self.assertFalse(Vehicle.objects.get(pk=self.vehicle.pk).is_available)
+        self.assertEqual(self.consolidate(self.orders).data['error'], 'Order not pending')
+
+        # рейс виден обоим клиентам, отзыв оставляет только владелец основного заказа
+        Shipment.objects.filter(pk=shipment.pk).update(status=Shipment.StatusChoices.DELIVERED)
+        self.client.force_authenticate(self.clients[1])
+        url = reverse('client-shipments-detail', args=[shipment.pk])
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.client.patch(url, {'review_rating': 5}, format='json').status_code, 403)
+
+
+class RoutePlanTests(DistanceMatrixDirMixin, APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dispatcher = make_dispatcher()
+        # города на одной параллели: порядок по долготе - кратчайший
+        cls.cities = [
+            City.objects.create(city_name=f'City{i}', latitude='55.000000', longitude=f'{30 + i}.000000')
+            for i in range(5)
+        ]
+        client_user = make_client()
+        cls.orders = [
+            Order.objects.create(weight=100, volume=1, client=client_user,
+                                 city_from=cls.cities[city_from], city_to=cls.cities[city_to])
+            for city_from, city_to in ((3, 1), (2, 4))
+        ]
+
+    def setUp(self):
+        self.client.force_authenticate(self.dispatcher)
+
+    def test_solve_respects_precedence(self):
+        rng = np.random.default_rng(0)
+        latitudes, longitudes = rng.uniform(50, 60, 41), rng.uniform(30, 50, 41)
+        pairs = [(2 * k + 1, 2 * k + 2) if k % 2 else (2 * k + 2, 2 * k + 1) for k in range(20)]
+        tour, length, initial = routing.solve(latitudes, longitudes, pairs, start=0)
+        self.assertEqual(tour[0], 0)
+        self.assertEqual(sorted(tour), list(range(41)))
+        position = {point: i for i, point in enumerate(tour)}
+        self.assertTrue(all(position[pickup] < position[dropoff] for pickup, dropoff in pairs))
+        self.assertLessEqual(length, initial)
+
+    def test_plan_for_orders(self):
+        url = reverse('dispatcher-route-plan')
+        response = self.client.post(url, {
+            'start': str(self.cities[0].pk), 'orders': [str(order.pk) for order in self.orders],
+        }, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        route = [(stop['city'], stop['action']) for stop in response.data['route']]
+        # 0 -> 2 (погрузка) -> 3 (погрузка) -> 4 (выгрузка) -> 1 (выгрузка) короче, чем заезд в 1 по пути
+        self.assertEqual(route, [
+            (self.cities[0].pk, 'start'), (self.cities[2].pk, 'pickup'), (self.cities[3].pk, 'pickup'),
+            (self.cities[4].pk, 'dropoff'), (self.cities[1].pk, 'dropoff'),
+        ])
+        self.assertEqual(response.data['route'][1]['order'], self.orders[1].pk)
+
+        missing = self.client.post(url, {'stops': [{'pickup': str(uuid4()), 'dropoff': str(self.cities[0].pk)}]},
+                                   format='json')
+        self.assertEqual(missing.status_code, 400)
+        self.assertEqual(self.client.post(url, {'start': str(self.cities[0].pk)}, format='json').status_code, 400)
@@ -0,0 +1,31 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+async def hit(scope, ident, limit, window=60):
+    """Фиксированное окно в общем кэше. Возвращает 0 или через сколько секунд можно повторить."""
+    if not limit:
+        return 0
+    now = time.time()
+    window_start = int(now // window)
+    key = f'throttle:{scope}:{hashlib.sha1(ident.encode()).hexdigest()}:{window_start}'
+    await cache.aadd(key, 0, window)
+    try:
+        count = await cache.aincr(key)
+    except ValueError:
+        # ключ истёк между add и incr - окно уже новое
+        return 0
+    if count > limit:
+        return max(1, int((window_start + 1) * window - now))
+    return 0
+
+
+async def auth_throttled(request, email=None):
+    """Лимиты на логин/регистрацию: по IP и по email."""
+    retry_after = await hit('auth-ip', request.META.get('REMOTE_ADDR', ''), settings.AUTH_THROTTLE_IP_PER_MINUTE)
+    if not retry_after and email:
+        retry_after = await hit('auth-email', str(email).strip().lower(), settings.AUTH_THROTTLE_EMAIL_PER_MINUTE)
+    return retry_after
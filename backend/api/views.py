@@ -1,13 +1,24 @@
 # backend/yourapp/views.py
-from rest_framework import viewsets, mixins, status, generics, permissions
+import asyncio
+import json
+
+from rest_framework import viewsets, mixins, status
 from rest_framework.response import Response
 from rest_framework.decorators import action
-from rest_framework.authentication import TokenAuthentication
+from rest_framework.views import APIView
+from rest_framework import serializers, exceptions
+from drf_spectacular.utils import OpenApiResponse, extend_schema, inline_serializer
 from rest_framework.permissions import IsAuthenticated
-from django.contrib.auth import get_user_model, authenticate, login
-from rest_framework.authtoken.models import Token
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views import View
+from asgiref.sync import sync_to_async
 
-from api.models import Order, Driver, Vehicle, Shipment, City
+from api.models import Order, Driver, Vehicle, Shipment, City, Downtime
 from api.serializers import (
     OrderSerializer,
     DispatcherOrderSerializer,
@@ -15,131 +26,456 @@ from api.serializers import (
     DriverSerializer,
     VehicleSerializer,
     LoginSerializer,
-    CitySerializer,
+    CitySerializer, CityDistanceSerializer, CitySearchSerializer,
     DispatcherAcceptSerializer, DispatcherRejectSerializer,
+    DispatcherBulkAcceptSerializer, DispatcherBulkRejectSerializer, DispatcherConsolidateSerializer,
     DispatcherShipmentSerializer, ClientShipmentSerializer,
-    DispatcherDeliverSerializer, DispatcherDelaySerializer
+    DispatcherDeliverSerializer, DispatcherDelaySerializer,
+    RouteAnalyticsParamsSerializer, RoutePlanSerializer, DowntimeSerializer,
 )
 
+from . import analytics, availability, booking, dashboard, routing
+from .bulk_import import BulkImportMixin
+from .authentication import CachedTokenAuthentication, issue_token, revoke_token, rotate_token
+from .async_views import AsyncAPIView, AsyncReadMixin
+from .conditional import ConditionalGetMixin
+from .caching import CITIES_VERSION_KEY, acached_json_response, acities_cache_key, cached_json_response, cities_cache_key
+from .hashing import HashingPoolBusy, hashing_pool
+from .distances import distance_matrix
+from .events import get_broker
+from .export import ORDER_EXPORT_COLUMNS, SHIPMENT_EXPORT_COLUMNS, ExportMixin
+from .matching import suggest_for_order
+from .consolidation import build_consolidation_plan
+from .planner import build_plan
 from .permissions import IsClient, IsDispatcher
+from .spatial import city_index, nearby_from_db
+from .throttling import auth_throttled
 from datetime import datetime
 
 User = get_user_model()
 
-class RegisterView(generics.CreateAPIView):
-    serializer_class = UserSerializer
-    permission_classes = [permissions.AllowAny]
+def request_data(request):
+    # async-вью работают без парсеров DRF: JSON-объект или обычная форма.
+    # Некорректный JSON и JSON не-объект ([], "x") - ValueError, вью отвечают 400
+    if request.content_type == 'application/json':
+        data = json.loads(request.body or b'{}')
+        if not isinstance(data, dict):
+            raise ValueError('JSON body must be an object')
+        return data
+    return request.POST
+
+
+def auth_payload(user, token):
+    return {
+        'token': token.key,
+        'user_id': user.pk,
+        'email': user.email,
+        'username': user.username,
+        'role': user.role,
+        'first_name': user.first_name,
+        'last_name': user.last_name
+    }
+
+
+def too_many_requests(retry_after):
+    response = JsonResponse({'error': 'Too many attempts'}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
+def hashing_busy():
+    response = JsonResponse({'error': 'Server busy, retry later'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    response['Retry-After'] = '1'
+    return response
+
+
+AUTH_RESPONSE = inline_serializer('AuthResponse', fields={
+    'token': serializers.CharField(),
+    'user_id': serializers.UUIDField(),
+    'email': serializers.EmailField(),
+    'username': serializers.CharField(),
+    'role': serializers.ChoiceField(choices=User.RoleChoices.choices),
+    'first_name': serializers.CharField(),
+    'last_name': serializers.CharField(),
+})
+AUTH_ERRORS = {
+    400: OpenApiResponse(description='Некорректные данные'),
+    429: OpenApiResponse(description='Слишком много попыток, см. Retry-After'),
+    503: OpenApiResponse(description='Пул хэширования паролей занят, см. Retry-After'),
+}
+
+
+# Регистрация и логин - async: PBKDF2 считается в ограниченном пуле (api/hashing.py),
+# а не на воркере запроса, поэтому шторм логинов не блокирует остальные эндпоинты
+class RegisterView(AsyncAPIView):
+    @extend_schema(request=UserSerializer, responses={201: AUTH_RESPONSE, **AUTH_ERRORS})
+    async def post(self, request, *args, **kwargs):
+        try:
+            data = request_data(request)
+        except ValueError:
+            return JsonResponse({'error': 'Invalid JSON'}, status=status.HTTP_400_BAD_REQUEST)
+        retry_after = await auth_throttled(request, data.get('email'))
+        if retry_after:
+            return too_many_requests(retry_after)
+
+        serializer = UserSerializer(data=data)
+        if not await sync_to_async(serializer.is_valid)():
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            password_hash = await hashing_pool.hash(serializer.validated_data['password'])
+        except HashingPoolBusy:
+            return hashing_busy()
+
+        @sync_to_async
+        def create():
+            user = serializer.save(password_hash=password_hash)
+            return user, issue_token(user)
 
+        user, token = await create()
+        return JsonResponse(auth_payload(user, token), status=status.HTTP_201_CREATED)
+
+
+class LoginView(AsyncAPIView):
+    @extend_schema(request=LoginSerializer, responses={200: AUTH_RESPONSE, **AUTH_ERRORS})
+    async def post(self, request, *args, **kwargs):
+        try:
+            serializer = LoginSerializer(data=request_data(request))
+        except ValueError:
+            return JsonResponse({'error': 'Invalid JSON'}, status=status.HTTP_400_BAD_REQUEST)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        email = serializer.validated_data['email']
+        password = serializer.validated_data['password']
+        retry_after = await auth_throttled(request, email)
+        if retry_after:
+            return too_many_requests(retry_after)
+
+        user = await User.objects.filter(email=email).afirst()
+        try:
+            valid, must_update = await hashing_pool.verify(password, user.password if user else None)
+            if valid and must_update:
+                # хэшер или число итераций поменялись - перехэшируем, как это делает check_password
+                user.password = await hashing_pool.hash(password)
+                await user.asave(update_fields=['password'])
+        except HashingPoolBusy:
+            return hashing_busy()
+
+        if valid and user.is_active:
+            token = await sync_to_async(issue_token)(user)
+            return JsonResponse(auth_payload(user, token))
+        return JsonResponse({'error': 'Invalid Credentials'}, status=status.HTTP_400_BAD_REQUEST)
+
+
+class LogoutView(APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    @extend_schema(request=None, responses={204: None})
     def post(self, request, *args, **kwargs):
-        serializer = self.get_serializer(data=request.data)
-        serializer.is_valid(raise_exception=True)
-        user = serializer.save()
-        token, created = Token.objects.get_or_create(user=user)
-        return Response({
-            'token': token.key,
-            'user_id': user.pk,
-            'email': user.email,
-            'username': user.username,
-            'role': user.role,
-            'first_name': user.first_name,
-            'last_name': user.last_name
-        }, status=status.HTTP_201_CREATED)
-
-class LoginView(generics.GenericAPIView):
-    serializer_class = LoginSerializer
-    permission_classes = [permissions.AllowAny]
+        revoke_token(request.user)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
 
+class TokenRefreshView(APIView):
+    # Выдаёт новый токен взамен текущего, старый сразу перестаёт работать
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    @extend_schema(
+        request=None,
+        responses=inline_serializer('TokenRefreshResponse', fields={'token': serializers.CharField()}),
+    )
     def post(self, request, *args, **kwargs):
-        serializer = self.get_serializer(data=request.data)
-        serializer.is_valid(raise_exception=True)
-        user = authenticate(
-            email=serializer.validated_data['email'],
-            password=serializer.validated_data['password']
-        )
-        if user:
-            token, created = Token.objects.get_or_create(user=user)
-            return Response({
-                'token': token.key,
-                'user_id': user.pk,
-                'email': user.email,
-                'username': user.username,
-                'role': user.role,
-                'first_name': user.first_name,
-                'last_name': user.last_name
-            })
-        return Response({'error': 'Invalid Credentials'}, status=status.HTTP_400_BAD_REQUEST)
-
-
-class ClientOrderViewSet(viewsets.GenericViewSet,
+        token = rotate_token(request.user)
+        return Response({'token': token.key})
+
+
+def sse_message(event):
+    lines = [f'event: {event["type"]}', f'data: {json.dumps(event["data"])}']
+    if event['id'] is not None:
+        lines.insert(0, f'id: {event["id"]}')
+    return '\n'.join(lines) + '\n\n'
+
+
+class EventStreamView(View):
+    """GET /api/events/ - Server-Sent Events со сменами статусов заказов и перевозок
+    текущего пользователя (клиента или диспетчера) вместо опроса списков.
+
+    Токен - в Authorization или ?token= (браузерный EventSource не умеет заголовки).
+    После обрыва EventSource сам присылает Last-Event-ID и получает пропущенное.
+    Держит соединение открытым - только под ASGI. Под WSGI бесконечный поток занял бы
+    поток воркера навсегда, поэтому там 501."""
+
+    async def get(self, request, *args, **kwargs):
+        if not isinstance(request, ASGIRequest):
+            return JsonResponse(
+                {'detail': 'Server-Sent Events доступны только под ASGI (SERVER_INTERFACE=asgi).'},
+                status=status.HTTP_501_NOT_IMPLEMENTED,
+            )
+        header = request.headers.get('Authorization', '').split()
+        if len(header) == 2 and header[0] == 'Token':
+            key = header[1]
+        else:
+            key = request.GET.get('token', '')
+        try:
+            user, _ = await sync_to_async(CachedTokenAuthentication().authenticate_credentials)(key)
+        except exceptions.AuthenticationFailed as e:
+            return JsonResponse({'detail': str(e.detail)}, status=status.HTTP_401_UNAUTHORIZED)
+
+        last_event_id = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id')
+        events = get_broker().subscribe(user.pk, last_event_id)
+        response = StreamingHttpResponse(self.stream(events), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # nginx не должен копить поток
+        return response
+
+    async def stream(self, events):
+        heartbeat = settings.EVENTS_HEARTBEAT_SECONDS
+        yield f'retry: {settings.EVENTS_RETRY_MS}\n\n'
+        try:
+            pending = asyncio.ensure_future(anext(events))
+            while True:
+                # комментарий-пинг держит соединение через прокси и вскрывает отвалившихся клиентов
+                done, _ = await asyncio.wait({pending}, timeout=heartbeat)
+                if not done:
+                    yield ': ping\n\n'
+                    continue
+                yield sse_message(pending.result())
+                pending = asyncio.ensure_future(anext(events))
+        finally:
+            # клиент отключился: ждём отмены pending, иначе aclose() упадёт на работающем генераторе
+            pending.cancel()
+            await asyncio.wait({pending})
+            await events.aclose()
+
+
+class DashboardView(APIView):
+    # Сводка для дашборда диспетчера из счётчиков (api/dashboard.py), без обхода заказов
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated, IsDispatcher]
+
+    @extend_schema(responses=inline_serializer('Dashboard', fields={
+        'orders': serializers.DictField(child=serializers.IntegerField()),
+        'shipments': serializers.DictField(child=serializers.IntegerField()),
+        'revenue': serializers.DecimalField(max_digits=20, decimal_places=3),
+        'reviews': serializers.IntegerField(),
+        'average_rating': serializers.FloatField(allow_null=True),
+    }))
+    def get(self, request, *args, **kwargs):
+        return Response(dashboard.read())
+
+
+class RouteAnalyticsView(APIView):
+    # Статистика по маршрутам за окно: GROUP BY в БД по часовым/суточным бакетам,
+    # закрытые бакеты берутся из кэша (api/analytics.py)
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated, IsDispatcher]
+
+    @extend_schema(
+        parameters=[RouteAnalyticsParamsSerializer],
+        responses=inline_serializer('RouteAnalytics', fields={
+            'since': serializers.DateTimeField(),
+            'until': serializers.DateTimeField(),
+            'routes': serializers.ListField(child=serializers.DictField()),
+        }),
+    )
+    def get(self, request, *args, **kwargs):
+        params = RouteAnalyticsParamsSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        return Response(analytics.route_stats(**params.validated_data))
+
+
+class RoutePlanView(APIView):
+    # Порядок объезда городов для машины с несколькими заказами: погрузка раньше выгрузки,
+    # ближайший сосед + 2-opt/Or-opt по haversine-расстояниям (api/routing.py)
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated, IsDispatcher]
+
+    @extend_schema(
+        request=RoutePlanSerializer,
+        responses=inline_serializer('RoutePlanResult', fields={
+            'route': serializers.ListField(child=serializers.DictField()),
+            'distance_km': serializers.FloatField(),
+            'initial_distance_km': serializers.FloatField(),
+            'solve_ms': serializers.FloatField(),
+        }),
+    )
+    def post(self, request, *args, **kwargs):
+        params = RoutePlanSerializer(data=request.data)
+        params.is_valid(raise_exception=True)
+        data = params.validated_data
+        stops = data.get('stops') or routing.stops_for_orders(data['orders'])
+        return Response(routing.build_route(stops, start=data.get('start')))
+
+
+class ClientOrderViewSet(ConditionalGetMixin,
+                         AsyncReadMixin,
+                         viewsets.GenericViewSet,
                          mixins.CreateModelMixin,
                          mixins.ListModelMixin,
                          mixins.RetrieveModelMixin):
     serializer_class = OrderSerializer
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated, IsClient]
+    # distance_km зависит от координат городов
+    validator_versions = (CITIES_VERSION_KEY,)
 
     def get_queryset(self):
         return Order.objects.filter(client=self.request.user)
 
+    async def aserialize(self, instance, many=False):
+        # distance_km считается по координатам из общего файла - открываем его вне event loop
+        await sync_to_async(distance_matrix.ensure_loaded)()
+        return await super().aserialize(instance, many=many)
+
+    @transaction.atomic
     def perform_create(self, serializer):
         serializer.save(client=self.request.user)
+        dashboard.record({dashboard.order_key(Order.StatusChoices.PENDING): 1})
 
-class DispatcherOrderViewSet(viewsets.GenericViewSet, mixins.ListModelMixin, mixins.RetrieveModelMixin):
-    authentication_classes = [TokenAuthentication]
+class DispatcherOrderViewSet(ConditionalGetMixin, ExportMixin, viewsets.GenericViewSet,
+                             mixins.ListModelMixin, mixins.RetrieveModelMixin):
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated, IsDispatcher]
-    queryset = Order.objects.all()
+    # client вложен в DispatcherOrderSerializer - подтягиваем JOIN-ом, его updated_at - в валидаторах
+    validator_fields = ('updated_at', 'client__updated_at')
+    validator_versions = (CITIES_VERSION_KEY,)
+    queryset = Order.objects.select_related('client')
+    export_columns = ORDER_EXPORT_COLUMNS
+    export_name = 'orders'
 
     def get_serializer_class(self):
         if self.action == 'accept':
             return DispatcherAcceptSerializer
         elif self.action == 'reject':
             return DispatcherRejectSerializer
+        elif self.action in ('bulk_accept', 'apply_plan'):
+            return DispatcherBulkAcceptSerializer
+        elif self.action == 'bulk_reject':
+            return DispatcherBulkRejectSerializer
+        elif self.action == 'consolidate':
+            return DispatcherConsolidateSerializer
         return DispatcherOrderSerializer
 
     @action(detail=True, methods=['post'])
     def accept(self, request, pk=None):
-        order = self.get_object()
-        if order.status != Order.StatusChoices.PENDING:
-            return Response({'error': 'Order not pending'}, status=status.HTTP_400_BAD_REQUEST)
-        # ожидаем в body: driver (PK) и vehicle (PK)
-        driver_id = request.data.get('driver')
-        vehicle_id = request.data.get('vehicle')
-        try:
-            driver = Driver.objects.get(pk=driver_id)
-            vehicle = Vehicle.objects.get(pk=vehicle_id)
-        except (Driver.DoesNotExist, Vehicle.DoesNotExist):
-            return Response({'error': 'Driver or Vehicle not found'}, status=status.HTTP_400_BAD_REQUEST)
-        # Проверяем availability:
-        if not driver.is_available or not vehicle.is_available:
-            return Response({'error': 'Driver or Vehicle not available'}, status=status.HTTP_400_BAD_REQUEST)
-        arrival_time = request.data.get('arrival_time')
-        price = request.data.get('price')
-        # После проверок:
-        order.status = Order.StatusChoices.CONFIRMED
-        order.dispatcher = request.user
-        order.save()
-        # создаём Shipment
-        Shipment.objects.create(order=order, driver=driver, vehicle=vehicle, arrival_time=arrival_time, price=price)
-        # отмечаем их как занятые
-        driver.is_available = False
-        driver.save()
-        vehicle.is_available = False
-        vehicle.save()
-        return Response({'status': order.status})
+        # ожидаем в body: driver (PK), vehicle (PK), [departure_time], arrival_time, price
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        try:
+            shipment = booking.accept_order(
+                pk, data['driver'], data['vehicle'], data['arrival_time'], data['price'],
+                dispatcher=request.user, departure_time=data.get('departure_time'),
+            )
+        except booking.BookingError as e:
+            return Response({'error': e.message}, status=e.status_code)
+        return Response({'status': shipment.order.status})
 
     @action(detail=True, methods=['post'])
     def reject(self, request, pk=None):
+        try:
+            order_status = booking.reject_order(pk, dispatcher=request.user)
+        except booking.BookingError as e:
+            return Response({'error': e.message}, status=e.status_code)
+        return Response({'status': order_status})
+
+    @action(detail=True, methods=['get'])
+    def suggest(self, request, pk=None):
+        # Подбор пар водитель + машина под вес/объём заказа, ?limit=10
         order = self.get_object()
         if order.status != Order.StatusChoices.PENDING:
             return Response({'error': 'Order not pending'}, status=status.HTTP_400_BAD_REQUEST)
-        order.status = Order.StatusChoices.CANCELLED
-        order.dispatcher = request.user
-        order.save()
-        return Response({'status': order.status})
+        try:
+            limit = min(int(request.query_params.get('limit', 10)), 100)
+        except ValueError:
+            return Response({'error': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'order': order.pk, 'suggestions': suggest_for_order(order, limit=max(limit, 1))})
+
+    def get_bulk_items(self, request):
+        serializer = self.get_serializer(
+            data=request.data, many=True, max_length=settings.BULK_ACTION_MAX_ITEMS,
+        )
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data
+
+    @action(detail=False, methods=['post'], url_path='bulk-accept')
+    def bulk_accept(self, request):
+        # body: [{order, driver, vehicle, [departure_time], arrival_time, price}, ...]
+        items = self.get_bulk_items(request)
+        try:
+            results = booking.accept_orders(items, dispatcher=request.user)
+        except booking.BookingError as e:
+            return Response({'error': e.message}, status=e.status_code)
+        return Response(results)
+
+    def planner_limit(self, request):
+        limit = min(int(request.query_params.get('limit', settings.PLANNER_MAX_ORDERS)), settings.PLANNER_MAX_ORDERS)
+        return max(limit, 1)
+
+    @action(detail=False, methods=['get'])
+    def plan(self, request):
+        # Dry-run: глобальное назначение Pending-заказов на свободный парк, ничего не меняет
+        try:
+            limit = self.planner_limit(request)
+        except ValueError:
+            return Response({'error': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(build_plan(limit=limit))
 
-class DispatcherShipmentViewSet(viewsets.GenericViewSet, mixins.ListModelMixin, mixins.RetrieveModelMixin):
-    authentication_classes = [TokenAuthentication]
+    @action(detail=False, methods=['get'], url_path='consolidation-plan')
+    def consolidation_plan(self, request):
+        # Dry-run: сборные рейсы - несколько Pending-заказов одного маршрута в одну машину
+        try:
+            limit = self.planner_limit(request)
+        except ValueError:
+            return Response({'error': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(build_consolidation_plan(limit=limit))
+
+    @action(detail=False, methods=['post'])
+    def consolidate(self, request):
+        # body: {orders: [...], driver, vehicle, [departure_time], arrival_time, price} - рейс из consolidation-plan
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        try:
+            shipment = booking.consolidate_orders(
+                data['orders'], data['driver'], data['vehicle'], data['arrival_time'], data['price'],
+                dispatcher=request.user, departure_time=data.get('departure_time'),
+            )
+        except booking.BookingError as e:
+            return Response({'error': e.message}, status=e.status_code)
+        return Response({'shipment': shipment.pk, 'status': shipment.order.status})
+
+    @action(detail=False, methods=['post'], url_path='plan/apply')
+    def apply_plan(self, request):
+        # body: назначения из plan, дополненные arrival_time и price.
+        # Применяется как bulk-accept: устаревшие пункты плана вернутся с ошибкой.
+        items = self.get_bulk_items(request)
+        try:
+            results = booking.accept_orders(items, dispatcher=request.user)
+        except booking.BookingError as e:
+            return Response({'error': e.message}, status=e.status_code)
+        return Response(results)
+
+    @action(detail=False, methods=['post'], url_path='bulk-reject')
+    def bulk_reject(self, request):
+        # body: [{order}, ...]
+        items = self.get_bulk_items(request)
+        try:
+            results = booking.reject_orders([item['order'] for item in items], dispatcher=request.user)
+        except booking.BookingError as e:
+            return Response({'error': e.message}, status=e.status_code)
+        return Response(results)
+
+class DispatcherShipmentViewSet(ConditionalGetMixin, AsyncReadMixin, ExportMixin, viewsets.GenericViewSet,
+                                mixins.ListModelMixin, mixins.RetrieveModelMixin):
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated, IsDispatcher]
+    # в ответ вложены заказ (с distance_km) и водитель
+    validator_fields = ('updated_at', 'order__updated_at', 'driver__updated_at')
+    validator_versions = (CITIES_VERSION_KEY,)
+    export_columns = SHIPMENT_EXPORT_COLUMNS
+    export_name = 'shipments'
 
     def get_serializer_class(self):
         if self.action == 'deliver':
@@ -149,36 +485,31 @@ class DispatcherShipmentViewSet(viewsets.GenericViewSet, mixins.ListModelMixin,
         return DispatcherShipmentSerializer
 
     def get_queryset(self):
-        orders = Order.objects.filter(dispatcher=self.request.user)
-        return Shipment.objects.filter(order__in=orders)
+        # driver и order вложены в DispatcherShipmentSerializer
+        return Shipment.objects.filter(
+            order__dispatcher=self.request.user
+        ).select_related('driver', 'order')
+
+    async def aserialize(self, instance, many=False):
+        # во вложенном заказе есть distance_km - файл координат открываем вне event loop
+        await sync_to_async(distance_matrix.ensure_loaded)()
+        return await super().aserialize(instance, many=many)
     
     @action(detail=True, methods=['post'])
     def deliver(self, request, pk=None):
-        shipment = self.get_object()
-        if shipment.status != Shipment.StatusChoices.IN_PROGRESS:
-            return Response({'error': f"Разрешено обновлять только доставки со статусом {Shipment.StatusChoices.IN_PROGRESS}"},
-                            status=status.HTTP_400_BAD_REQUEST)
-        shipment.status = Shipment.StatusChoices.DELIVERED
-        shipment.save(update_fields=['status'])
-
-        driver = shipment.driver
-        driver.is_available = True
-        driver.save(update_fields=['is_available'])
-
-        vehicle = shipment.vehicle
-        vehicle.is_available = True
-        vehicle.save(update_fields=['is_available'])
-        return Response({'status': shipment.status})
+        try:
+            shipment_status = booking.deliver_shipment(pk, dispatcher=request.user)
+        except booking.BookingError as e:
+            return Response({'error': e.message}, status=e.status_code)
+        return Response({'status': shipment_status})
 
     @action(detail=True, methods=['post'])
     def delay(self, request, pk=None):
-        shipment = self.get_object()
-        if shipment.status != Shipment.StatusChoices.IN_PROGRESS:
-            return Response({'error': f"Разрешено обновлять только доставки со статусом {Shipment.StatusChoices.IN_PROGRESS}"},
-                            status=status.HTTP_400_BAD_REQUEST)
-        shipment.status = Shipment.StatusChoices.DELAYED
-        shipment.save()
-        return Response({'status': shipment.status})
+        try:
+            shipment_status = booking.delay_shipment(pk, dispatcher=request.user)
+        except booking.BookingError as e:
+            return Response({'error': e.message}, status=e.status_code)
+        return Response({'status': shipment_status})
     
 
     # def partial_update(self, request, *args, **kwargs):
@@ -201,17 +532,23 @@ class DispatcherShipmentViewSet(viewsets.GenericViewSet, mixins.ListModelMixin,
     #     return Response(self.get_serializer(instance).data)
 
 
-class ClientShipmentViewSet(viewsets.GenericViewSet,
+class ClientShipmentViewSet(ConditionalGetMixin,
+                            AsyncReadMixin,
+                            viewsets.GenericViewSet,
                             mixins.ListModelMixin,
                             mixins.RetrieveModelMixin,
                             mixins.UpdateModelMixin):
     serializer_class = ClientShipmentSerializer
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated, IsClient]
 
     def get_queryset(self):
-        orders = Order.objects.filter(client=self.request.user)
-        return Shipment.objects.filter(order__in=orders)
+        # свои рейсы и сборные, в которых едет хотя бы один заказ клиента
+        user = self.request.user
+        return Shipment.objects.filter(
+            Q(order__client=user)
+            | Exists(Order.objects.filter(consolidated_shipment=OuterRef('pk'), client=user))
+        )
     
     def partial_update(self, request, *args, **kwargs):
         # Оставление отзыва
@@ -220,36 +557,171 @@ class ClientShipmentViewSet(viewsets.GenericViewSet,
             return Response({'detail': 'Можно обновлять только review_rating и review_text.'}, status=status.HTTP_400_BAD_REQUEST)
         
         instance = self.get_object()
+        if instance.order.client_id != request.user.pk:
+            return Response({'detail': 'Отзыв к сборному рейсу оставляет владелец основного заказа.'}, status=status.HTTP_403_FORBIDDEN)
         if instance.status != Shipment.StatusChoices.DELIVERED:
             return Response({'detail': 'Добавлять отзывы можно только к выполненным доставкам.'}, status=status.HTTP_400_BAD_REQUEST)
         instance.review_created_at = datetime.now()
         instance.save()
         return super().partial_update(request, *args, **kwargs)
+
+    @transaction.atomic
+    def perform_update(self, serializer):
+        # прежняя оценка - под блокировкой, чтобы параллельные отзывы не сбили счётчики дашборда
+        old_rating = Shipment.objects.select_for_update().values_list('review_rating', flat=True).get(
+            pk=serializer.instance.pk,
+        )
+        shipment = serializer.save()
+        dashboard.record(dashboard.review_changed(old_rating, shipment.review_rating))
     
     
 
-class DriverViewSet(viewsets.ModelViewSet):
+class DriverViewSet(availability.FreeWindowMixin, ConditionalGetMixin, BulkImportMixin, viewsets.ModelViewSet):
     queryset = Driver.objects.all()
     serializer_class = DriverSerializer
-    authentication_classes = [TokenAuthentication]
+    cursor_ordering = ('pk',)
+    import_name = 'drivers'
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated, IsDispatcher]
 
-class VehicleViewSet(viewsets.ModelViewSet):
+class VehicleViewSet(availability.FreeWindowMixin, ConditionalGetMixin, BulkImportMixin, viewsets.ModelViewSet):
     queryset = Vehicle.objects.all()
     serializer_class = VehicleSerializer
-    authentication_classes = [TokenAuthentication]
+    cursor_ordering = ('pk',)
+    import_name = 'vehicles'
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated, IsDispatcher]
+
+class DowntimeViewSet(viewsets.ModelViewSet):
+    # Плановые простои водителей и машин; пересечение с рейсами и другими простоями - 400
+    queryset = Downtime.objects.all()
+    serializer_class = DowntimeSerializer
+    cursor_ordering = ('-start', '-pk')
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated, IsDispatcher]
 
-class CityViewSet(viewsets.ModelViewSet):
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        for field in ('driver', 'vehicle'):
+            if field in self.request.query_params:
+                queryset = queryset.filter(**{field: self.request.query_params[field]})
+        return queryset
+
+    @staticmethod
+    def resource(downtime):
+        return (Driver, downtime.driver_id) if downtime.driver_id else (Vehicle, downtime.vehicle_id)
+
+    def perform_save(self, serializer):
+        previous = serializer.instance
+        fields = {} if previous is None else {
+            'pk': previous.pk, 'driver': previous.driver, 'vehicle': previous.vehicle,
+            'start': previous.start, 'end': previous.end,
+        }
+        candidate = Downtime(**{**fields, **serializer.validated_data})
+        resources = {self.resource(candidate)} | ({self.resource(previous)} if previous else set())
+        with transaction.atomic():
+            model, resource_id = self.resource(candidate)
+            # блокировка ресурса, как в booking: параллельный accept не займёт то же окно
+            list(model.objects.select_for_update().filter(pk=resource_id).values_list('pk'))
+            availability.check_downtime(candidate)
+            serializer.save()
+            for model, resource_id in resources:
+                availability.sync_available(model, [resource_id])
+
+    def perform_create(self, serializer):
+        self.perform_save(serializer)
+
+    def perform_update(self, serializer):
+        self.perform_save(serializer)
+
+    def perform_destroy(self, instance):
+        model, resource_id = self.resource(instance)
+        with transaction.atomic():
+            instance.delete()
+            availability.sync_available(model, [resource_id])
+
+class CityViewSet(AsyncReadMixin, BulkImportMixin, viewsets.ModelViewSet):
     queryset = City.objects.all()
     serializer_class = CitySerializer
-    authentication_classes = [TokenAuthentication]
+    import_name = 'cities'
+    authentication_classes = [CachedTokenAuthentication]
+    # справочник городов отдаём целиком, без пагинации
+    pagination_class = None
 
     def get_permissions(self):
-        # для клиента только GET
-        if self.action in ["list", "retrieve"]:
+        # для клиента только чтение, расчёт расстояний и поиск по координатам
+        if self.action in ["list", "retrieve", "distances", "nearby", "nearest"]:
             permission_classes =  [(IsDispatcher | IsClient)]
         else:
             permission_classes = [IsDispatcher]
         return [perm() for perm in permission_classes]
 
+    # Справочник почти не меняется: ответы list/retrieve кэшируются готовыми байтами
+    # и сбрасываются сменой версии при любой записи в City (см. signals)
+    def list(self, request, *args, **kwargs):
+        return cached_json_response(
+            request, cities_cache_key('list'), lambda: super(CityViewSet, self).list(request, *args, **kwargs),
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        return cached_json_response(
+            request, cities_cache_key('detail', kwargs['pk']),
+            lambda: super(CityViewSet, self).retrieve(request, *args, **kwargs),
+        )
+
+    async def alist(self, request, *args, **kwargs):
+        return await acached_json_response(
+            request, await acities_cache_key('list'), lambda: super(CityViewSet, self).alist(request, *args, **kwargs),
+        )
+
+    async def aretrieve(self, request, *args, **kwargs):
+        return await acached_json_response(
+            request, await acities_cache_key('detail', kwargs['pk']),
+            lambda: super(CityViewSet, self).aretrieve(request, *args, **kwargs),
+        )
+
+    def get_serializer_class(self):
+        if self.action == 'distances':
+            return CityDistanceSerializer
+        if self.action in ('nearby', 'nearest'):
+            return CitySearchSerializer
+        return super().get_serializer_class()
+
+    def get_search_params(self, request):
+        serializer = self.get_serializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data
+
+    @action(detail=False, methods=['get'])
+    def nearby(self, request):
+        # ?lat=&lon=&radius=<км>&limit= или ?city=<uuid>&radius=; source=db - bounding box в БД вместо индекса
+        params = self.get_search_params(request)
+        if 'radius' not in params:
+            return Response({'radius': ['This field is required.']}, status=status.HTTP_400_BAD_REQUEST)
+        search = nearby_from_db if params['source'] == 'db' else city_index.nearby
+        return Response(search(
+            params['lat'], params['lon'], params['radius'], limit=params['limit'], exclude=params.get('city'),
+        ))
+
+    @action(detail=False, methods=['get'])
+    def nearest(self, request):
+        # ?lat=&lon=&k= или ?city=<uuid>&k= (сам город в ответ не попадает)
+        params = self.get_search_params(request)
+        return Response(city_index.nearest(params['lat'], params['lon'], k=params['k'], exclude=params.get('city')))
+
+    @action(detail=False, methods=['post'])
+    def distances(self, request):
+        # body: [{city_from, city_to}, ...] -> те же пары с distance_km (null для неизвестного города)
+        serializer = self.get_serializer(
+            data=request.data, many=True, max_length=settings.BULK_ACTION_MAX_ITEMS,
+        )
+        serializer.is_valid(raise_exception=True)
+        pairs = serializer.validated_data
+        result = distance_matrix.distances(
+            [pair['city_from'] for pair in pairs], [pair['city_to'] for pair in pairs],
+        )
+        return Response([
+            {'city_from': pair['city_from'], 'city_to': pair['city_to'], 'distance_km': distance_km}
+            for pair, distance_km in zip(pairs, result)
+        ])
+
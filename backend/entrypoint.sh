@@ -16,5 +16,8 @@ echo "PostgreSQL is up - continuing"
 echo "Apply database migrations"
 python manage.py migrate --noinput
 
+# Файл координат для расстояний между городами: в запросах он не собирается
+python manage.py build_distance_matrix --missing-only
+
 # Затем выполняем CMD
 exec "$@"
\ No newline at end of file
@@ -0,0 +1,35 @@
+# Продакшен-конфиг gunicorn: gunicorn -c gunicorn.conf.py
+import multiprocessing
+import os
+
+
+def env(name, default=None):
+    # пустое значение (NAME= в .env) - как не заданное
+    return os.environ.get(name) or default
+
+
+bind = env('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(env('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+
+if env('SERVER_INTERFACE', 'asgi') == 'wsgi':
+    # WSGI-потоки: async-вью выполняются синхронно, SSE (GET /api/events/) отвечает 501
+    wsgi_app = 'there_n_back_backend.wsgi:application'
+    worker_class = 'gthread'
+    threads = int(env('GUNICORN_THREADS', '4'))
+else:
+    # async-вью (логин, SSE) работают на event loop, синхронные - в потоке asgiref
+    wsgi_app = 'there_n_back_backend.asgi:application'
+    worker_class = 'uvicorn_worker.UvicornWorker'
+
+# воркер, не ответивший за timeout, перезапускается; при деплое даём дообработать запросы
+timeout = int(env('GUNICORN_TIMEOUT', '30'))
+graceful_timeout = 30
+keepalive = 5
+# периодический перезапуск воркеров против утечек памяти, с разбросом, чтобы не все сразу
+max_requests = 2000
+max_requests_jitter = 200
+# heartbeat-файлы воркеров в памяти, а не на overlay-диске контейнера
+worker_tmp_dir = '/dev/shm'
+
+accesslog = '-'
+errorlog = '-'
@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "there_n_back_backend.settings")
+# настройки, зависящие от сервера (ASYNC_READ_PATH), должны знать, что запущены под ASGI
+os.environ["SERVER_INTERFACE"] = "asgi"
 
 application = get_asgi_application()
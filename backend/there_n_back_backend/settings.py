@@ -17,11 +17,16 @@ import os
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 
+def env(name, default=None):
+    """Переменная окружения; пустое значение (NAME= в .env) - как не заданное."""
+    return os.environ.get(name) or default
+
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.1/howto/deployment/checklist/
 
 SECRET_KEY = os.environ.get('SECRET_KEY', 'fallback-dev-key')  # fallback только для dev
-DEBUG = os.environ.get('DEBUG', '0') == '1'
+DEBUG = env('DEBUG', '0') == '1'
 
 ALLOWED_HOSTS = os.environ.get('ALLOWED_HOSTS', '').split(',') if os.environ.get('ALLOWED_HOSTS') else []
 
@@ -79,14 +84,39 @@ WSGI_APPLICATION = "there_n_back_backend.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# Пул соединений psycopg 3 (DB_POOL_MAX_SIZE > 0) - для продакшена, в том числе под ASGI.
+# Без пула соединение живёт DB_CONN_MAX_AGE секунд и переиспользуется потоком воркера.
+DB_POOL_MAX_SIZE = int(env('DB_POOL_MAX_SIZE', '0'))
+DB_STATEMENT_TIMEOUT_MS = int(env('DB_STATEMENT_TIMEOUT_MS', '30000'))
+
+DB_OPTIONS = {
+    'connect_timeout': int(env('DB_CONNECT_TIMEOUT', '5')),
+}
+if DB_STATEMENT_TIMEOUT_MS:
+    DB_OPTIONS['options'] = f'-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}'
+if DB_POOL_MAX_SIZE:
+    DB_OPTIONS['pool'] = {
+        'min_size': int(env('DB_POOL_MIN_SIZE', '2')),
+        'max_size': DB_POOL_MAX_SIZE,
+        # сколько ждать свободное соединение, прежде чем отдать ошибку
+        'timeout': float(env('DB_POOL_TIMEOUT', '10')),
+        'max_idle': 300,
+        'max_lifetime': 3600,
+    }
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
-        'NAME': os.environ.get('POSTGRES_DB', 'there_n_back'),
-        'USER': os.environ.get('POSTGRES_USER', 'postgres'),
-        'PASSWORD': os.environ.get('POSTGRES_PASSWORD', 'postgres'),
-        'HOST': os.environ.get('DB_HOST', 'db'),
-        'PORT': os.environ.get('DB_PORT', '5432'),
+        'NAME': env('POSTGRES_DB', 'there_n_back'),
+        'USER': env('POSTGRES_USER', 'postgres'),
+        'PASSWORD': env('POSTGRES_PASSWORD', 'postgres'),
+        'HOST': env('DB_HOST', 'db'),
+        'PORT': env('DB_PORT', '5432'),
+        # пул не совместим с постоянными соединениями Django
+        'CONN_MAX_AGE': 0 if DB_POOL_MAX_SIZE else int(env('DB_CONN_MAX_AGE', '60')),
+        # проверка соединения перед использованием (для пула - check_connection при выдаче)
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': DB_OPTIONS,
     }
 }
 
@@ -134,14 +164,123 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
+    'DEFAULT_PAGINATION_CLASS': 'api.pagination.CreatedAtCursorPagination',
+    'PAGE_SIZE': int(env('PAGE_SIZE', '50')),
 }
 
+# Верхняя граница для ?page_size= в курсорной пагинации
+MAX_PAGE_SIZE = int(env('MAX_PAGE_SIZE', '500'))
+
+# Максимум элементов в одном запросе bulk-accept / bulk-reject
+BULK_ACTION_MAX_ITEMS = int(env('BULK_ACTION_MAX_ITEMS', '1000'))
+
+# Как часто (сек) in-memory индекс парка перечитывается из БД целиком
+FLEET_INDEX_REFRESH_SECONDS = int(env('FLEET_INDEX_REFRESH_SECONDS', '30'))
+
+# Сколько Pending-заказов планировщик берёт за один прогон
+PLANNER_MAX_ORDERS = int(env('PLANNER_MAX_ORDERS', '5000'))
+
+# Оптимизатор маршрута с несколькими остановками: максимум точек и бюджет локального поиска (мс)
+ROUTING_MAX_STOPS = int(env('ROUTING_MAX_STOPS', '1000'))
+ROUTING_TIME_LIMIT_MS = int(env('ROUTING_TIME_LIMIT_MS', '80'))
+
+# Период (сек) полной перезагрузки in-memory индекса городов для поиска по радиусу
+CITY_INDEX_REFRESH_SECONDS = int(env('CITY_INDEX_REFRESH_SECONDS', '300'))
+
+# Общий кэш (и брокер событий) для всех воркеров; без REDIS_URL - локальный кэш процесса (только для разработки)
+REDIS_URL = env('REDIS_URL')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Кэш справочника городов: срок жизни записи и max-age для клиента (сек)
+CITY_CACHE_TIMEOUT = int(env('CITY_CACHE_TIMEOUT', '86400'))
+CITY_CACHE_MAX_AGE = int(env('CITY_CACHE_MAX_AGE', '0'))
+
+# Срок жизни токена (сек, 0 - бессрочный) и возраст, после которого логин выдаёт новый токен
+TOKEN_EXPIRE_SECONDS = int(env('TOKEN_EXPIRE_SECONDS', str(30 * 24 * 3600)))
+TOKEN_ROTATE_SECONDS = int(env('TOKEN_ROTATE_SECONDS', str(7 * 24 * 3600)))
+
+# In-process кэш token -> user: время жизни записи (сек) и максимум записей
+TOKEN_CACHE_TTL = int(env('TOKEN_CACHE_TTL', '60'))
+TOKEN_CACHE_SIZE = int(env('TOKEN_CACHE_SIZE', '10000'))
+
+# Пул для хэширования паролей при логине/регистрации: потоков и максимум задач в работе и очереди
+PASSWORD_HASH_WORKERS = int(env('PASSWORD_HASH_WORKERS', str(max(1, (os.cpu_count() or 2) // 2))))
+PASSWORD_HASH_QUEUE = int(env('PASSWORD_HASH_QUEUE', '64'))
+
+# Лимит попыток логина/регистрации в минуту (0 - без лимита)
+AUTH_THROTTLE_EMAIL_PER_MINUTE = int(env('AUTH_THROTTLE_EMAIL_PER_MINUTE', '10'))
+AUTH_THROTTLE_IP_PER_MINUTE = int(env('AUTH_THROTTLE_IP_PER_MINUTE', '60'))
+
+# Интерфейс сервера: asgi выставляет there_n_back_backend/asgi.py (продакшен-gunicorn по умолчанию),
+# runserver, manage.py и wsgi.py - wsgi
+SERVER_INTERFACE = env('SERVER_INTERFACE', 'wsgi')
+
+# list/retrieve городов, заказов и перевозок через async ORM (см. api/async_views.py); 0 - синхронные вью.
+# По умолчанию включено только под ASGI: под WSGI async-вью выполнялась бы через async_to_sync
+ASYNC_READ_PATH = env('ASYNC_READ_PATH', '1' if SERVER_INTERFACE == 'asgi' else '0') == '1'
+
+# Строк за одно чтение из server-side cursor при потоковой выгрузке (export)
+EXPORT_CHUNK_SIZE = int(env('EXPORT_CHUNK_SIZE', '2000'))
+
+# Строк в одной пачке валидации и bulk_create при импорте водителей/машин/городов
+BULK_IMPORT_CHUNK_SIZE = int(env('BULK_IMPORT_CHUNK_SIZE', '5000'))
+
+# Push статусов заказов/перевозок (GET /api/events/, SSE): класс брокера (с REDIS_URL - общий
+# RedisBroker, иначе брокер в памяти процесса), сколько последних событий помнить для докачки
+# по Last-Event-ID, очередь одного подписчика, период пинга (сек) и пауза переподключения клиента (мс)
+EVENTS_BROKER = env('EVENTS_BROKER', 'api.events.RedisBroker' if REDIS_URL else 'api.events.InMemoryBroker')
+EVENTS_BUFFER_SIZE = int(env('EVENTS_BUFFER_SIZE', '10000'))
+EVENTS_QUEUE_SIZE = int(env('EVENTS_QUEUE_SIZE', '1000'))
+EVENTS_HEARTBEAT_SECONDS = float(env('EVENTS_HEARTBEAT_SECONDS', '15'))
+EVENTS_RETRY_MS = int(env('EVENTS_RETRY_MS', '3000'))
+
+# На сколько строк-шардов разбит каждый счётчик дашборда (меньше ожидания блокировок при записи)
+DASHBOARD_COUNTER_SHARDS = int(env('DASHBOARD_COUNTER_SHARDS', '8'))
+
+# Сколько (сек) живут в кэше часовые/суточные свёртки аналитики по маршрутам.
+# Смены статусов и отзывы в уже закрытых бакетах видны не позже, чем через это время
+ANALYTICS_ROLLUP_TTL = int(env('ANALYTICS_ROLLUP_TTL', '600'))
+
+# Период (сек) задачи планировщика (manage.py run_scheduler), переводящей просроченные перевозки в Delayed
+SCHEDULER_OVERDUE_SECONDS = int(env('SCHEDULER_OVERDUE_SECONDS', '60'))
+# Период (сек) пересчёта is_available ("свободен сейчас") по интервалам рейсов и простоев
+SCHEDULER_AVAILABILITY_SECONDS = int(env('SCHEDULER_AVAILABILITY_SECONDS', '60'))
+# Сколько (сек) после arrival_time задержанный рейс ещё держит водителя и машину
+SHIPMENT_DELAY_GRACE_SECONDS = int(env('SHIPMENT_DELAY_GRACE_SECONDS', str(24 * 3600)))
+
+# Очередь задач после переходов статусов (api/tasks.py): потоков-воркеров в процессе
+# manage.py run_tasks, задач за один проход, пауза опроса при пустой очереди (сек)
+TASKS_WORKERS = int(env('TASKS_WORKERS', '2'))
+TASKS_BATCH_SIZE = int(env('TASKS_BATCH_SIZE', '50'))
+TASKS_POLL_SECONDS = float(env('TASKS_POLL_SECONDS', '1'))
+# Повторы упавшей задачи: задержка TASKS_RETRY_BASE_SECONDS * 2^(попытка-1), не больше
+# TASKS_RETRY_MAX_SECONDS; после TASKS_MAX_ATTEMPTS попыток задача уходит в DeadTask
+TASKS_MAX_ATTEMPTS = int(env('TASKS_MAX_ATTEMPTS', '8'))
+TASKS_RETRY_BASE_SECONDS = float(env('TASKS_RETRY_BASE_SECONDS', '2'))
+TASKS_RETRY_MAX_SECONDS = float(env('TASKS_RETRY_MAX_SECONDS', '3600'))
+
+# Каталог с memory-mapped матрицей расстояний по маршрутам заказов (общий для всех воркеров);
+# собирается manage.py build_distance_matrix, в docker - в entrypoint.sh, дальше её пишет run_tasks
+DISTANCE_MATRIX_DIR = env('DISTANCE_MATRIX_DIR', str(BASE_DIR / 'var' / 'distances'))
+
 # AUTHENTICATION_BACKENDS = [
 #     'django.contrib.auth.backends.ModelBackend',
 # ]
@@ -3,8 +3,9 @@ from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from api.views import (
     ClientOrderViewSet, DispatcherOrderViewSet,
-    DriverViewSet, VehicleViewSet,
-    RegisterView, LoginView,
+    DriverViewSet, VehicleViewSet, DowntimeViewSet,
+    RegisterView, LoginView, LogoutView, TokenRefreshView, EventStreamView, DashboardView, RouteAnalyticsView,
+    RoutePlanView,
     CityViewSet,
     DispatcherShipmentViewSet,
     ClientShipmentViewSet
@@ -19,6 +20,7 @@ router.register(r'client/orders', ClientOrderViewSet, basename='client-orders')
 router.register(r'dispatcher/orders', DispatcherOrderViewSet, basename='dispatcher-orders')
 router.register(r'drivers', DriverViewSet)
 router.register(r'vehicles', VehicleViewSet)
+router.register(r'downtimes', DowntimeViewSet)
 router.register(r'cities', CityViewSet)
 router.register(r'dispatcher/shipments', DispatcherShipmentViewSet, basename='dispatcher-shipments')
 router.register(r'client/shipments', ClientShipmentViewSet, basename='client-shipments')
@@ -29,6 +31,12 @@ urlpatterns = [
     path('api/', include(router.urls)),
     path('api/register/', RegisterView.as_view(), name='register'),
     path('api/login/', LoginView.as_view(), name='login'),
+    path('api/logout/', LogoutView.as_view(), name='logout'),
+    path('api/token/refresh/', TokenRefreshView.as_view(), name='token-refresh'),
+    path('api/events/', EventStreamView.as_view(), name='events'),
+    path('api/dispatcher/dashboard/', DashboardView.as_view(), name='dispatcher-dashboard'),
+    path('api/dispatcher/analytics/routes/', RouteAnalyticsView.as_view(), name='dispatcher-route-analytics'),
+    path('api/dispatcher/routes/plan/', RoutePlanView.as_view(), name='dispatcher-route-plan'),
     #path('api-token-auth/', drf_auth_views.obtain_auth_token),
     # Swagger:
     path('api/schema/', SpectacularAPIView.as_view(), name='schema'),